@@ -30,7 +30,7 @@ filesMajor = ["interpretFlat.py", "interpretPisa.py", "makePisaFigure.py",
 
 # Things that take command-line arguments
 filesMinor = ["checkJson.py", "lengthCalc.py", "makeLossPlots.py", "metrics.py",
-              "motifAddQuantiles.py", "predictToBigwig.py", "shapToBigwig.py",
+              "motifAddQuantiles.py", "predictGenome.py", "predictToBigwig.py", "shapToBigwig.py",
               "shapToNumpy.py", "showModel.py", "showTrainingProgress.py"]
 
 # Libraries that can't be executed on their own
@@ -42,11 +42,13 @@ filesApi = ["bedUtils.py", "callbacks.py", "colors.py", "gaOptimize.py",
 
 filesInternalApi = ["disableTensorflowLogging.py", "constants.py", "crashQueue.py",
                     "files.py", "interpreter.py", "interpretUtils.py", "predictUtils.py",
-                    "plotUtils.py"]
+                    "plotUtils.py", "sharedRing.py", "fastaIndex.py",
+                    "predictionCache.py", "bigwigCache.py"]
 
 filesToolsMinor = ["lossWeights.py", "revcompTools.py", "shiftBigwigs.py",
                    "tileGenome.py", "bestMotifsOnly.py", "shiftPisa.py",
-                   "filterProc.py"
+                   "filterProc.py", "benchmarkSlide.py", "benchmarkLoss.py",
+                   "checkMixedPrecision.py"
                    ]
 
 filesToolsMajor = ["addNoise.py"]
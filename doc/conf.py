@@ -36,11 +36,12 @@ exclude_patterns = ["_build", "Thumbs.db", ".DS_Store", "text", "bnf",
 man1 = ["addNoise", "bestMotifsOnly", "checkJson", "interpretFlat",
         "interpretPisa", "lengthCalc", "lossWeights", "makeLossPlots",
         "makePisaFigure", "makePredictions", "metrics", "motifAddQuantiles",
-        "motifScan", "motifSeqletCutoffs", "predictToBigwig", "prepareBed",
+        "motifScan", "motifSeqletCutoffs", "predictGenome", "predictToBigwig", "prepareBed",
         "prepareTrainingData", "revcompTools", "shapToBigwig", "shapToNumpy",
         "shiftBigwigs", "shiftPisa", "showModel", "showTrainingProgress",
         "tileGenome", "trainSoloModel", "trainTransformationModel",
-        "trainCombinedModel", "filterProc"]
+        "trainCombinedModel", "filterProc", "benchmarkSlide",
+        "benchmarkLoss", "checkMixedPrecision"]
 man3 = ["addNoiseUtils", "bedUtils", "callbacks", "colors", "constants",
         "disableTensorflowLogging", "files", "gaOptimize", "generators",
         "interpretUtils", "jaccard", "layers", "logUtils", "losses", "models",
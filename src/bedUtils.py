@@ -10,6 +10,7 @@ import pyBigWig
 from bpreveal import logUtils
 from bpreveal.logUtils import wrapTqdm
 from bpreveal.internal import constants
+from bpreveal.internal.bigwigCache import BigwigCache
 from bpreveal.internal.crashQueue import CrashQueue
 
 
@@ -232,7 +233,7 @@ def resize(interval: pybedtools.Interval, mode: str, width: int,
 def _metapeakThread(bwFname: str,
                     inQueue: CrashQueue,
                     outQueue: CrashQueue) -> None:
-    bigwigFp = pyBigWig.open(bwFname)
+    bigwigFp = BigwigCache(bwFname)
     totalProfile = None
     numQueries = 0
     while (query := inQueue.get()) is not None:
@@ -242,10 +243,10 @@ def _metapeakThread(bwFname: str,
         if strand == "-":
             profile = np.flip(profile)
         if totalProfile is None:
-            totalProfile = profile
+            totalProfile = profile.astype(np.float64)
         else:
             totalProfile = totalProfile + profile
-        outQueue.put((totalProfile, numQueries))
+    outQueue.put((totalProfile, numQueries))
     bigwigFp.close()
 
 
@@ -272,6 +273,8 @@ def metapeak(intervals: pybedtools.BedTool,
     your inputs before you call this.
 
     NaN entries in the bigwig are treated as zero.
+    The bigwig is read through a
+    :py:class:`BigwigCache<bpreveal.internal.bigwigCache.BigwigCache>`.
     """
     # I don't usually do error checking, but getting a crash in this function
     # could leave the interpreter in a tizzy, and it will likely be used
@@ -305,6 +308,8 @@ def metapeak(intervals: pybedtools.BedTool,
         rets.append(outQueue.get())
     for i in range(numThreads):
         pids[i].join()
+    # A worker that didn't get any regions sends back a None profile.
+    rets = [r for r in rets if r[1] > 0]
     totalProfile = rets[0][0]
     totalCounts = rets[0][1]
     for p, c in rets[1:]:
@@ -318,7 +323,9 @@ def getCounts(interval: pybedtools.Interval, bigwigs: list) -> float:
     """Get the total counts from all bigwigs at a given Interval.
 
     :param interval: A pyBedTools Interval.
-    :param bigwigs: A list of opened pyBigWig objects (not strings!).
+    :param bigwigs: A list of opened pyBigWig objects or
+        :py:class:`BigwigCache<bpreveal.internal.bigwigCache.BigwigCache>` objects
+        (not strings!).
     :return: A single number giving the total reads from all bigwigs at
         the given interval.
 
@@ -327,7 +334,7 @@ def getCounts(interval: pybedtools.Interval, bigwigs: list) -> float:
     total = 0
     for bw in bigwigs:
         vals = np.nan_to_num(bw.values(interval.chrom, interval.start, interval.end))
-        total += np.sum(vals)
+        total += np.sum(vals, dtype=np.float64)
     return total
 
 
@@ -363,6 +370,9 @@ class ParallelCounter:
     """A class that queues up :py:func:`~getCounts` jobs and runs them in parallel.
 
     This is used by the :py:mod:`prepareBed<bpreveal.prepareBed>` script.
+    The workers read the bigwigs through
+    :py:class:`BigwigCache<bpreveal.internal.bigwigCache.BigwigCache>` objects,
+    so if the cache is turned on, each chromosome is only decoded once.
 
     :param bigwigNames: The name of the bigwig files to read from
     :param numThreads: How many parallel workers should be used?
@@ -452,7 +462,7 @@ def _counterThread(bigwigFnames: list[str], inQueue: CrashQueue,
             return total
 
     """
-    bwFiles = [pyBigWig.open(fname) for fname in bigwigFnames]
+    bwFiles = [BigwigCache(fname) for fname in bigwigFnames]
     outDeque = deque()
     inDeque = 0
     while True:
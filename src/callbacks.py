@@ -54,9 +54,9 @@ class FixLossCallback(Callback):
 
         for head in self.heads:
             headName = head["head-name"]
-            profileRe = fr".*profile_{headName}_multinomial_nll"
+            profileRe = fr".*profile_{headName}_(fast_)?multinomial_nll"
             countsRe = fr".*logcounts_{headName}_reweightable_mse"
-            valProfileRe = fr"val.*profile_{headName}_multinomial_nll"
+            valProfileRe = fr"val.*profile_{headName}_(fast_)?multinomial_nll"
             valCountsRe = fr"val.*logcounts_{headName}_reweightable_mse"
 
             for lossName in logs.keys():
@@ -202,9 +202,9 @@ class ApplyAdaptiveCountsLoss(Callback):
         named "profile_x", then this could get messed up.
         """
         epochLosses = self.logsHistory[epoch]
-        profileRe = fr".*profile_{headName}_multinomial_nll"
+        profileRe = fr".*profile_{headName}_(fast_)?multinomial_nll"
         countsRe = fr".*logcounts_{headName}_reweightable_mse"
-        valProfileRe = fr"val.*profile_{headName}_multinomial_nll"
+        valProfileRe = fr"val.*profile_{headName}_(fast_)?multinomial_nll"
         valCountsRe = fr"val.*logcounts_{headName}_reweightable_mse"
 
         valProfile = valCounts = profile = counts = None
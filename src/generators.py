@@ -4,6 +4,8 @@ These files will have been generated by
 :py:mod:`prepareTrainingData<bpreveal.prepareTrainingData>`.
 """
 import math
+import os
+import threading
 import time
 import h5py
 import numpy as np
@@ -11,8 +13,31 @@ from numpy._typing import NDArray
 from bpreveal.internal import disableTensorflowLogging  # pylint: disable=unused-import # noqa
 import keras
 from bpreveal import logUtils
-from bpreveal.internal.constants import MODEL_ONEHOT_T, NUM_BASES, ONEHOT_T, PRED_T
-from bpreveal.internal.libslide import slide, slideChar
+from bpreveal.internal.constants import NUM_BASES, ONEHOT_T, PRED_T, H5_CHUNK_SIZE
+from bpreveal.internal.libslide import slide, slideBytes
+
+
+def jitteredLogCounts(data: NDArray, outputLength: int, numOffsets: int) -> NDArray:
+    """Calculate the log counts in every jittered output window of every region.
+
+    :param data: The profiles for one head, shape
+        (numRegions x (outputLength + jitter*2) x numTasks).
+    :param outputLength: The output length of the model.
+    :param numOffsets: How many different jitters can be applied to each region?
+    :return: An array of shape (numRegions x numOffsets) where entry ``[r, c]`` is
+        ``log(sum(data[r, c:c + outputLength, :]))``.
+
+    The sums come from a running total along each region, so each window's count is
+    the difference of two entries of it and the profiles are only summed once.
+    """
+    ret = np.empty((data.shape[0], numOffsets), dtype=PRED_T)
+    for start in range(0, data.shape[0], H5_CHUNK_SIZE):
+        baseCounts = np.sum(data[start:start + H5_CHUNK_SIZE], axis=2, dtype=np.float64)
+        runningTotal = np.zeros((baseCounts.shape[0], baseCounts.shape[1] + 1))
+        np.cumsum(baseCounts, axis=1, out=runningTotal[:, 1:])
+        np.log(runningTotal[:, outputLength:outputLength + numOffsets]
+               - runningTotal[:, :numOffsets], out=ret[start:start + H5_CHUNK_SIZE])
+    return ret
 
 
 class H5BatchGenerator(keras.utils.Sequence):
@@ -27,10 +52,41 @@ class H5BatchGenerator(keras.utils.Sequence):
     :param maxJitter: How much random offset can the generator apply when it creates
         a batch?
     :param batchSize: How many samples will the model be trained on in each batch?
+    :param lazy: If True, don't load the data into memory. Instead, read it from the
+        hdf5 file as it's needed. See below.
+    :param lazyWindowChunks: In lazy mode, how many hdf5 chunks are read at once?
+    :param backgroundRefreshBytes: If the jittered data for one epoch take no more than
+        this many bytes, the next epoch is prepared in a background thread while the
+        current one trains. This costs one extra copy of the jittered data.
+        The default, 0, turns this off. It isn't used in lazy mode.
+    :param numThreads: How many threads should jitter the data each epoch?
+        The default is the number of CPUs this process may run on.
+
+    Normally, the whole data set is read into memory, along with a jittered copy of it
+    that is re-made every epoch.
+    For data sets that don't fit in memory, use ``lazy=True``. In lazy mode, each epoch
+    visits the chunks of the hdf5 file in a random order. The chunks are read
+    ``lazyWindowChunks`` at a time, the regions in each such window are shuffled,
+    and each batch is jittered when it's requested. Only about two windows of data are
+    in memory at any time. The shuffling is not quite as thorough as in normal mode,
+    since two regions from different windows can't be in the same batch.
+
+    In normal mode, shuffling and jittering all of the data takes a few seconds at
+    the end of every epoch, and nothing trains during that time. With
+    ``backgroundRefreshBytes``, there are two sets of jittered buffers. One is used
+    for training while a background thread fills the other one for the next epoch,
+    and they are swapped in :py:meth:`~on_epoch_end`.
+
+    Sequences in the batches are one-hot encoded as :py:data:`ONEHOT_T
+    <bpreveal.internal.constants.ONEHOT_T>` (bytes), not as floats. The model casts them
+    to the dtype of its input layer inside the graph, so the sequence buffers are a
+    quarter of the size and a quarter as much data is copied to the model each step.
     """
 
     def __init__(self, headList: dict, dataH5: h5py.File, inputLength: int,
-                 outputLength: int, maxJitter: int, batchSize: int):
+                 outputLength: int, maxJitter: int, batchSize: int,
+                 lazy: bool = False, lazyWindowChunks: int = 64,
+                 backgroundRefreshBytes: int = 0, numThreads: int | None = None):
         """Create the generator and do the initial data load."""
         logUtils.info("Initial load of dataset for hdf5-based generator.")
         self.headList = headList
@@ -38,23 +94,49 @@ class H5BatchGenerator(keras.utils.Sequence):
         self.outputLength = outputLength
         self.maxJitter = maxJitter
         self.batchSize = batchSize
-        # The shape of the sequence dataset is
-        # (numRegions x (inputLength + jitter*2 x NUM_BASES))
-        self.fullSequences = np.array(dataH5["sequence"], dtype=ONEHOT_T)
-        self.numRegions = self.fullSequences.shape[0]
-        # The shape of the profile is
-        # (num-heads) x (numRegions x (outputLength + jitter*2) x numTasks)
-        # Similar to the prediction script outputs, the heads are all separate,
-        # and are named "head_N", where N is 0,1,2, etc.
-        self.fullData = []
-        for i, curHead in enumerate(headList):
-            logUtils.debug(f"Loading data for {curHead['head-name']}")
-            self.fullData.append(np.array(dataH5[f"head_{i}"],
-                                          dtype=PRED_T))
+        self.lazy = lazy
+        self.backgroundRefreshBytes = backgroundRefreshBytes
+        if numThreads is None:
+            numThreads = len(os.sched_getaffinity(0))
+        self.numThreads = numThreads
+        self._refreshThread = None
+        if lazy:
+            self._initLazy(dataH5, lazyWindowChunks)
+        else:
+            # The shape of the sequence dataset is
+            # (numRegions x (inputLength + jitter*2 x NUM_BASES))
+            self.fullSequences = np.array(dataH5["sequence"], dtype=ONEHOT_T)
+            self.numRegions = self.fullSequences.shape[0]
+            # The shape of the profile is
+            # (num-heads) x (numRegions x (outputLength + jitter*2) x numTasks)
+            # Similar to the prediction script outputs, the heads are all separate,
+            # and are named "head_N", where N is 0,1,2, etc.
+            self.fullData = []
+            for i, curHead in enumerate(headList):
+                logUtils.debug(f"Loading data for {curHead['head-name']}")
+                self.fullData.append(np.array(dataH5[f"head_{i}"],
+                                              dtype=PRED_T))
+            # The counts of every possible jittered window never change, so
+            # they're calculated once here instead of every epoch.
+            self._jitterLogCounts = [
+                jitteredLogCounts(d, outputLength, maxJitter * 2) for d in self.fullData]
         self.loadData()
         self.addMeanCounts()
         logUtils.info("Batch generator initialized.")
 
+    def _initLazy(self, dataH5: h5py.File, lazyWindowChunks: int) -> None:
+        """Set up the generator to read from dataH5 as needed."""
+        self._dataH5 = dataH5
+        seqDset = dataH5["sequence"]
+        self.numRegions = seqDset.shape[0]
+        self._blockRows = seqDset.chunks[0] if seqDset.chunks is not None else H5_CHUNK_SIZE
+        self._numBlocks = math.ceil(self.numRegions / self._blockRows)
+        self._windowBlocks = lazyWindowChunks
+        self._windowCache: dict[int, tuple] = {}
+        self._windowLock = threading.Lock()
+        logUtils.debug(f"Lazy generator with {self.numRegions} regions in "
+                       f"{self._numBlocks} chunks of {self._blockRows}.")
+
     def addMeanCounts(self) -> None:
         """For all heads, calculate the average number of reads over all regions.
 
@@ -69,7 +151,15 @@ class H5BatchGenerator(keras.utils.Sequence):
         λ = f * ĉ
         """
         for i, head in enumerate(self.headList):
-            sumCounts = np.sum(self.fullData[i][:, self.maxJitter:-self.maxJitter, :])
+            if self.lazy:
+                dset = self._dataH5[f"head_{i}"]
+                sumCounts = 0.0
+                for start in range(0, self.numRegions, self._blockRows * self._windowBlocks):
+                    block = np.array(dset[start:start + self._blockRows * self._windowBlocks],
+                                     dtype=PRED_T)
+                    sumCounts += float(np.sum(block[:, self.maxJitter:-self.maxJitter, :]))
+            else:
+                sumCounts = np.sum(self.fullData[i][:, self.maxJitter:-self.maxJitter, :])
             mean = sumCounts / self.numRegions
             head["INTERNAL_mean-counts"] = mean
             logUtils.debug(f"For head {head['head-name']}, mean counts is {mean}")
@@ -82,6 +172,8 @@ class H5BatchGenerator(keras.utils.Sequence):
         """Get the next *batch* of data."""
         batchStart = idx * self.batchSize
         batchEnd = min((idx + 1) * self.batchSize, self.numRegions)
+        if self.lazy:
+            return self._getLazyBatch(batchStart, batchEnd)
         vals = []
         counts = []
         for i in range(len(self.headList)):
@@ -89,57 +181,186 @@ class H5BatchGenerator(keras.utils.Sequence):
             counts.append(self._allBatchCounts[i][batchStart:batchEnd])
         return self._allBatchSequences[batchStart:batchEnd], tuple(vals + counts)
 
+    def _getLazyBatch(self, batchStart: int, batchEnd: int) -> tuple[NDArray, tuple[NDArray]]:
+        """Read and jitter the regions at positions batchStart to batchEnd of this epoch."""
+        sequences = []
+        vals = [[] for _ in self.headList]
+        counts = [[] for _ in self.headList]
+        firstWindow = np.searchsorted(self._windowStarts, batchStart, side="right") - 1
+        lastWindow = np.searchsorted(self._windowStarts, batchEnd - 1, side="right") - 1
+        for windowIdx in range(firstWindow, lastWindow + 1):
+            windowSeqs, windowData, windowLogCounts = self._getWindow(windowIdx)
+            start = max(batchStart, self._windowStarts[windowIdx])
+            end = min(batchEnd, self._windowStarts[windowIdx + 1])
+            localIdxs = self._epochLocalIdxs[start:end, np.newaxis]
+            cols = self._epochSliceCols[start:end, np.newaxis]
+            sequences.append(windowSeqs[localIdxs, cols + np.arange(self.inputLength)])
+            for headIdx, headData in enumerate(windowData):
+                vals[headIdx].append(headData[localIdxs, cols + np.arange(self.outputLength)])
+                counts[headIdx].append(windowLogCounts[headIdx][localIdxs[:, 0], cols[:, 0]])
+        batchSequences = np.concatenate(sequences)
+        batchVals = [np.concatenate(v) for v in vals]
+        batchCounts = [np.concatenate(c) for c in counts]
+        return batchSequences, tuple(batchVals + batchCounts)
+
+    def _getWindow(self, windowIdx: int) -> tuple[NDArray, list[NDArray], list[NDArray]]:
+        """Get the (unjittered) data for the chunks in a window, reading them if needed.
+
+        :return: The sequences, the profiles for each head, and the log counts
+            of every jittered window for each head (see :py:func:`~jitteredLogCounts`).
+        """
+        with self._windowLock:
+            if windowIdx not in self._windowCache:
+                blocks = self._windowBlocksSorted[windowIdx]
+                seqDset = self._dataH5["sequence"]
+                headDsets = [self._dataH5[f"head_{i}"] for i in range(len(self.headList))]
+                seqs = []
+                data = [[] for _ in self.headList]
+                for block in blocks:
+                    rowStart = block * self._blockRows
+                    rowEnd = min(rowStart + self._blockRows, self.numRegions)
+                    seqs.append(seqDset[rowStart:rowEnd])
+                    for headIdx, dset in enumerate(headDsets):
+                        data[headIdx].append(dset[rowStart:rowEnd])
+                # Keep the window that the last batch used, since the next batch
+                # may start in it.
+                for oldIdx in list(self._windowCache.keys()):
+                    if oldIdx < windowIdx - 1:
+                        del self._windowCache[oldIdx]
+                windowData = [np.concatenate(d).astype(PRED_T) for d in data]
+                self._windowCache[windowIdx] = (
+                    np.concatenate(seqs).astype(ONEHOT_T),
+                    windowData,
+                    [jitteredLogCounts(d, self.outputLength, self.maxJitter * 2)
+                     for d in windowData])
+            return self._windowCache[windowIdx]
+
     def loadData(self) -> None:
         """Read in the hdf5 file and suck all the data into memory.
 
-        Called only once.
+        Called only once. In lazy mode, this just sets up the random number generator.
         """
-        self._allBatchSequences = np.empty((self.numRegions, self.inputLength, NUM_BASES),
-                                           dtype=MODEL_ONEHOT_T)
-        self._allBatchValues = []
-        self._allBatchCounts = []
+        self.rng = np.random.default_rng(seed=1234)
+        if self.lazy:
+            self.refreshData()
+            return
+        self._allBatchSequences, self._allBatchValues, self._allBatchCounts = \
+            self._makeBuffers()
+        self.regionIndexes = np.arange(0, self.numRegions)
+        self.refreshData()
+        bufferBytes = self._allBatchSequences.nbytes \
+            + sum(v.nbytes for v in self._allBatchValues) \
+            + sum(c.nbytes for c in self._allBatchCounts)
+        if 0 < bufferBytes <= self.backgroundRefreshBytes:
+            logUtils.debug(f"Preparing epochs in the background, using {bufferBytes} "
+                           "extra bytes.")
+            self._nextBuffers = self._makeBuffers()
+            self._startRefresh()
+        elif self.backgroundRefreshBytes > 0:
+            logUtils.info(f"The jittered data take {bufferBytes} bytes, which is more than "
+                          f"the background refresh limit of {self.backgroundRefreshBytes}. "
+                          "The data will be refreshed between epochs instead.")
+
+    def _makeBuffers(self) -> tuple[NDArray, list[NDArray], list[NDArray]]:
+        """Allocate the arrays that hold one epoch of jittered data."""
+        sequences = np.empty((self.numRegions, self.inputLength, NUM_BASES),
+                             dtype=ONEHOT_T)
+        values = []
+        counts = []
         for head in self.headList:
-            self._allBatchValues.append(
+            values.append(
                 np.empty((self.numRegions, self.outputLength, head["num-tasks"]),
                          dtype=PRED_T))
-            self._allBatchCounts.append(
+            counts.append(
                 np.empty((self.numRegions,), dtype=PRED_T))
-        self.regionIndexes = np.arange(0, self.numRegions)
-        self.rng = np.random.default_rng(seed=1234)
-        self.refreshData()
+        return sequences, values, counts
 
     def refreshData(self) -> None:
         """Go over all the data and load it into the data structures from loadData.
 
-        Called once every epoch.
+        Called once every epoch, unless the next epoch is being prepared in the
+        background.
         """
         # First, randomize which regions go into which batches.
         logUtils.debug("Refreshing batch data.")
         startTime = time.perf_counter()
+        if self.lazy:
+            self._refreshLazy()
+            return
+        self._fillBuffers(self._allBatchSequences, self._allBatchValues,
+                          self._allBatchCounts)
+        stopTime = time.perf_counter()
+        Δt = stopTime - startTime
+        logUtils.debug(f"Loaded new batch in {Δt:5f} seconds.")
+
+    def _fillBuffers(self, sequences: NDArray, values: list[NDArray],
+                     counts: list[NDArray]) -> None:
+        """Shuffle and jitter the data into the given buffers."""
         self.rng.shuffle(self.regionIndexes)
         sliceCols = self.rng.integers(0,
                                       self.maxJitter * 2, size=(self.numRegions,),
                                       dtype=np.int32)
-        self._shiftSequence(self.regionIndexes, sliceCols)
-        self._shiftData(self.regionIndexes, sliceCols)
-        stopTime = time.perf_counter()
-        Δt = stopTime - startTime
-        logUtils.debug(f"Loaded new batch in {Δt:5f} seconds.")
+        self._shiftSequence(self.regionIndexes, sliceCols, sequences)
+        self._shiftData(self.regionIndexes, sliceCols, values, counts)
+
+    def _startRefresh(self) -> None:
+        """Start filling the spare buffers with the next epoch's data."""
+        self._refreshThread = threading.Thread(target=self._fillBuffers,
+                                               args=self._nextBuffers, daemon=True)
+        self._refreshThread.start()
+
+    def _refreshLazy(self) -> None:
+        """Pick a new order of chunks and regions, and new jitters, for lazy mode."""
+        blockOrder = self.rng.permutation(self._numBlocks)
+        self._windowBlocksSorted = [
+            np.sort(blockOrder[i:i + self._windowBlocks])
+            for i in range(0, self._numBlocks, self._windowBlocks)]
+        windowLocalIdxs = []
+        windowSizes = []
+        for blocks in self._windowBlocksSorted:
+            # The regions in each window are shuffled. Only the last chunk of the file
+            # can be short, and since it sorts to the end of its window, a region's
+            # index in the window is just its position in the concatenated chunks.
+            numRows = int(np.sum(np.minimum((blocks + 1) * self._blockRows, self.numRegions)
+                                 - blocks * self._blockRows))
+            windowLocalIdxs.append(self.rng.permutation(numRows))
+            windowSizes.append(numRows)
+        self._windowStarts = np.concatenate([[0], np.cumsum(windowSizes)])
+        self._epochLocalIdxs = np.concatenate(windowLocalIdxs)
+        self._epochSliceCols = self.rng.integers(0, self.maxJitter * 2,
+                                                 size=(self.numRegions,), dtype=np.int32)
+        with self._windowLock:
+            self._windowCache = {}
 
-    def _shiftSequence(self, regionIndexes: NDArray, sliceCols: NDArray) -> None:
-        # This is a good target for optimization - it takes multiple seconds!
-        slideChar(self.fullSequences, self._allBatchSequences,
-                  regionIndexes, sliceCols)
+    def _shiftSequence(self, regionIndexes: NDArray, sliceCols: NDArray,
+                       sequences: NDArray) -> None:
+        slideBytes(self.fullSequences, sequences, regionIndexes, sliceCols, self.numThreads)
 
-    def _shiftData(self, regionIndexes: NDArray, sliceCols: NDArray) -> None:
-        # This is a big target for optimization - it takes seconds to load a batch.
+    def _shiftData(self, regionIndexes: NDArray, sliceCols: NDArray,
+                   values: list[NDArray], counts: list[NDArray]) -> None:
+        allRows = np.arange(self.numRegions)
         for headIdx, _ in enumerate(self.headList):
-            slide(self.fullData[headIdx], self._allBatchValues[headIdx],
-                  regionIndexes, sliceCols)
-            valSums = np.sum(self._allBatchValues[headIdx], axis=(1, 2))
-            self._allBatchCounts[headIdx] = np.log(valSums)
+            slide(self.fullData[headIdx], values[headIdx],
+                  regionIndexes, sliceCols, self.numThreads)
+            counts[headIdx][regionIndexes] = self._jitterLogCounts[headIdx][allRows, sliceCols]
 
     def on_epoch_end(self) -> None:
-        """When the epoch is done, re-jitter the data by calling refreshData."""
-        self.refreshData()
+        """When the epoch is done, re-jitter the data.
+
+        If the next epoch was being prepared in the background, wait for it to
+        finish, swap it in, and start preparing the one after that.
+        Otherwise, call refreshData.
+        """
+        if self._refreshThread is None:
+            self.refreshData()
+            return
+        startTime = time.perf_counter()
+        self._refreshThread.join()
+        Δt = time.perf_counter() - startTime
+        logUtils.debug(f"Waited {Δt:5f} seconds for the background refresh.")
+        current = (self._allBatchSequences, self._allBatchValues, self._allBatchCounts)
+        self._allBatchSequences, self._allBatchValues, self._allBatchCounts = \
+            self._nextBuffers
+        self._nextBuffers = current
+        self._startRefresh()
 # Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
@@ -0,0 +1,232 @@
+"""A disk cache of decoded bigwig chromosomes, shared between tools and processes.
+
+Most of the data-preparation tools read the same bigwigs one region at a time:
+prepareBed counts reads in every candidate peak, prepareTrainingData pulls out the
+profile for every training region, and metrics and
+:py:func:`metapeak<bpreveal.bedUtils.metapeak>` do it again. Every one of those
+reads decompresses bigwig blocks, and the parallel tools decompress the same
+blocks once in every worker.
+
+A :py:class:`~BigwigCache` decodes a whole chromosome the first time any part of it
+is asked for and saves it as a float32 ``.npy`` file in the cache directory.
+After that, reads are just slices of a memory-mapped array. Since the arrays are
+memory-mapped, all of the processes reading the same chromosome share one copy
+in the operating system's page cache, and the next tool that reads the same bigwig
+doesn't decode anything at all.
+
+Cache files are named by a hash of the bigwig's absolute path, its size and
+modification time, and the chromosome, so changing a bigwig means its old cache
+files are simply never used again. (:py:func:`~clearCache` deletes them.)
+
+The cache takes four bytes per base of each chromosome that is read, so a full human
+genome is about 12 GB per bigwig, and nothing is ever deleted automatically.
+For that reason, the cache is off unless you ask for it: set the
+``BPREVEAL_BIGWIG_CACHE`` environment variable to a directory (or call
+:py:func:`~setCacheDir`) to turn it on. Put it somewhere with plenty of room, not
+on a small ``/tmp`` or a node's tmpfs. With the cache off, a ``BigwigCache`` just
+reads each region from the bigwig. If the cache directory fills up, the
+chromosome that was being decoded is thrown away and that cache goes back to
+reading from the bigwig.
+"""
+import fcntl
+import hashlib
+import os
+import numpy as np
+import pyBigWig
+from bpreveal import logUtils
+
+CACHE_SUFFIX = ".bpbw.npy"
+"""The file extension of the cached chromosome arrays."""
+
+_DECODE_BLOCK_SIZE = 2 ** 22
+"""How many bases should be decoded from the bigwig at once?"""
+
+_NUMPY_VALUES = bool(pyBigWig.numpy)
+"""Can pyBigWig give values as numpy arrays? (It can if numpy was there when it was built.)"""
+
+_cacheDir = os.environ.get("BPREVEAL_BIGWIG_CACHE", "")
+
+
+def setCacheDir(cacheDir: str | None) -> None:
+    """Set the directory where decoded chromosomes are saved.
+
+    :param cacheDir: The directory to use. It will be created if needed.
+        If ``None`` or empty, caching is turned off.
+
+    This only affects caches that are created after it is called.
+    """
+    global _cacheDir
+    _cacheDir = cacheDir or ""
+
+
+def getCacheDir() -> str | None:
+    """Get the directory where decoded chromosomes are saved.
+
+    :return: The cache directory, or ``None`` if caching is turned off.
+    """
+    return _cacheDir or None
+
+
+def clearCache() -> None:
+    """Delete every cached chromosome in the cache directory."""
+    if not _cacheDir or not os.path.isdir(_cacheDir):
+        return
+    for fname in os.listdir(_cacheDir):
+        if CACHE_SUFFIX in fname:  # The arrays, and any leftover lock or temporary files.
+            os.remove(os.path.join(_cacheDir, fname))
+
+
+class BigwigCache:
+    """Reads regions of a bigwig, decoding each chromosome only once.
+
+    :param bwFname: The name of the bigwig file.
+
+    :py:meth:`~values` is a drop-in replacement for pyBigWig's ``values()``, except
+    that it returns a float32 numpy array. As with pyBigWig, positions without data
+    are ``NaN``.
+
+    A ``BigwigCache`` can be pickled and sent to another process. The cached
+    chromosomes are mapped again the first time they're used in the new process.
+    """
+
+    def __init__(self, bwFname: str):
+        self.bwFname = os.path.abspath(bwFname)
+        stat = os.stat(self.bwFname)
+        self._fileKey = f"{self.bwFname}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        self.cacheDir = getCacheDir()
+        self._bw = None
+        self._chroms: dict[str, np.ndarray] = {}
+
+    def _open(self) -> pyBigWig.pyBigWig:
+        if self._bw is None:
+            self._bw = pyBigWig.open(self.bwFname, "r")
+        return self._bw
+
+    def _cacheFname(self, chrom: str) -> str:
+        assert self.cacheDir is not None
+        key = hashlib.blake2b(f"{self._fileKey}\0{chrom}".encode(), digest_size=16)
+        return os.path.join(self.cacheDir, key.hexdigest() + CACHE_SUFFIX)
+
+    def _decode(self, chrom: str, fname: str) -> None:
+        """Decode a whole chromosome from the bigwig and save it."""
+        bw = self._open()
+        chromSize = bw.chroms(chrom)
+        assert chromSize is not None, f"Chromosome {chrom} is not in {self.bwFname}"
+        logUtils.debug(f"Decoding {chrom} of {self.bwFname} into the bigwig cache.")
+        tmpFname = f"{fname}.{os.getpid()}.tmp"
+        # Write the file in blocks rather than through a memmap: if the disk fills
+        # up, a write raises an OSError, but a store into a memmap kills the process.
+        try:
+            with open(tmpFname, "wb") as fp:
+                np.lib.format.write_array_header_1_0(
+                    fp, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                         "fortran_order": False, "shape": (chromSize,)})
+                for start in range(0, chromSize, _DECODE_BLOCK_SIZE):
+                    end = min(start + _DECODE_BLOCK_SIZE, chromSize)
+                    vals = bw.values(chrom, start, end, numpy=_NUMPY_VALUES)
+                    fp.write(np.asarray(vals, dtype=np.float32).tobytes())
+            # Other processes only ever see a complete file.
+            os.replace(tmpFname, fname)
+        except BaseException:
+            if os.path.exists(tmpFname):
+                os.remove(tmpFname)
+            raise
+        logUtils.info(f"Wrote {chromSize * 4} bytes for {chrom} of {self.bwFname} "
+                      f"to the bigwig cache in {self.cacheDir}.")
+
+    def chromosome(self, chrom: str) -> np.ndarray:
+        """Get the (read-only, memory-mapped) data for a whole chromosome.
+
+        :param chrom: The chromosome to load.
+        :return: A float32 array with one entry per base of the chromosome.
+
+        This only works if caching is turned on.
+        """
+        if chrom in self._chroms:
+            return self._chroms[chrom]
+        assert self.cacheDir is not None, "Cannot load whole chromosomes with no cache."
+        fname = self._cacheFname(chrom)
+        if not os.path.exists(fname):
+            os.makedirs(self.cacheDir, exist_ok=True)
+            # Only one process decodes each chromosome; the others wait for it.
+            lockFname = fname + ".lock"
+            with open(lockFname, "w") as lockFp:
+                fcntl.flock(lockFp, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(fname):
+                        self._decode(chrom, fname)
+                finally:
+                    # Anyone still waiting on this lock finds the finished file
+                    # (or decodes it again if this failed), so it can go now.
+                    if os.path.exists(lockFname):
+                        os.remove(lockFname)
+                    fcntl.flock(lockFp, fcntl.LOCK_UN)
+        self._chroms[chrom] = np.load(fname, mmap_mode="r")
+        return self._chroms[chrom]
+
+    def values(self, chrom: str, start: int, end: int) -> np.ndarray:
+        """Get the values in a region.
+
+        :param chrom: The chromosome of the region.
+        :param start: The start of the region, 0-based, inclusive.
+        :param end: The end of the region, 0-based, exclusive.
+        :return: A float32 array of shape ``(end - start,)``. Bases with no data
+            are ``NaN``.
+        """
+        if self.cacheDir is None:
+            vals = self._open().values(chrom, start, end, numpy=_NUMPY_VALUES)
+            return np.array(vals, dtype=np.float32)
+        try:
+            chromData = self.chromosome(chrom)
+        except OSError as e:
+            logUtils.warning(f"Could not use the bigwig cache in {self.cacheDir} ({e}). "
+                             "Reading from the bigwig instead.")
+            self.cacheDir = None
+            return self.values(chrom, start, end)
+        assert 0 <= start <= end <= chromData.shape[0], \
+            f"Invalid interval {chrom}:{start}-{end} for {self.bwFname}"
+        return np.array(chromData[start:end])
+
+    def regions(self, chrom: str, starts: np.ndarray, width: int) -> np.ndarray:
+        """Get the values in many regions of the same width on one chromosome.
+
+        :param chrom: The chromosome that the regions are on.
+        :param starts: The start of each region, 0-based.
+        :param width: The width of every region.
+        :return: A float32 array of shape ``(len(starts), width)``. Bases with no
+            data are ``NaN``.
+
+        With the cache on, all of the regions are sliced out of the chromosome
+        at once. With it off, each region is read from the bigwig.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if self.cacheDir is not None and starts.shape[0] > 0:
+            try:
+                chromData = self.chromosome(chrom)
+            except OSError as e:
+                logUtils.warning(f"Could not use the bigwig cache in {self.cacheDir} ({e}). "
+                                 "Reading from the bigwig instead.")
+                self.cacheDir = None
+            else:
+                assert starts.min() >= 0 and starts.max() + width <= chromData.shape[0], \
+                    f"A region on {chrom} runs off the end of the chromosome in {self.bwFname}"
+                return chromData[starts[:, np.newaxis] + np.arange(width)]
+        ret = np.zeros((starts.shape[0], width), dtype=np.float32)
+        for i, start in enumerate(starts):
+            ret[i] = self.values(chrom, int(start), int(start) + width)
+        return ret
+
+    def close(self) -> None:
+        """Close the bigwig and unmap the chromosomes."""
+        if self._bw is not None:
+            self._bw.close()
+            self._bw = None
+        self._chroms = {}
+
+    def __getstate__(self) -> dict:
+        """Pickle everything except the open file and mapped arrays."""
+        state = self.__dict__.copy()
+        state["_bw"] = None
+        state["_chroms"] = {}
+        return state
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
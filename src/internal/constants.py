@@ -22,6 +22,8 @@ LOGIT_AR_T: TypeAlias = npt.NDArray[LOGIT_T]
 
 LOGCOUNT_T: TypeAlias = np.float32
 """Data type for logcount values."""
+LOGCOUNT_AR_T: TypeAlias = npt.NDArray[LOGCOUNT_T]
+"""Data type for an array of logcount values."""
 
 IMPORTANCE_T: TypeAlias = np.float16
 """Store importance scores with 16 bits of precision.
@@ -37,6 +39,9 @@ MODEL_ONEHOT_T: TypeAlias = np.float32
 """Inside the models, we use floating point numbers to represent one-hot sequences.
 
 For reasons I don't understand, setting this to uint8 DESTROYS pisa values.
+The inputs of the models themselves are still this type, but the training generator
+and the batch predictors hand sequences to the model as :py:data:`ONEHOT_T`, and Keras
+casts them to this type inside the graph.
 """
 
 MOTIF_FLOAT_T: TypeAlias = np.float32
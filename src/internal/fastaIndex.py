@@ -0,0 +1,314 @@
+"""An index of the records in a fasta file, for random access and parallel reading.
+
+Reading a fasta file line by line is slow when there are millions of records,
+and it can't be split up between processes since you don't know where a record
+starts until you've read everything in front of it. A :py:class:`~FastaIndex`
+scans the file once (with NumPy, so it runs at about the speed of the disk) and
+records the byte offset of every record. It saves those offsets next to the fasta
+so that the next program that reads the same file can skip the scan.
+
+With an index, any record can be read directly, and
+:py:func:`~readRecords` uses that to spread reading and one-hot encoding over
+a pool of worker processes.
+"""
+import os
+import mmap
+import multiprocessing
+from collections import deque
+from collections.abc import Iterator
+import numpy as np
+from bpreveal import logUtils
+from bpreveal.internal.constants import ONEHOT_T, ONEHOT_AR_T, NUM_BASES
+
+INDEX_SUFFIX = ".bpidx.npz"
+"""The index of ``foo.fa`` is saved as ``foo.fa.bpidx.npz``."""
+
+_SCAN_BLOCK_SIZE = 2 ** 26
+"""How many bytes of the fasta should be scanned at once when building an index?"""
+
+_NEWLINE = ord("\n")
+_WHITESPACE = b" \t\r\n"
+
+_ONEHOT_TABLE = np.zeros((256, NUM_BASES), dtype=ONEHOT_T)
+"""Maps each byte value onto its one-hot encoding, using the same rules as oneHotEncode."""
+for _i, _base in enumerate("ACGT"):
+    _ONEHOT_TABLE[ord(_base), _i] = 1
+    _ONEHOT_TABLE[ord(_base.lower()), _i] = 1
+_IS_BASE = np.any(_ONEHOT_TABLE, axis=1)
+
+
+def _encodePacked(seqBytes: np.ndarray) -> ONEHOT_AR_T:
+    """One-hot encode an array of bytes."""
+    return np.take(_ONEHOT_TABLE, seqBytes, axis=0)
+
+
+class FastaIndex:
+    """The positions of all of the records in a fasta file.
+
+    :param fastaFname: The name of the fasta file to index.
+    :param useCache: If True (the default), load the index from
+        ``fastaFname + INDEX_SUFFIX`` if it's there and up to date, and if it isn't,
+        try to save the new index there. If the directory isn't writable, you just
+        get a warning.
+
+    The cached index stores the size and modification time of the fasta, so if
+    the fasta changes, the index is rebuilt.
+
+    A ``FastaIndex`` can be pickled and sent to another process. The file is
+    re-opened the first time a record is read in the new process.
+    """
+
+    numRecords: int
+    """How many records (that is, ``>`` lines) are in the file?"""
+
+    def __init__(self, fastaFname: str, useCache: bool = True):
+        self.fastaFname = fastaFname
+        self._mm = None
+        stat = os.stat(fastaFname)
+        self._fileSize = stat.st_size
+        self._mtime = stat.st_mtime_ns
+        indexFname = fastaFname + INDEX_SUFFIX
+        if not (useCache and self._loadCache(indexFname)):
+            logUtils.info(f"Building index for fasta {fastaFname}")
+            self._build()
+            if useCache:
+                self._saveCache(indexFname)
+        self.numRecords = len(self._headerStarts)
+        # Each record's sequence starts after its description line and
+        # ends where the next record begins.
+        self._seqStarts = np.minimum(self._labelEnds + 1, self._fileSize)
+        self._seqEnds = np.append(self._headerStarts[1:], self._fileSize)
+        logUtils.debug(f"Fasta index has {self.numRecords} records.")
+
+    def _build(self) -> None:
+        """Scan the fasta and find where every record starts."""
+        if self._fileSize == 0:
+            self._headerStarts = np.zeros((0,), dtype=np.int64)
+            self._labelEnds = np.zeros((0,), dtype=np.int64)
+            return
+        headerBlocks = []
+        with open(self.fastaFname, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            raw = np.frombuffer(mm, dtype=np.uint8)
+            prevByte = _NEWLINE
+            for blockStart in range(0, self._fileSize, _SCAN_BLOCK_SIZE):
+                block = raw[blockStart:blockStart + _SCAN_BLOCK_SIZE]
+                isHeader = block == ord(">")
+                # A > only starts a record if it's at the start of a line.
+                isHeader[1:] &= block[:-1] == _NEWLINE
+                isHeader[0] &= prevByte == _NEWLINE
+                headerBlocks.append(np.flatnonzero(isHeader) + blockStart)
+                prevByte = block[-1]
+            self._headerStarts = np.concatenate(headerBlocks).astype(np.int64)
+            labelEnds = [mm.find(b"\n", h) for h in self._headerStarts]
+            # The numpy views have to go before the mmap can be closed.
+            del raw, block, isHeader
+            mm.close()
+        # If the last line is a description with no newline, find() gives -1.
+        self._labelEnds = np.array([self._fileSize if e < 0 else e for e in labelEnds],
+                                   dtype=np.int64)
+
+    def _loadCache(self, indexFname: str) -> bool:
+        """Try to load a saved index.
+
+        :param indexFname: Where the index would be.
+        :return: True if the index was loaded, False if it's missing or stale.
+        """
+        if not os.path.exists(indexFname):
+            return False
+        try:
+            with np.load(indexFname) as saved:
+                if int(saved["fileSize"]) != self._fileSize \
+                        or int(saved["mtime"]) != self._mtime:
+                    logUtils.info(f"Fasta index {indexFname} is out of date.")
+                    return False
+                self._headerStarts = saved["headerStarts"]
+                self._labelEnds = saved["labelEnds"]
+        except (OSError, ValueError, KeyError):
+            logUtils.warning(f"Could not read fasta index {indexFname}. Rebuilding it.")
+            return False
+        logUtils.debug(f"Loaded fasta index from {indexFname}")
+        return True
+
+    def _saveCache(self, indexFname: str) -> None:
+        """Save the index so it can be re-used later."""
+        try:
+            # np.savez would add .npz if the name didn't end with it,
+            # so give it an open file instead.
+            with open(indexFname, "wb") as fp:
+                np.savez(fp, headerStarts=self._headerStarts, labelEnds=self._labelEnds,
+                         fileSize=self._fileSize, mtime=self._mtime)
+        except OSError:
+            logUtils.warning(f"Could not save fasta index to {indexFname}. "
+                             "The fasta will be scanned again next time.")
+
+    def __getstate__(self) -> dict:
+        """Pickle everything except the open file."""
+        state = self.__dict__.copy()
+        state["_mm"] = None
+        return state
+
+    def _open(self) -> mmap.mmap:
+        if self._mm is None:
+            with open(self.fastaFname, "rb") as fp:
+                # The mmap stays valid after the file is closed.
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def close(self) -> None:
+        """Close the fasta file. It will be re-opened if you read another record."""
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def label(self, idx: int) -> str:
+        """Get the description line of a record.
+
+        :param idx: The number of the record, starting at zero.
+        :return: The description, without the leading ``>``.
+        """
+        mm = self._open()
+        return mm[self._headerStarts[idx] + 1:self._labelEnds[idx]].decode().strip()
+
+    def sequenceBytes(self, idx: int) -> bytes:
+        """Get the sequence of a record, with the line breaks removed.
+
+        :param idx: The number of the record, starting at zero.
+        :return: The sequence, as bytes.
+        """
+        mm = self._open()
+        return mm[self._seqStarts[idx]:self._seqEnds[idx]].translate(None, _WHITESPACE)
+
+    def sequence(self, idx: int) -> str:
+        """Get the sequence of a record as a string.
+
+        :param idx: The number of the record, starting at zero.
+        :return: The sequence.
+        """
+        return self.sequenceBytes(idx).decode()
+
+    def oneHot(self, idx: int, allowN: bool = False) -> ONEHOT_AR_T:
+        """Get the one-hot encoded sequence of a record.
+
+        :param idx: The number of the record, starting at zero.
+        :param allowN: Same meaning as in
+            :py:func:`utils.oneHotEncode<bpreveal.utils.oneHotEncode>`.
+        :return: An array of shape ``(sequence-length, NUM_BASES)``.
+
+        This encodes straight from the bytes in the file, and gives the same
+        result as ``oneHotEncode(index.sequence(idx))``.
+        """
+        seqBytes = np.frombuffer(self.sequenceBytes(idx), dtype=np.uint8)
+        ret = _encodePacked(seqBytes)
+        if not allowN:
+            assert np.count_nonzero(ret) == seqBytes.shape[0], \
+                "Sequence contains unrecognized nucleotides. "\
+                "Maybe your sequence contains 'N'?"
+        return ret
+
+    def readBlock(self, start: int, stop: int) -> tuple[list[str], list[ONEHOT_AR_T]]:
+        """Read a run of records.
+
+        :param start: The first record to read.
+        :param stop: One past the last record to read.
+        :return: The labels and one-hot encoded sequences of the records.
+        """
+        labels, seqBytes, splits = self._readPacked(start, stop)
+        return labels, np.split(_encodePacked(seqBytes), splits)
+
+    def _readPacked(self, start: int, stop: int) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """Read a run of records, and check all of their sequences in one go.
+
+        :param start: The first record to read.
+        :param stop: One past the last record to read.
+        :return: The labels, one array containing the bytes of every sequence in the
+            block one after the other, and the positions in that array where each
+            sequence (except the first) starts.
+
+        The workers in :py:func:`~readRecords` encode the packed form and send it
+        back as one array, since one big array pickles much faster than lots of
+        little ones.
+        """
+        mm = self._open()
+        blockStart = self._headerStarts[start]
+        blockEnd = self._seqEnds[stop - 1]
+        raw = np.frombuffer(mm[blockStart:blockEnd], dtype=np.uint8)
+        headerStarts = self._headerStarts[start:stop] - blockStart
+        labelEnds = self._labelEnds[start:stop] - blockStart
+        seqStarts = self._seqStarts[start:stop] - blockStart
+        labels = [bytes(raw[h + 1:e]).decode().strip()
+                  for h, e in zip(headerStarts, labelEnds)]
+        # Keep everything that isn't whitespace or part of a description line.
+        keep = np.ones(raw.shape, dtype=bool)
+        for c in _WHITESPACE:
+            keep &= raw != c
+        seqEnds = np.append(headerStarts[1:], raw.shape[0])
+        lengths = np.empty((stop - start,), dtype=np.int64)
+        for i, (h, seqStart, seqEnd) in enumerate(zip(headerStarts, seqStarts, seqEnds)):
+            keep[h:seqStart] = False
+            lengths[i] = np.count_nonzero(keep[seqStart:seqEnd])
+        seqBytes = raw[keep]
+        assert np.all(_IS_BASE[seqBytes]), \
+            "Sequence contains unrecognized nucleotides. "\
+            "Maybe your sequence contains 'N'?"
+        return labels, seqBytes, np.cumsum(lengths)[:-1]
+
+
+_workerIndex: FastaIndex | None = None
+"""The index that a worker in readRecords' pool reads from."""
+
+
+def _initWorker(index: FastaIndex) -> None:
+    global _workerIndex
+    _workerIndex = index
+
+
+def _readBlockWorker(start: int, stop: int) -> tuple[list[str], ONEHOT_AR_T, np.ndarray]:
+    """Read and one-hot encode a block, keeping the sequences packed into one array."""
+    assert _workerIndex is not None
+    readPacked = _workerIndex._readPacked  # pylint: disable=protected-access
+    labels, seqBytes, splits = readPacked(start, stop)
+    return labels, _encodePacked(seqBytes), splits
+
+
+def readRecords(index: FastaIndex, numThreads: int = 1, blockSize: int = 1024,
+                start: int = 0, stop: int | None = None) \
+        -> Iterator[tuple[str, ONEHOT_AR_T]]:
+    """Read records from a fasta, in order, using a pool of worker processes.
+
+    :param index: The index of the fasta to read.
+    :param numThreads: How many worker processes should read the file? If this is 1,
+        then the records are read in this process and no pool is created.
+    :param blockSize: How many records should a worker read at a time?
+    :param start: The first record to read.
+    :param stop: One past the last record to read. Default: read to the end.
+    :return: A generator yielding ``(label, oneHotSequence)`` for each record.
+
+    Each worker both reads and one-hot encodes its blocks, so this process only
+    splits the encoded blocks into records.
+    Only ``2 * numThreads`` blocks are read ahead of what you've consumed, so the
+    memory use stays small no matter how big the fasta is.
+    The pool is shut down when the generator is exhausted or closed.
+    """
+    if stop is None:
+        stop = index.numRecords
+    if numThreads <= 1:
+        for blockStart in range(start, stop, blockSize):
+            yield from zip(*index.readBlock(blockStart, min(blockStart + blockSize, stop)))
+        return
+    blockStarts = iter(range(start, stop, blockSize))
+    with multiprocessing.Pool(numThreads, initializer=_initWorker,
+                              initargs=(index,)) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * numThreads:
+                blockStart = next(blockStarts, None)
+                if blockStart is None:
+                    break
+                pending.append(pool.apply_async(
+                    _readBlockWorker, (blockStart, min(blockStart + blockSize, stop))))
+            if not pending:
+                break
+            labels, oneHots, splits = pending.popleft().get()
+            yield from zip(labels, np.split(oneHots, splits))
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
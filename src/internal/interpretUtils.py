@@ -24,6 +24,7 @@ from bpreveal.internal.constants import IMPORTANCE_AR_T, NUM_BASES, ONEHOT_T, ON
     IMPORTANCE_T, H5_CHUNK_SIZE, MODEL_ONEHOT_T, PRED_AR_T, PRED_T
 import bpreveal.internal.files as bprfiles
 from bpreveal.internal.crashQueue import CrashQueue
+from bpreveal.internal.fastaIndex import FastaIndex
 
 
 class Query:
@@ -821,35 +822,29 @@ class FastaGenerator(Generator):
 
     :param fastaFname: The name of the fasta-format file containing
         query sequences.
+
+    The records are found with a :py:class:`FastaIndex<bpreveal.internal.fastaIndex.FastaIndex>`,
+    so each sequence is read straight out of the file and encoded in one go.
     """
 
     def __init__(self, fastaFname: str):
         logUtils.info("Creating fasta generator.")
         self.fastaFname = fastaFname
-        self.nowStop = False
-        numRegions = 0
-
-        with open(fastaFname, "r") as fp:
-            for line in fp:
-                if len(line) > 0 and line[0] == ">":
-                    numRegions += 1
-        # Iterate through the input file real quick and find out how many regions I'll have.
-        self.numRegions = numRegions
+        # Building the index tells us how many regions there are. The index
+        # doesn't hold the file open, so it's safe to send to the child thread.
+        self._fastaIndex = FastaIndex(fastaFname)
+        self.numRegions = self._fastaIndex.numRecords
         self.index = 0
         logUtils.info(f"Fasta generator initialized with {self.numRegions} regions.")
 
     def construct(self) -> None:
-        """Open the file and start reading."""
+        """Nothing to do; the index opens the file when the first record is read."""
         logUtils.info("Constructing fasta generator in its thread.")
-        self.fastaFile = open(self.fastaFname, "r")  # pylint: disable=consider-using-with
-        self.nextSequenceID = self.fastaFile.readline()[1:].strip()
-        # [1:] to get rid of the '>'.
-        logUtils.debug(f"Initial sequence to read: {self.nextSequenceID}")
 
     def done(self) -> None:
         """Close the Fasta file."""
         logUtils.info("Closing fasta generator.")
-        self.fastaFile.close()
+        self._fastaIndex.close()
 
     def __iter__(self):
         """Return self, because generators are Iterable."""
@@ -858,21 +853,10 @@ class FastaGenerator(Generator):
 
     def __next__(self) -> Query:
         """Get the next Query."""
-        if self.nowStop:
+        if self.index >= self.numRegions:
             raise StopIteration()
-        sequence = ""
-        prevSequenceID = self.nextSequenceID
-        while True:
-            nextLine = self.fastaFile.readline()
-            if len(nextLine) == 0:
-                self.nowStop = True
-                break
-            if nextLine[0] == ">":
-                self.nextSequenceID = nextLine[1:].strip()
-                break
-            sequence += nextLine.strip()
-        oneHotSequence = utils.oneHotEncode(sequence)
-        q = Query(oneHotSequence, prevSequenceID, self.index)
+        q = Query(self._fastaIndex.oneHot(self.index), self._fastaIndex.label(self.index),
+                  self.index)
         self.index += 1
         return q
 
@@ -1,67 +1,35 @@
+#include <string.h>
 #define FLOAT_T float
 #define SIZE_T long
 /*
  * C implementation of row sliding, used to prepare input data for training.
  *
+ * All of the functions here implement the following:
+ * for row in numRows:
+ *   dest[rowIndexes[row]] = source[row, colIndexes[row]:colIndexes[row]+numDestCols]
+ *
+ * source is a (numRows x numSourceCols x depth) array.
+ * dest is a (numRows x numDestCols x depth) array.
+ * rowIndexes is a (numRows,) vector.
+ * colIndexes is a (numRows,) vector.
+ * Rows are handed out to numThreads threads.
+ * Both arrays are C-contiguous, so the part of a source row that gets copied
+ * and the destination row are each one contiguous span of numDestCols * depth
+ * elements.
+ * This is done on all the data in every epoch, so speeding it up made sense.
+ * It is invalid for any of the arrays to overlap at all.
  */
 
-void runRow(const FLOAT_T * const restrict source, FLOAT_T *restrict dest,
-            SIZE_T numRows, SIZE_T numSourceCols, SIZE_T numDestCols, SIZE_T depth,
-            const int * const restrict rowIndexes,
-            const int * const restrict colIndexes,
-            SIZE_T row) {
-    for (SIZE_T destCol = 0; destCol < numDestCols; destCol++) {
-        for (SIZE_T z = 0; z < depth; z++) {
-            SIZE_T sr = rowIndexes[row];
-            FLOAT_T srcVal = source[row * numSourceCols * depth
-                                    + (destCol + colIndexes[row]) * depth
-                                    + z];
-            dest[sr * numDestCols * depth
-                + destCol * depth
-                + z] = srcVal;
-        }
-    }
-}
-
-void runRowChar(const unsigned char * const restrict source,
-                FLOAT_T *restrict dest, SIZE_T numRows, SIZE_T numSourceCols,
-                SIZE_T numDestCols, SIZE_T depth,
-                const int * const restrict rowIndexes,
-                const int * const restrict colIndexes, SIZE_T row) {
-    for (SIZE_T destCol = 0; destCol < numDestCols; destCol++) {
-        for (SIZE_T z = 0; z < depth; z++) {
-            SIZE_T sr = rowIndexes[row];
-            FLOAT_T srcVal = source[row * numSourceCols * depth
-                                    + (destCol + colIndexes[row]) * depth
-                                    + z];
-            dest[sr * numDestCols * depth
-                + destCol * depth
-                + z] = srcVal;
-        }
-    }
-}
-
 void slide(const FLOAT_T * const restrict source, FLOAT_T *restrict dest,
            int numRows, int numSourceCols, int numDestCols, int depth,
            const int * const restrict rowIndexes,
-           const int * const restrict colIndexes) {
-    /**
-    * source is a (numRows x numSourceCols x depth) array.
-    * dest is a (numRows x numDestCols x depth) array.
-    * rowIndexes is a (numRows,) vector.
-    * colIndexes is a (numRows,) vector.
-    * Implements the following:
-    * for row in numRows:
-    *   dest[rowIndexes[row]] = source[row, colIndexes[row]:colIndexes[row]+numDestCols]
-    *
-    * This is done on all the data in every epoch, so speeding it up made sense.
-    * It is invalid for any of the arrays to overlap at all.
-    *
-    */
-    #pragma omp parallel for num_threads(8)
+           const int * const restrict colIndexes, int numThreads) {
+    const SIZE_T spanSize = (SIZE_T) numDestCols * depth;
+    #pragma omp parallel for num_threads(numThreads)
     for (SIZE_T row = 0; row < numRows; row++) {
-        runRow(source, dest, numRows, numSourceCols, numDestCols,
-               depth, rowIndexes, colIndexes, row);
+        memcpy(dest + rowIndexes[row] * spanSize,
+               source + (row * numSourceCols + colIndexes[row]) * depth,
+               spanSize * sizeof(FLOAT_T));
     }
 }
 
@@ -69,24 +37,67 @@ void slideChar(const unsigned char * const restrict source,
                FLOAT_T *restrict dest, int numRows, int numSourceCols,
                int numDestCols, int depth,
                const int * const restrict rowIndexes,
-               const int * const restrict colIndexes) {
-    /**
-    * source is a (numRows x numSourceCols x depth) array.
-    * dest is a (numRows x numDestCols x depth) array.
-    * rowIndexes is a (numRows,) vector.
-    * colIndexes is a (numRows,) vector.
-    * Implements the following:
-    * for row in numRows:
-    *   dest[rowIndexes[row]] = source[row, colIndexes[row]:colIndexes[row]+numDestCols]
-    *
-    * This is done on all the data in every epoch, so speeding it up made sense.
-    * It is invalid for any of the arrays to overlap at all.
-    *
-    */
-    #pragma omp parallel for num_threads(8)
+               const int * const restrict colIndexes, int numThreads) {
+    /*
+     * Same as slide, but the source is bytes and they are widened to floats,
+     * so the span can't just be copied. The loop over one span is simple enough
+     * for the compiler to vectorize.
+     * The training generator no longer calls this, since one-hot sequences now
+     * stay as bytes (see slideBytes).
+     */
+    const SIZE_T spanSize = (SIZE_T) numDestCols * depth;
+    #pragma omp parallel for num_threads(numThreads)
     for (SIZE_T row = 0; row < numRows; row++) {
-        runRowChar(source, dest, numRows, numSourceCols, numDestCols,
-                   depth, rowIndexes, colIndexes, row);
+        const unsigned char * const restrict sourceSpan =
+            source + (row * numSourceCols + colIndexes[row]) * depth;
+        FLOAT_T * const restrict destSpan = dest + rowIndexes[row] * spanSize;
+        for (SIZE_T i = 0; i < spanSize; i++) {
+            destSpan[i] = sourceSpan[i];
+        }
+    }
+}
+
+void slideBytes(const unsigned char * const restrict source,
+                unsigned char *restrict dest, int numRows, int numSourceCols,
+                int numDestCols, int depth,
+                const int * const restrict rowIndexes,
+                const int * const restrict colIndexes, int numThreads) {
+    /*
+     * Same as slide, but both arrays are bytes.
+     * One-hot sequences stay as bytes all the way into the model, which
+     * casts them to floats itself.
+     */
+    const SIZE_T spanSize = (SIZE_T) numDestCols * depth;
+    #pragma omp parallel for num_threads(numThreads)
+    for (SIZE_T row = 0; row < numRows; row++) {
+        memcpy(dest + rowIndexes[row] * spanSize,
+               source + (row * numSourceCols + colIndexes[row]) * depth,
+               spanSize);
+    }
+}
+
+void slideReference(const FLOAT_T * const restrict source, FLOAT_T *restrict dest,
+                    int numRows, int numSourceCols, int numDestCols, int depth,
+                    const int * const restrict rowIndexes,
+                    const int * const restrict colIndexes, int numThreads) {
+    /*
+     * Same as slide, but copies one element at a time with the full index
+     * arithmetic, the way slide used to. Nothing in BPReveal calls this; it's
+     * kept so that the benchmarkSlide tool can time slide against it.
+     */
+    #pragma omp parallel for num_threads(numThreads)
+    for (SIZE_T row = 0; row < numRows; row++) {
+        for (SIZE_T destCol = 0; destCol < numDestCols; destCol++) {
+            for (SIZE_T z = 0; z < depth; z++) {
+                SIZE_T sr = rowIndexes[row];
+                FLOAT_T srcVal = source[row * numSourceCols * depth
+                                        + (destCol + colIndexes[row]) * depth
+                                        + z];
+                dest[sr * numDestCols * depth
+                    + destCol * depth
+                    + z] = srcVal;
+            }
+        }
     }
 }
 /*Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.*/
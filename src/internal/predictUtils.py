@@ -1,68 +1,63 @@
 #!/usr/bin/env python3
 """Some functions and classes for streaming predictions."""
+from collections import OrderedDict
+import queue
+import threading
 import numpy as np
 import h5py
 import pybedtools
 import pysam
 from bpreveal import logUtils
-from bpreveal.logUtils import wrapTqdm
-from bpreveal.internal.constants import LOGIT_T, LOGCOUNT_T
+from bpreveal import utils
+from bpreveal.internal.constants import LOGIT_T, LOGCOUNT_T, ONEHOT_AR_T, ONEHOT_T, NUM_BASES
+from bpreveal.internal.fastaIndex import FastaIndex, readRecords
 import bpreveal.internal.files
 
+MAX_CACHED_BLOCKS: int = 32
+"""How many chromosomes' worth of genome blocks should a :py:class:`~BedReader` hold?
+
+Each block is ``4 * blockSize`` bytes, so the default holds at most 128 MB.
+"""
+
 
 class FastaReader:
     """Streams a fasta file from disk lazily.
 
     :param fastaFname: The name of the fasta file to load.
+    :param numThreads: How many processes should read and one-hot encode the
+        sequences? With large fasta files, reading can be slower than the model.
+
+    The records are found with a :py:class:`FastaIndex<bpreveal.internal.fastaIndex.FastaIndex>`,
+    which is saved next to the fasta so that it only has to be built once.
     """
 
-    curSequence = ""
-    """The current sequence in this file. Updated by :py:meth:`~pop`."""
+    curOneHot: ONEHOT_AR_T
+    """The current sequence in this file, one-hot encoded. Updated by :py:meth:`~pop`."""
     curLabel = ""
     """The current description line in this file. Updated by :py:meth:`~pop`."""
     numPredictions = 0
-    _nextLabel = ""
-
-    def __init__(self, fastaFname: str):
-        """Scan the file to count the total lines, then load the first sequence."""
-        # First, scan over the file and count how many sequences are in it.
-        logUtils.info("Counting number of samples.")
-        with open(fastaFname, "r") as fp:
-            for inLine in wrapTqdm(fp):
-                line = inLine.strip()  # Get rid of newlines.
-                if len(line) == 0:
-                    continue  # There is a blank line. Ignore it.
-                if line[0] == ">":
-                    self.numPredictions += 1
-            fp.close()
-        self._idx = -1  # We're about to pop to get index zero.
+
+    def __init__(self, fastaFname: str, numThreads: int = 1):
+        """Index the file to count the records, then load the first sequence."""
+        self._index = FastaIndex(fastaFname)
+        self.numPredictions = self._index.numRecords
         logUtils.info(f"Found {self.numPredictions} entries in input fasta")
-        # Note that we close the file after that with block, so this re-opens it
-        # at position zero.
-        self._fp = open(fastaFname, "r")  # pylint: disable=consider-using-with
-        # We know a fasta starts with >, so read in the first label.
-        self._nextLabel = self._fp.readline().strip()[1:]
+        self._records = readRecords(self._index, numThreads)
+        self._idx = -1  # We're about to pop to get index zero.
         self.pop()  # Read in the first sequence.
 
+    @property
+    def curSequence(self) -> str:
+        """The current sequence in this file, as a string. Updated by :py:meth:`~pop`."""
+        return utils.oneHotDecode(self.curOneHot)
+
     def pop(self) -> None:
-        """Pop the current sequence off the queue. Updates curSequence and curLabel."""
-        # We know we're at the start of the sequence section of a fasta.
+        """Pop the current sequence off the queue. Updates curOneHot and curLabel."""
         self._idx += 1
         if self._idx >= self.numPredictions:
             logUtils.debug("Reached end of fasta generator.")
             return
-        self.curLabel = self._nextLabel
-        self.curSequence = ""
-        inSequence = True
-        curLine = self._fp.readline()
-        while inSequence and len(curLine) > 1:
-            if curLine[0] != ">":
-                self.curSequence = self.curSequence + curLine.strip()
-            else:
-                self._nextLabel = curLine[1:].strip()
-                inSequence = False
-                break
-            curLine = self._fp.readline()
+        self.curLabel, self.curOneHot = next(self._records)
 
 
 class BedReader:
@@ -73,14 +68,26 @@ class BedReader:
     :param padding: The amount by which each region should be expanded before
         fetching the sequence. This will be (inputLength - outputLength) // 2
         for most cases.
+    :param blockSize: How many bases of the genome should be fetched at a time?
+
+    Instead of fetching every region from the genome separately, the reader
+    fetches a big block of a chromosome, one-hot encodes it once, and then serves
+    each region as a slice of that block. With a tiled genome, where the regions
+    are sorted and often overlap, this means one call to pysam per ``blockSize``
+    bases instead of one per region. The reader keeps one block for each
+    chromosome (up to :py:data:`~MAX_CACHED_BLOCKS` of them), so a bed file that
+    jumps between chromosomes still benefits. The regions are always returned in
+    the order they appear in the bed file, since that's the order the writer
+    saves their coordinates in.
     """
 
     numPredictions: int = 0
     """The total number of regions in the bed file."""
-    curSequence: str
-    """The genomic sequence under the current region.
+    curOneHot: ONEHOT_AR_T
+    """The genomic sequence under the current region, one-hot encoded.
 
-    This will update when you call pop().
+    This will update when you call pop(). It is a view into the reader's block of the
+    genome, so copy it if you want to modify it.
     """
     curChrom: str
     curStart: int
@@ -89,46 +96,107 @@ class BedReader:
     curLabel = ""
     """Just for compatibility with the FastaReader, this will always be an empty string."""
 
-    def __init__(self, bedFname: str, genomeFname: str, padding: int):
+    numFetches: int = 0
+    """How many times has the reader had to fetch sequence from the genome?"""
+
+    def __init__(self, bedFname: str, genomeFname: str, padding: int,
+                 blockSize: int = 2 ** 20):
         """Scan the bed file to count the total lines."""
         logUtils.debug("Counting number of samples.")
-        self._bt = list(pybedtools.BedTool(bedFname))
-        self.numPredictions = len(self._bt)
+        self.numPredictions = pybedtools.BedTool(bedFname).count()
         logUtils.info(f"Found {self.numPredictions} entries in input bed file")
+        # Only one Interval exists at a time, instead of a list of the whole file.
+        self._regions = iter(pybedtools.BedTool(bedFname))
         self._idx = 0
         self.genome = pysam.FastaFile(genomeFname)
         self.padding = padding
+        self._blockSize = blockSize
+        # Maps chromosome name to (block start, one-hot block), with the most
+        # recently used chromosome at the end.
+        self._blocks: OrderedDict[str, tuple[int, ONEHOT_AR_T]] = OrderedDict()
         self._fetch()
 
+    @property
+    def curSequence(self) -> str:
+        """The genomic sequence under the current region, in upper case."""
+        return utils.oneHotDecode(self.curOneHot)
+
     def _fetch(self) -> None:
-        r = self._bt[self._idx]
-        s = self.genome.fetch(r.chrom, r.start - self.padding, r.end + self.padding)
-        self.curSequence = s.upper()
+        r = next(self._regions)
         self.curChrom = r.chrom
         self.curStart = r.start
         self.curEnd = r.end
+        self.curOneHot = self._getSlice(r.chrom, r.start - self.padding, r.end + self.padding)
+
+    def _getSlice(self, chrom: str, start: int, end: int) -> ONEHOT_AR_T:
+        """Get the one-hot encoded sequence of a region, fetching a new block if needed."""
+        if chrom in self._blocks:
+            self._blocks.move_to_end(chrom)
+            blockStart, block = self._blocks[chrom]
+        else:
+            blockStart, block = 0, np.zeros((0, NUM_BASES), dtype=ONEHOT_T)
+        if start < blockStart or end > blockStart + block.shape[0]:
+            chromLength = self.genome.get_reference_length(chrom)
+            self.numFetches += 1
+            if start < 0 or end > chromLength:
+                # This region runs off the end of the chromosome, so don't put it
+                # in a block; let pysam deal with it as it always has.
+                return utils.oneHotEncode(self.genome.fetch(chrom, start, end).upper())
+            blockStart = start
+            blockEnd = min(max(start + self._blockSize, end), chromLength)
+            block = utils.oneHotEncode(self.genome.fetch(chrom, blockStart, blockEnd),
+                                       allowN=True)
+            self._blocks[chrom] = (blockStart, block)
+            if len(self._blocks) > MAX_CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+        ret = block[start - blockStart:end - blockStart]
+        # The block allows N, but a region with an N in it is still an error.
+        assert np.count_nonzero(ret) == ret.shape[0], \
+            "Sequence contains unrecognized nucleotides. "\
+            "Maybe your sequence contains 'N'?"
+        return ret
 
     def pop(self) -> None:
         """Pop the current sequence off the queue."""
         self._idx += 1
         if self._idx >= self.numPredictions:
-            logUtils.debug("Reached end of bed generator.")
+            logUtils.debug(f"Reached end of bed generator after {self.numFetches} fetches.")
         else:
             self._fetch()
 
 
 class H5Writer:
-    """Batches up predictions and saves them in chunks.
+    """Batches up predictions and saves them in chunks, in a background thread.
 
     :param fname: The name of the hdf5 file to save.
     :param numHeads: The total number of heads for this model.
     :param numPredictions: How many total predictions will be made?
-
+    :param bedFname: (Optional) A bed file to take coordinate information from.
+    :param genomeFname: (Optional) The genome, needed if you give ``bedFname``.
+    :param config: (Optional) The configuration, saved in the file's metadata.
+    :param writeChunkSize: How many predictions should be buffered before they're
+        written? This is also the chunk size of the datasets in the hdf5.
+    :param compression: The compression filter to use for the logits and logcounts,
+        either ``"gzip"``, ``"lzf"``, or ``None`` for no compression.
+    :param streamDescriptions: If True, write the descriptions to the file along
+        with each chunk of predictions. If False (the default), hold them in memory
+        and write them when the writer is closed, which gives a contiguous dataset
+        but uses memory proportional to the number of predictions.
+    :param numBuffers: How many chunks can be waiting to be written before
+        :py:meth:`~addEntry` blocks?
+
+    Predictions are copied into a buffer as they arrive. When a buffer is full, it is
+    handed off to a writer thread, and :py:meth:`~addEntry` carries on filling the
+    next one, so the hdf5 writes (and compression) happen while the model is
+    running. Since there are only ``numBuffers`` buffers, the memory used by the
+    writer is bounded even if the disk can't keep up.
     """
 
     def __init__(self, fname: str, numHeads: int, numPredictions: int,
                  bedFname: str | None = None, genomeFname: str | None = None,
-                 config: str | None = None):
+                 config: str | None = None, writeChunkSize: int = 100,
+                 compression: str | None = None, streamDescriptions: bool = False,
+                 numBuffers: int = 4):
         """Load everything that can be loaded before the subprocess launches."""
         self._fp = h5py.File(fname, "w")
         bpreveal.internal.files.addH5Metadata(self._fp, config=str(config))
@@ -136,7 +204,13 @@ class H5Writer:
         self.numPredictions = numPredictions
         self.writeHead = 0
         self.batchWriteHead = 0
-        self.writeChunkSize = 100
+        self.writeChunkSize = writeChunkSize
+        self._compression = compression
+        self._streamDescriptions = streamDescriptions
+        self._numBuffers = numBuffers
+        self._descriptionList = []
+        self._writerThread = None
+        self._writerError = None
         if bedFname is not None:
             logUtils.info("Adding coordinate information.")
             assert genomeFname is not None, "Must supply a genome to get coordinate information."
@@ -147,7 +221,7 @@ class H5Writer:
         # We'll construct the datasets on the fly once we get our first output.
 
     def buildDatasets(self, sampleOutputs: list) -> None:
-        """Actually construct the output hdf5 file.
+        """Actually construct the output hdf5 file, and start the writer thread.
 
         You must give this function the first prediction from the model so that
         it can size its datasets appropriately.
@@ -155,31 +229,42 @@ class H5Writer:
         :param sampleOutputs: An output from the Batcher. This is not written to the file,
             it's just used to get the right size for the datasets.
         """
-        # Since descriptions will not consume an inordinate amount of memory, and string
-        # handling is messy with h5py, just store all the descriptions in a list and
-        # write them out at the end.
-        self._descriptionList = []
-        self.headBuffers = []
         # h5 files are very slow if you write many times to non-chunked datasets.
         # So I create chunked datasets, and then create internal buffers to store
-        # up to 100 entries before actually committing to the hdf5 file.
+        # up to writeChunkSize entries before actually committing to the hdf5 file.
         # This optimization means that the program is now GPU-limited and not
         # h5py-limited, which is how things should be.
+        chunkSize = min(self.writeChunkSize, self.numPredictions)
         for headID in range(self.numHeads):
             headGroup = self._fp.create_group(f"head_{headID}")
-            # These are the storage buffers for incoming data.
-            headBuffer = [np.empty((self.writeChunkSize, ), dtype=LOGCOUNT_T),  # counts
-                          np.empty((self.writeChunkSize, ) + sampleOutputs[headID].shape,
-                                   dtype=LOGIT_T)]  # profile
-            self.headBuffers.append(headBuffer)
             headGroup.create_dataset("logcounts", (self.numPredictions,),
-                                     dtype=LOGCOUNT_T,
-                                     chunks=(min(self.writeChunkSize, self.numPredictions),))
+                                     dtype=LOGCOUNT_T, chunks=(chunkSize,),
+                                     compression=self._compression)
             headGroup.create_dataset("logits",
                                      ((self.numPredictions,) + sampleOutputs[headID].shape),
                                      dtype=LOGIT_T,
-                                     chunks=(min(self.writeChunkSize, self.numPredictions),)
-                                            + sampleOutputs[headID].shape)  # noqa
+                                     chunks=(chunkSize,) + sampleOutputs[headID].shape,
+                                     compression=self._compression)
+        if self._streamDescriptions:
+            self._fp.create_dataset("descriptions", (self.numPredictions,),
+                                    dtype=h5py.string_dtype(encoding="utf-8"),
+                                    chunks=(chunkSize,))
+        # These are the storage buffers for incoming data. Full buffers go to the
+        # writer thread through fullBuffers, and come back through freeBuffers.
+        self._freeBuffers = queue.Queue()
+        self._fullBuffers = queue.Queue()
+        for _ in range(self._numBuffers):
+            headBuffers = []
+            for headID in range(self.numHeads):
+                headBuffers.append(
+                    [np.empty((self.writeChunkSize, ), dtype=LOGCOUNT_T),  # counts
+                     np.empty((self.writeChunkSize, ) + sampleOutputs[headID].shape,
+                              dtype=LOGIT_T)])  # profile
+            self._freeBuffers.put(headBuffers)
+        self.headBuffers = self._freeBuffers.get()
+        self._bufferDescriptions = []
+        self._writerThread = threading.Thread(target=self._writerLoop, daemon=True)
+        self._writerThread.start()
         logUtils.debug("Initialized datasets.")
 
     def addEntry(self, batcherOut: tuple) -> None:
@@ -188,12 +273,12 @@ class H5Writer:
         # to be written to the hdf5 on the next commit.
 
         logitsLogcounts, label = batcherOut
-        if self.writeHead == 0 and self.batchWriteHead == 0:
+        if self._writerThread is None:
             # We haven't constructed our datasets yet. Do so now, because
             # now we know the output size of the model.
             self.buildDatasets(logitsLogcounts)
 
-        self._descriptionList.append(label)
+        self._bufferDescriptions.append(label)
 
         for headID in range(self.numHeads):
             logits = logitsLogcounts[headID]
@@ -206,16 +291,41 @@ class H5Writer:
             self.commit()
 
     def commit(self) -> None:
-        """Actually write the data out to the backing hdf5 file."""
+        """Send the current buffer off to be written, and start filling a fresh one."""
+        if self._writerError is not None:
+            raise self._writerError
         start = self.writeHead
         stop = start + self.batchWriteHead
-        for headID in range(self.numHeads):
-            headGroup = self._fp[f"head_{headID}"]
-            headBuffer = self.headBuffers[headID]
-            headGroup["logits"][start:stop] = headBuffer[1][:self.batchWriteHead]
-            headGroup["logcounts"][start:stop] = headBuffer[0][:self.batchWriteHead]
+        if not self._streamDescriptions:
+            self._descriptionList.extend(self._bufferDescriptions)
+        self._fullBuffers.put((start, stop, self.headBuffers, self._bufferDescriptions))
         self.writeHead += self.batchWriteHead
         self.batchWriteHead = 0
+        self._bufferDescriptions = []
+        # This blocks if the writer thread has fallen numBuffers chunks behind.
+        self.headBuffers = self._freeBuffers.get()
+
+    def _writerLoop(self) -> None:
+        """Runs in the writer thread, and writes buffers as they fill up."""
+        while True:
+            match self._fullBuffers.get():
+                case None:
+                    return
+                case (start, stop, headBuffers, descriptions):
+                    numEntries = stop - start
+                    try:
+                        for headID in range(self.numHeads):
+                            headGroup = self._fp[f"head_{headID}"]
+                            headBuffer = headBuffers[headID]
+                            headGroup["logits"][start:stop] = headBuffer[1][:numEntries]
+                            headGroup["logcounts"][start:stop] = headBuffer[0][:numEntries]
+                        if self._streamDescriptions:
+                            self._fp["descriptions"][start:stop] = descriptions
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        # Save the error so that it's raised in the main thread.
+                        logUtils.error(f"Failed to write predictions {start} to {stop}.")
+                        self._writerError = e
+                    self._freeBuffers.put(headBuffers)
 
     def close(self) -> None:
         """Close the output hdf5.
@@ -223,10 +333,17 @@ class H5Writer:
         You MUST call close on this object, as otherwise the last bit of data won't
         get written to disk.
         """
-        if self.batchWriteHead != 0:
-            self.commit()
-        stringDType = h5py.string_dtype(encoding="utf-8")
-        self._fp.create_dataset("descriptions", dtype=stringDType, data=self._descriptionList)
+        if self._writerThread is not None:
+            if self.batchWriteHead != 0:
+                self.commit()
+            self._fullBuffers.put(None)
+            self._writerThread.join()
+            if self._writerError is not None:
+                raise self._writerError
+        if not self._streamDescriptions:
+            stringDType = h5py.string_dtype(encoding="utf-8")
+            self._fp.create_dataset("descriptions", dtype=stringDType,
+                                    data=self._descriptionList)
         logUtils.info("Closing h5.")
         self._fp.close()
 
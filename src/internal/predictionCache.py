@@ -0,0 +1,291 @@
+"""A cache of model predictions, keyed by the model and the input sequence.
+
+Lots of workflows predict the same sequences over and over: a genetic algorithm
+keeps re-scoring the survivors from the last generation, notebooks call
+:py:func:`easyPredict<bpreveal.utils.easyPredict>` on the same loci, and
+re-running makePredictions on an overlapping bed file repeats most of the work.
+A :py:class:`~PredictionCache` given to a
+:py:class:`BatchPredictor<bpreveal.utils.BatchPredictor>` or
+:py:class:`ThreadedBatchPredictor<bpreveal.utils.ThreadedBatchPredictor>` means
+a sequence that has been predicted before never goes to the model again.
+
+The cache has two tiers. Recently used predictions live in memory. If you give a
+file name, every prediction is also written to an hdf5 file on disk, so the cache
+survives between runs. Both tiers have a size limit. The memory tier drops the
+least recently used predictions, and the disk tier overwrites its oldest entries.
+
+The key for each prediction is a hash of the model file(s), the kind of output
+(logits or profiles, in float32 or mixed precision), and the bytes of the one-hot
+encoded sequence, so a cache file can't give you predictions from a different
+model or a different precision.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import h5py
+import numpy as np
+from bpreveal import logUtils
+from bpreveal.internal.constants import ONEHOT_T
+
+_HASH_READ_SIZE = 2 ** 20
+
+_DISK_CHUNK_BYTES = 2 ** 18
+"""About how big should each hdf5 chunk of stored predictions be?"""
+
+_DISK_SYNC_INTERVAL = 256
+"""How many predictions are written to the disk tier between saves of the write head?"""
+
+
+def hashModel(modelFname: str) -> bytes:
+    """Get a hash of a model's contents.
+
+    :param modelFname: The model file, or directory for old-style models.
+    :return: A sha256 digest of every file in the model.
+    """
+    h = hashlib.sha256()
+    if os.path.isdir(modelFname):
+        fnames = []
+        for dirPath, _, fileNames in os.walk(modelFname):
+            fnames.extend(os.path.join(dirPath, f) for f in fileNames)
+        fnames.sort()
+    else:
+        fnames = [modelFname]
+    for fname in fnames:
+        h.update(os.path.relpath(fname, modelFname).encode())
+        with open(fname, "rb") as fp:
+            while block := fp.read(_HASH_READ_SIZE):
+                h.update(block)
+    return h.digest()
+
+
+class PredictionCache:
+    """Remembers predictions so that they don't have to be made again.
+
+    :param modelFname: The model that the predictions come from. The model's
+        contents are hashed, so renaming or moving the model doesn't matter.
+    :param maxMemoryBytes: How much memory can the in-memory tier use?
+        Default: 1 GiB.
+    :param diskFname: (Optional) An hdf5 file to store predictions in. If it already
+        exists and was made with the same model, its predictions are re-used.
+    :param maxDiskBytes: How big can the disk tier get? Default: 16 GiB.
+
+    You normally don't call :py:meth:`~get` and :py:meth:`~put` yourself; just
+    pass the cache to a batcher::
+
+        cache = PredictionCache("mnase.keras", diskFname="mnase_cache.h5")
+        batcher = BatchPredictor("mnase.keras", 64, cache=cache)
+        # use the batcher as usual.
+        print(cache.hits, cache.misses)
+        cache.close()
+
+    The same cache can be given to many batchers, one after another, as long as
+    they use the same model.
+    The disk tier can only be used by one process at a time, so with a
+    ``ThreadedBatchPredictor`` the cache lives in the parent process.
+    Only sequences of the same length as the first one stored go to the disk tier,
+    since its datasets have a fixed shape.
+    Call :py:meth:`~close` when you're done: it records where the next entry goes,
+    so that the disk tier keeps overwriting its oldest entries in the next run.
+
+    The disk tier is not crash-safe. Where the next entry goes is saved (and the
+    file flushed) every few hundred writes, and whenever the tier wraps around, so
+    after a crash the next run may overwrite some of the newest entries first. A
+    crash in the middle of a write can also leave the file unreadable; if it can't
+    be opened, it is thrown away and a new, empty one is made.
+    """
+
+    hits: int = 0
+    """How many lookups found a prediction?"""
+    misses: int = 0
+    """How many lookups had to go to the model?"""
+    diskHits: int = 0
+    """How many of the hits came from the disk tier?"""
+
+    def __init__(self, modelFname: str, maxMemoryBytes: int = 2 ** 30,
+                 diskFname: str | None = None, maxDiskBytes: int = 2 ** 34):
+        logUtils.debug(f"Hashing model {modelFname} for the prediction cache.")
+        self.modelHash = hashModel(modelFname)
+        self._maxMemoryBytes = maxMemoryBytes
+        self._memory: OrderedDict[bytes, list] = OrderedDict()
+        self._memoryBytes = 0
+        self._diskFname = diskFname
+        self._maxDiskBytes = maxDiskBytes
+        self._disk = None
+        self._diskIndex: dict[bytes, int] = {}
+        # The shapes of the stored outputs, once the disk tier has datasets.
+        self._diskShapes: list[tuple] | None = None
+        self._writeHead = 0
+        if diskFname is not None:
+            self._openDisk()
+
+    def key(self, sequence: np.ndarray, kind: str) -> bytes:
+        """Get the key for a sequence.
+
+        :param sequence: The one-hot encoded sequence.
+        :param kind: What sort of prediction is stored, like ``"logits"`` or
+            ``"profile"``. Different kinds of predictions of the same sequence
+            get different keys. The batchers add ``"-bf16"`` for mixed-precision
+            predictions.
+        :return: A 16-byte key.
+        """
+        h = hashlib.blake2b(self.modelHash, digest_size=16)
+        h.update(kind.encode())
+        h.update(str(sequence.shape).encode())
+        h.update(np.ascontiguousarray(sequence, dtype=ONEHOT_T).data)
+        return h.digest()
+
+    def get(self, key: bytes) -> list | None:
+        """Look up a prediction.
+
+        :param key: The key, from :py:meth:`~key`.
+        :return: A copy of the stored prediction, or None if it isn't in the cache.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return _copyPreds(self._memory[key])
+        if key in self._diskIndex:
+            preds = self._readDisk(self._diskIndex[key])
+            self._putMemory(key, preds)
+            self.hits += 1
+            self.diskHits += 1
+            return _copyPreds(preds)
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, preds: list) -> None:
+        """Store a prediction.
+
+        :param key: The key, from :py:meth:`~key`.
+        :param preds: The prediction, a list of arrays and floats, like you get from
+            :py:meth:`BatchPredictor.getOutput<bpreveal.utils.BatchPredictor.getOutput>`.
+        """
+        preds = _copyPreds(preds)
+        self._putMemory(key, preds)
+        if self._diskFname is not None and key not in self._diskIndex:
+            self._writeDisk(key, preds)
+
+    def logStats(self) -> None:
+        """Write the hit and miss counts to the log."""
+        total = max(self.hits + self.misses, 1)
+        logUtils.info(f"Prediction cache: {self.hits} hits ({self.diskHits} from disk), "
+                      f"{self.misses} misses, hit rate {100 * self.hits / total:.1f}%.")
+
+    def close(self) -> None:
+        """Close the disk tier, if there is one."""
+        if self._disk is not None:
+            if self._diskShapes is not None:
+                self._disk.attrs["writeHead"] = self._writeHead
+            self._disk.close()
+            self._disk = None
+
+    def _putMemory(self, key: bytes, preds: list) -> None:
+        if key in self._memory:
+            return
+        self._memory[key] = preds
+        self._memoryBytes += _predsBytes(preds)
+        while self._memoryBytes > self._maxMemoryBytes and len(self._memory) > 1:
+            _, oldPreds = self._memory.popitem(last=False)
+            self._memoryBytes -= _predsBytes(oldPreds)
+
+    def _openDisk(self) -> None:
+        """Open the disk tier and load its keys."""
+        assert self._diskFname is not None
+        try:
+            self._disk = h5py.File(self._diskFname, "a")
+        except OSError as e:
+            logUtils.warning(f"Could not open the prediction cache {self._diskFname} ({e}). "
+                             "It may have been left half-written by a crash. Starting over.")
+            self._disk = h5py.File(self._diskFname, "w")
+        if "keys" not in self._disk:
+            return
+        if bytes.fromhex(self._disk.attrs["modelHash"]) != self.modelHash:
+            logUtils.warning(f"The prediction cache {self._diskFname} was made with a "
+                             "different model. Clearing it.")
+            for name in list(self._disk.keys()):
+                del self._disk[name]
+            return
+        self._diskShapes = self._readDiskShapes()
+        self._writeHead = int(self._disk.attrs["writeHead"])
+        keys = self._disk["keys"][:]
+        used = np.any(keys != 0, axis=1)
+        for slot in np.flatnonzero(used):
+            self._diskIndex[keys[slot].tobytes()] = int(slot)
+        logUtils.debug(f"Loaded {len(self._diskIndex)} predictions from {self._diskFname}")
+
+    def _createDisk(self, preds: list) -> None:
+        """Make the datasets for the disk tier, sized to fit the given prediction."""
+        assert self._disk is not None
+        entryBytes = _predsBytes(preds) + 16
+        numSlots = max(self._maxDiskBytes // entryBytes, 1)
+        logUtils.debug(f"Creating prediction cache with room for {numSlots} predictions.")
+        self._disk.attrs["modelHash"] = self.modelHash.hex()
+        self._disk.attrs["writeHead"] = 0
+        self._disk.create_dataset("keys", (numSlots, 16), dtype=np.uint8,
+                                  chunks=(min(numSlots, 1024), 16))
+        for i, p in enumerate(preds):
+            p = np.asarray(p)
+            # Group several predictions into each chunk so that hdf5 isn't
+            # keeping track of one tiny chunk per prediction.
+            chunkRows = int(min(numSlots, max(_DISK_CHUNK_BYTES // max(p.nbytes, 1), 1)))
+            self._disk.create_dataset(f"output_{i}", (numSlots,) + p.shape,
+                                      dtype=p.dtype, chunks=(chunkRows,) + p.shape)
+        self._diskShapes = self._readDiskShapes()
+        self._writeHead = 0
+
+    def _readDiskShapes(self) -> list[tuple]:
+        """Get the shape of one prediction for each output stored on disk."""
+        assert self._disk is not None
+        shapes = []
+        while f"output_{len(shapes)}" in self._disk:
+            shapes.append(self._disk[f"output_{len(shapes)}"].shape[1:])
+        return shapes
+
+    def _fitsDisk(self, preds: list) -> bool:
+        assert self._diskShapes is not None
+        return len(preds) == len(self._diskShapes) and \
+            all(np.shape(p) == shape for p, shape in zip(preds, self._diskShapes))
+
+    def _writeDisk(self, key: bytes, preds: list) -> None:
+        """Write a prediction to the disk tier, overwriting the oldest entry if it's full."""
+        assert self._disk is not None
+        if self._diskShapes is None:
+            self._createDisk(preds)
+        if not self._fitsDisk(preds):
+            return
+        keysDset = self._disk["keys"]
+        numSlots = keysDset.shape[0]
+        slot = self._writeHead % numSlots
+        oldKey = keysDset[slot].tobytes()
+        if oldKey in self._diskIndex:
+            del self._diskIndex[oldKey]
+        for i, p in enumerate(preds):
+            self._disk[f"output_{i}"][slot] = p
+        keysDset[slot] = np.frombuffer(key, dtype=np.uint8)
+        self._writeHead = slot + 1
+        self._diskIndex[key] = slot
+        # Saving the write head is a metadata write, so only do it now and then.
+        # close() saves it too.
+        if self._writeHead % _DISK_SYNC_INTERVAL == 0 or self._writeHead == numSlots:
+            self._disk.attrs["writeHead"] = self._writeHead
+            self._disk.flush()
+
+    def _readDisk(self, slot: int) -> list:
+        assert self._disk is not None
+        ret = []
+        i = 0
+        while f"output_{i}" in self._disk:
+            val = self._disk[f"output_{i}"][slot]
+            # Logcounts are stored as floats, not 0-d arrays.
+            ret.append(float(val) if np.ndim(val) == 0 else val)
+            i += 1
+        return ret
+
+
+def _copyPreds(preds: list) -> list:
+    return [np.array(p) if isinstance(p, np.ndarray) else p for p in preds]
+
+
+def _predsBytes(preds: list) -> int:
+    return sum(np.asarray(p).nbytes for p in preds)
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
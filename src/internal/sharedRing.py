@@ -0,0 +1,111 @@
+"""Arrays in shared memory, used to pass data between processes without pickling."""
+from multiprocessing import shared_memory
+from typing import Any
+import numpy as np
+
+
+class SharedRing:
+    """A set of arrays in shared memory, each divided into numbered slots.
+
+    :param numSlots: How many slots should each array have?
+    :param shapes: The shape of a single slot in each array.
+    :param dtypes: The data type of each array.
+    :param names: If given, attach to the existing shared memory blocks with these
+        names instead of creating new ones. You shouldn't need to pass this yourself,
+        use :py:meth:`~attach` with the :py:attr:`~spec` from the creating process.
+
+    The process that creates a ring owns it, and is responsible for calling
+    :py:meth:`~close` when it's done, since that frees the shared memory.
+    Other processes attach to the ring with::
+
+        ring = SharedRing.attach(spec)
+
+    where ``spec`` is the :py:attr:`~spec` of the original ring, sent over a queue.
+    Each slot holds one entry from every array, so slot ``i`` is
+    ``[ar[i] for ar in ring.arrays]``. The ring doesn't keep track of which slots
+    are in use; that's up to the processes that share it.
+    """
+
+    arrays: list[np.ndarray]
+    """The shared arrays. Each one has shape ``(numSlots,) + shape``."""
+
+    def __init__(self, numSlots: int, shapes: list[tuple[int, ...]],
+                 dtypes: list[Any], names: list[str] | None = None):
+        self.numSlots = numSlots
+        self._shapes = [tuple(s) for s in shapes]
+        self._dtypes = [np.dtype(d) for d in dtypes]
+        self._owner = names is None
+        self._blocks = []
+        self.arrays = []
+        for i, (shape, dtype) in enumerate(zip(self._shapes, self._dtypes)):
+            fullShape = (numSlots,) + shape
+            if names is None:
+                # SharedMemory refuses to make a zero-byte block.
+                size = max(int(np.prod(fullShape)) * dtype.itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[i])
+            self._blocks.append(block)
+            self.arrays.append(np.ndarray(fullShape, dtype=dtype, buffer=block.buf))
+
+    @property
+    def spec(self) -> tuple:
+        """A picklable description of this ring that can be given to :py:meth:`~attach`."""
+        return (self.numSlots, self._shapes, self._dtypes,
+                [block.name for block in self._blocks])
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "SharedRing":
+        """Attach to a ring that was created in another process.
+
+        :param spec: The :py:attr:`~spec` of the ring.
+        :return: A SharedRing that uses the same memory as the original.
+        """
+        numSlots, shapes, dtypes, names = spec
+        return cls(numSlots, shapes, dtypes, names)
+
+    def fits(self, values: list) -> bool:
+        """Could the given values be stored in one slot of this ring?
+
+        :param values: A list with one entry (an array or a scalar) per array in the ring.
+        :return: True if there's one value per array and every shape matches.
+        """
+        if len(values) != len(self._shapes):
+            return False
+        return all(np.shape(v) == s for v, s in zip(values, self._shapes))
+
+    def write(self, slot: int, values: list) -> None:
+        """Store values in a slot.
+
+        :param slot: The slot to write.
+        :param values: A list with one entry per array in the ring.
+        """
+        for ar, v in zip(self.arrays, values):
+            ar[slot] = v
+
+    def read(self, slot: int) -> list:
+        """Copy the values out of a slot.
+
+        :param slot: The slot to read.
+        :return: A list with one entry per array. Scalar entries are returned as
+            Python floats, and array entries are copies, so the slot can be
+            re-used as soon as this returns.
+        """
+        ret = []
+        for ar in self.arrays:
+            if ar.ndim == 1:
+                ret.append(float(ar[slot]))
+            else:
+                ret.append(np.array(ar[slot]))
+        return ret
+
+    def close(self) -> None:
+        """Detach from the shared memory, and free it if this process created it."""
+        # The numpy views have to go before the blocks can be closed.
+        self.arrays = []
+        for block in self._blocks:
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = []
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
@@ -72,7 +72,7 @@ def reweightCountsLosses(history: dict, lossTypes: list[list[str]]) -> list[floa
         weightLossTypes.append("cw_" + countsKey)
         # countsKey will be the head-name, we need to decorate it.
         countsRe = re.compile(f".*logcounts_{countsKey}_reweightable_mse")
-        profileRe = re.compile(f".*profile_{countsKey}_multinomial_nll")
+        profileRe = re.compile(f".*profile_{countsKey}_(fast_)?multinomial_nll")
         for lossPair in lossTypes:
             typesToAdd = []
             for lossType in lossPair:
@@ -3,6 +3,8 @@
 
 This program streams input from disk and writes output as it calculates, so
 it can run with very little memory even for extremely large prediction tasks.
+The output file is written in a background thread, so the model doesn't have
+to wait for the disk.
 
 
 BNF
@@ -28,6 +30,20 @@ output-h5
 batch-size
     How many samples should be run simultaneously? I recommend 64 or so.
 
+write-chunk-size
+    (Optional) How many predictions should be written to the hdf5 at a time? This
+    is also the chunk size of the datasets in the output file. Default: 100.
+
+compression
+    (Optional) Either ``"gzip"`` or ``"lzf"``, to compress the logits and logcounts
+    in the output file. Default: no compression.
+
+stream-descriptions
+    (Optional) If ``true``, the descriptions are written along with the predictions
+    instead of being saved up and written at the end. Use this when predicting from
+    huge fasta files so that the descriptions don't fill up memory.
+    Default: ``false``.
+
 model-file
     The name of the Keras model file on disk.
 
@@ -50,6 +66,23 @@ num-threads
     (Optional) How many parallel predictors should be run? Unless you're really taxed
     for performance, leave this at 1.
 
+reader-threads
+    (Optional, only used with ``fasta-file``.) How many processes should read and
+    one-hot encode sequences from the fasta? With millions of short sequences, the
+    reader can fall behind the model, and a few reader threads will fix that.
+    Default: 1. The first time a fasta is read, an index of its records is saved
+    next to it as ``<fasta-file>.bpidx.npz``, so later runs don't have to scan it.
+
+prediction-cache
+    (Optional) If given, predictions are remembered and sequences that have been seen
+    before are not run through the model again. This helps when the input has lots of
+    repeated sequences, or when you re-run predictions over a bed file that overlaps
+    an old one. The predictions are kept in memory (``memory-mb`` megabytes of them,
+    default 1024), and if you give a ``disk-file``, they are also saved in that hdf5
+    file (up to ``disk-mb`` megabytes, default 16384) so that later runs can use them.
+    The cache file remembers which model made it, so you can't get predictions from
+    the wrong model. The number of hits and misses is logged at the end.
+
 coordinates
     (Optional, only valid with ``fasta-file``.)
     The ``bed-file`` and ``genome`` entries may be specified to add coordinate information
@@ -135,6 +168,7 @@ from bpreveal.logUtils import wrapTqdm
 from bpreveal.internal import predictUtils
 import bpreveal.internal.files
 from bpreveal.internal import interpreter
+from bpreveal.internal.predictionCache import PredictionCache
 
 
 def getReader(config: dict) -> predictUtils.BedReader | predictUtils.FastaReader:
@@ -150,7 +184,7 @@ def getReader(config: dict) -> predictUtils.BedReader | predictUtils.FastaReader
         logUtils.info(f"Initialized reader for bed file {bedFname}")
     elif "fasta-file" in config:
         fastaFname = config["fasta-file"]
-        reader = predictUtils.FastaReader(fastaFname)
+        reader = predictUtils.FastaReader(fastaFname, config.get("reader-threads", 1))
         logUtils.info(f"Initialized reader for fasta file {fastaFname}")
     else:
         raise ValueError("Could not find an input source in your config.")
@@ -161,23 +195,30 @@ def getWriter(config: dict, numPredictions: int) -> predictUtils.H5Writer:
     """Creates a writer appropriate for the configuration."""
     outFname = config["settings"]["output-h5"]
     numHeads = config["settings"]["heads"]
+    writerOptions = {
+        "writeChunkSize": config["settings"].get("write-chunk-size", 100),
+        "compression": config["settings"].get("compression", None),
+        "streamDescriptions": config["settings"].get("stream-descriptions", False)}
     if "bed-file" in config:
         bedFname = config["bed-file"]
         genomeFname = config["genome"]
         writer = predictUtils.H5Writer(fname=outFname, numHeads=numHeads,
                                        numPredictions=numPredictions, bedFname=bedFname,
-                                       genomeFname=genomeFname, config=str(config))
+                                       genomeFname=genomeFname, config=str(config),
+                                       **writerOptions)
         logUtils.debug(f"Initialized writer for {outFname} from a bed reader.")
     elif "fasta-file" in config:
-        bedFname = config["coordinates"]["bed-file"]
-        genomeFname = config["coordinates"]["genome"]
         if "coordinates" in config:
+            bedFname = config["coordinates"]["bed-file"]
+            genomeFname = config["coordinates"]["genome"]
             writer = predictUtils.H5Writer(fname=outFname, numHeads=numHeads,
                                            numPredictions=numPredictions, bedFname=bedFname,
-                                           genomeFname=genomeFname, config=str(config))
+                                           genomeFname=genomeFname, config=str(config),
+                                           **writerOptions)
             logUtils.debug(f"Initialized writer for {outFname} from fasta reader with coordinates.")
         else:
-            writer = predictUtils.H5Writer(outFname, numHeads, numPredictions)
+            writer = predictUtils.H5Writer(outFname, numHeads, numPredictions,
+                                           **writerOptions)
             logUtils.debug(f"Initialized writer for {outFname} from a fasta without coordinates.")
     else:
         raise ValueError("Could not construct a writer.")
@@ -206,17 +247,25 @@ def main(config: dict) -> None:
     # know how many regions we will be asked to predict.
     reader = getReader(config)
     writer = getWriter(config, reader.numPredictions)
+    cache = None
+    if "prediction-cache" in config:
+        cacheConfig = config["prediction-cache"]
+        cache = PredictionCache(modelFname,
+                                maxMemoryBytes=int(cacheConfig.get("memory-mb", 1024) * 2 ** 20),
+                                diskFname=cacheConfig.get("disk-file", None),
+                                maxDiskBytes=int(cacheConfig.get("disk-mb", 16384) * 2 ** 20))
     if "num-threads" in config:
         batcher = utils.ThreadedBatchPredictor(modelFname, batchSize,
-                                               numThreads=config["num-threads"])
+                                               numThreads=config["num-threads"],
+                                               cache=cache)
     else:
-        batcher = utils.BatchPredictor(modelFname, batchSize)
+        batcher = utils.BatchPredictor(modelFname, batchSize, cache=cache)
     logUtils.info("Entering prediction loop.")
     # Now we just iterate over the reader and submit to our batcher.
     with batcher:
         pbar = wrapTqdm(reader.numPredictions, smoothing=0.1)
         for _ in range(reader.numPredictions):
-            batcher.submitString(reader.curSequence, reader.curLabel)
+            batcher.submitOHE(reader.curOneHot, reader.curLabel)
             reader.pop()
             while batcher.outputReady():
                 # We've just run a batch. Write it out.
@@ -231,6 +280,9 @@ def main(config: dict) -> None:
             pbar.update()
             writer.addEntry(ret)
     writer.close()
+    if cache is not None:
+        cache.logStats()
+        cache.close()
     logUtils.info("Done making predictions, exiting.")
 
 
@@ -108,12 +108,12 @@ import typing
 from multiprocessing import Process
 import sys
 from numpy._typing import NDArray
-import pyBigWig
 import numpy as np
 import scipy.stats
 import scipy.spatial.distance
 from bpreveal import logUtils
 from bpreveal.internal.crashQueue import CrashQueue
+from bpreveal.internal.bigwigCache import BigwigCache
 
 
 class Region:
@@ -135,12 +135,17 @@ class MetricsCalculator:
     :param inQueue: The queue that will provide queries.
     :param outQueue: The queue where results will be put.
     :param tid: The thread ID of this process.
+
+    The bigwigs are read through
+    :py:class:`BigwigCache<bpreveal.internal.bigwigCache.BigwigCache>` objects,
+    so if the cache is turned on, all of the calculators share one decoded copy of
+    each chromosome.
     """
 
     def __init__(self, referenceBwFname: str, predictedBwFname: str, applyAbs: bool,
                  inQueue: CrashQueue, outQueue: CrashQueue, tid: int):
-        self.referenceBw = pyBigWig.open(referenceBwFname, "r")
-        self.predictedBw = pyBigWig.open(predictedBwFname, "r")
+        self.referenceBw = BigwigCache(referenceBwFname)
+        self.predictedBw = BigwigCache(predictedBwFname)
         self.applyAbs = applyAbs
         self.inQueue = inQueue
         self.outQueue = outQueue
@@ -157,14 +162,14 @@ class MetricsCalculator:
         Given a region, loads up profiles from the reference and predicted bigwigs
         and calculates the various metrics. Puts its results into the output queue.
         """
-        referenceData = np.nan_to_num(self.referenceBw.values(regionReference.chrom,
-                                                              regionReference.start,
-                                                              regionReference.stop))
+        referenceData = self.referenceBw.values(regionReference.chrom, regionReference.start,
+                                                regionReference.stop)
+        referenceData = np.nan_to_num(referenceData.astype(np.float64))
         if self.applyAbs:
             referenceData = np.abs(referenceData)
-        predictedData = np.nan_to_num(self.predictedBw.values(regionPredicted.chrom,
-                                                              regionPredicted.start,
-                                                              regionPredicted.stop))
+        predictedData = self.predictedBw.values(regionPredicted.chrom, regionPredicted.start,
+                                                regionPredicted.stop)
+        predictedData = np.nan_to_num(predictedData.astype(np.float64))
         if self.applyAbs:
             predictedData = np.abs(predictedData)
         if np.sum(referenceData) > 0 and np.sum(predictedData) > 0:
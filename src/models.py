@@ -36,16 +36,18 @@ def _soloModelHead(dilateOutput: klayers.Layer, individualHead: dict,
     headName = individualHead["head-name"]
     logUtils.debug(f"Initializing head {headName}")
     numOutputs = individualHead["num-tasks"]
+    # The output layers always compute in float32, even when the rest of the model
+    # uses mixed precision, so that the losses are calculated with full precision.
     profile = klayers.Conv1D(
             filters=numOutputs, kernel_size=outputFilterWidth, padding="valid",  # noqa
-            name=f"solo_profile_{headName}")\
+            name=f"solo_profile_{headName}", dtype="float32")\
         (dilateOutput)  # noqa
     countsGap = klayers.GlobalAveragePooling1D(
             name=f"solo_counts_gap_{headName}")\
         (dilateOutput)  # noqa
     counts = klayers.Dense(
             units=1,  # noqa
-            name=f"solo_logcounts_{headName}")\
+            name=f"solo_logcounts_{headName}", dtype="float32")\
         (countsGap)  # noqa
     return (profile, counts)
 
@@ -361,14 +363,15 @@ def combinedModel(inputLength: int, outputLength: int, numFilters: int,
         # Just straight-up add the logit tensors.
         headName = head["head-name"]
         addProfile = klayers.Add(
-                name=f"combined_add_profile_{headName}")\
+                name=f"combined_add_profile_{headName}", dtype="float32")\
             ([readyBiasHeads[i], residualModel.outputs[i]])  # noqa  # type: ignore
         if head["use-bias-counts"]:
             # While we add logits, we have to convert from log space to linear space
             # This is because we want to model
             # counts = biasCounts + residualCounts noqa
             # but the counts in BPNet are log-counts.
-            addCounts = bprlayers.CountsLogSumExp(name=f"combined_logcounts_{headName}")\
+            addCounts = bprlayers.CountsLogSumExp(name=f"combined_logcounts_{headName}",
+                                                  dtype="float32")\
                 (readyBiasHeads[i + numHeads], residualModel.outputs[i + numHeads])  # noqa
         else:
             # The user doesn't want the counts value from the regression used,
@@ -376,7 +379,8 @@ def combinedModel(inputLength: int, outputLength: int, numFilters: int,
             # "negative peak set" is meaningless, like in MNase.
             # I use an identity layer so that I can rename it so there's not a spooky
             # 'solo' loss component in a combined model.
-            addCounts = klayers.Identity(name=f"combined_logcounts_{headName}")\
+            addCounts = klayers.Identity(name=f"combined_logcounts_{headName}",
+                                         dtype="float32")\
                 (residualModel.outputs[i + numHeads])  # type: ignore  # noqa
         combinedProfileHeads.append(addProfile)
         combinedCountsHeads.append(addCounts)
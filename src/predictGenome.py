@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Predict over a whole genome and write the predictions straight to a bigwig.
+
+This does the same thing as running ``tileGenome``, then ``makePredictions``,
+then ``predictToBigwig``, but it never writes the predictions to an hdf5 file.
+The genome is tiled with
+:py:func:`createTilingRegions<bpreveal.bedUtils.createTilingRegions>`, each tile
+is predicted as soon as its sequence is read, and the predictions are written
+to the bigwig as soon as every tile that covers a base has come back.
+Only a few tiles' worth of predictions are ever held in memory.
+
+If you give a negative ``--spacing``, the tiles overlap, and the predictions
+from overlapping tiles are averaged, just like in ``predictToBigwig``.
+The regions near the ends of chromosomes and around runs of ``N`` that the model
+can't see have no data in the output bigwig.
+"""
+import argparse
+import numpy as np
+import pybedtools
+import pyBigWig
+import pysam
+from bpreveal import logUtils
+from bpreveal import bedUtils
+from bpreveal import utils
+from bpreveal.internal import predictUtils
+from bpreveal.internal.constants import PRED_AR_T
+
+FLUSH_SIZE = 2 ** 20
+"""How many finished bases should be saved up before they are written to the bigwig?"""
+
+
+class StreamingTrack:
+    """Averages overlapping predictions and writes them to a bigwig as they finish.
+
+    :param outBw: The (open) bigwig to write. Its header must already be written.
+    :param negate: Should the values be negated before they are written?
+
+    Regions must be added in sorted order, one chromosome at a time, in the same
+    order as the chromosomes in the bigwig header. Once a region starting at
+    position ``p`` has been added, no later region can touch any base before ``p``,
+    so those bases are done and can be written.
+    """
+
+    def __init__(self, outBw: pyBigWig.pyBigWig, negate: bool):
+        self._outBw = outBw
+        self._negate = negate
+        self._chrom = None
+        self._bufStart = 0
+        self._sums = np.zeros((0,), dtype=np.float64)
+        self._counts = np.zeros((0,), dtype=np.uint32)
+
+    def add(self, chrom: str, start: int, values: PRED_AR_T) -> None:
+        """Add the values for one region.
+
+        :param chrom: The chromosome of the region.
+        :param start: The start of the region.
+        :param values: The predicted values at each base of the region.
+        """
+        if chrom != self._chrom:
+            self.finishChrom()
+            self._chrom = chrom
+            self._bufStart = start
+        assert start >= self._bufStart, "Regions must be added in sorted order."
+        if start - self._bufStart >= FLUSH_SIZE:
+            self._flush(start)
+        offset = start - self._bufStart
+        end = offset + values.shape[0]
+        if end > self._sums.shape[0]:
+            growBy = max(end - self._sums.shape[0], self._sums.shape[0])
+            self._sums = np.concatenate([self._sums, np.zeros((growBy,), dtype=np.float64)])
+            self._counts = np.concatenate([self._counts, np.zeros((growBy,), dtype=np.uint32)])
+        self._sums[offset:end] += values
+        self._counts[offset:end] += 1
+
+    def finishChrom(self) -> None:
+        """Write out everything that's left for the current chromosome."""
+        if self._chrom is not None:
+            self._flush(self._bufStart + self._sums.shape[0])
+            logUtils.debug(f"Finished writing {self._chrom}")
+        self._chrom = None
+
+    def _flush(self, upTo: int) -> None:
+        """Write all the bases before upTo and drop them from the buffer."""
+        numDone = upTo - self._bufStart
+        counts = self._counts[:numDone]
+        covered = np.concatenate([[False], counts > 0, [False]])
+        # Each run of covered bases becomes one call to addEntries.
+        edges = np.flatnonzero(covered[1:] != covered[:-1])
+        for runStart, runEnd in zip(edges[::2], edges[1::2]):
+            values = self._sums[runStart:runEnd] / counts[runStart:runEnd]
+            if self._negate:
+                values *= -1
+            self._outBw.addEntries(self._chrom, int(self._bufStart + runStart),
+                                   values=values, span=1, step=1)
+        self._sums = self._sums[numDone:].copy()
+        self._counts = self._counts[numDone:].copy()
+        self._bufStart = upTo
+
+
+def predsToValues(preds: list, mode: str, headID: int, taskID: int) -> PRED_AR_T:
+    """Turn the output of a batcher into the values for one track.
+
+    :param preds: The predictions, as returned by ``getOutput()``.
+    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
+        or ``counts``.
+    :param headID: The head you want predictions from.
+    :param taskID: The task within that head that you want predictions for.
+    :return: A vector with one value for each base in the output window.
+    """
+    numHeads = len(preds) // 2
+    logits = preds[headID]
+    logcounts = preds[headID + numHeads]
+    match mode:
+        case "profile":
+            return utils.logitsToProfile(logits, logcounts)[:, taskID]
+        case "logits":
+            return logits[:, taskID]
+        case "mnlogits":
+            return logits[:, taskID] - np.mean(logits[:, taskID])
+        case "logcounts":
+            return np.full((logits.shape[0],), logcounts)
+        case "counts":
+            return np.full((logits.shape[0],), np.exp(logcounts))
+        case _:
+            raise ValueError(f"{mode} is not a valid mode.")
+
+
+def tileGenome(genomeFname: str, inputLength: int, outputLength: int, spacing: int,
+               allowChroms: list[str] | None) -> pybedtools.BedTool:
+    """Make the (sorted) regions that will be predicted.
+
+    :param genomeFname: The genome fasta.
+    :param inputLength: The input length of the model.
+    :param outputLength: The output length of the model.
+    :param spacing: The space between regions. Negative values mean overlapping regions.
+    :param allowChroms: If given, only tile these chromosomes.
+    :return: A BedTool, saved to a temporary file.
+    """
+    with pysam.FastaFile(genomeFname) as genome:
+        regions = bedUtils.createTilingRegions(inputLength, outputLength, genome, spacing)
+    if allowChroms is not None:
+        regions = pybedtools.BedTool([r for r in regions if r.chrom in allowChroms])
+    return regions.saveas()
+
+
+def predictGenome(modelFname: str, genomeFname: str, outFname: str, inputLength: int,
+                  outputLength: int, headID: int, taskID: int, mode: str,
+                  spacing: int = 0, allowChroms: list[str] | None = None,
+                  batchSize: int = 64, numThreads: int | None = None,
+                  negate: bool = False) -> None:
+    """Tile the genome, make predictions, and write them to a bigwig.
+
+    :param modelFname: The model to predict with.
+    :param genomeFname: The genome fasta.
+    :param outFname: The name of the bigwig file to write.
+    :param inputLength: The input length of the model.
+    :param outputLength: The output length of the model.
+    :param headID: The head you want predictions from.
+    :param taskID: The task within that head that you want predictions for.
+    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
+        or ``counts``.
+    :param spacing: The space between tiles. Use a negative number to have the tiles
+        overlap, in which case overlapping predictions are averaged.
+    :param allowChroms: If given, only predict on these chromosomes.
+    :param batchSize: The batch size to use for predictions.
+    :param numThreads: If given, use a ThreadedBatchPredictor with this many workers.
+    :param negate: Should the predictions be negated in the output bigwig?
+    """
+    regions = tileGenome(genomeFname, inputLength, outputLength, spacing, allowChroms)
+    padding = (inputLength - outputLength) // 2
+    reader = predictUtils.BedReader(regions.fn, genomeFname, padding)
+    # The tiles come out of createTilingRegions in sorted chromosome order,
+    # and bigwig entries have to be added in the same order as the header.
+    chromSizes = utils.loadChromSizes(genomeFname=genomeFname)
+    outBw = pyBigWig.open(outFname, "w")
+    outBw.addHeader([(c, chromSizes[c]) for c in sorted(chromSizes.keys())])
+    track = StreamingTrack(outBw, negate)
+    if numThreads is not None:
+        batcher = utils.ThreadedBatchPredictor(modelFname, batchSize, numThreads=numThreads)
+    else:
+        batcher = utils.BatchPredictor(modelFname, batchSize)
+
+    def addOutput() -> None:
+        preds, (chrom, start) = batcher.getOutput()
+        track.add(chrom, start, predsToValues(preds, mode, headID, taskID))
+        pbar.update()
+
+    logUtils.info(f"Predicting {reader.numPredictions} regions.")
+    with batcher:
+        pbar = logUtils.wrapTqdm(reader.numPredictions, smoothing=0.1)
+        for _ in range(reader.numPredictions):
+            batcher.submitOHE(reader.curOneHot, (reader.curChrom, reader.curStart))
+            reader.pop()
+            while batcher.outputReady():
+                addOutput()
+        while not batcher.empty():
+            addOutput()
+        pbar.close()
+    track.finishChrom()
+    outBw.close()
+    logUtils.info("Done.")
+
+
+def getParser() -> argparse.ArgumentParser:
+    """Generate the argument parser."""
+    parser = argparse.ArgumentParser(
+        description="Predict over a whole genome and write the predictions to a bigwig, "
+                    "without making an hdf5 file in between.")
+    parser.add_argument("--model", help="The model to use.", dest="modelFname")
+    parser.add_argument("--genome", help="The fasta-format genome to predict on.")
+    parser.add_argument("--bw", help="The name of the bigwig file that should be written.")
+    parser.add_argument("--input-length", help="The input length of the model.",
+                        type=int, dest="inputLength")
+    parser.add_argument("--output-length", help="The output length of the model.",
+                        type=int, dest="outputLength")
+    parser.add_argument("--head-id",
+                        help="Which head number do you want data for?",
+                        dest="headID", type=int)
+    parser.add_argument("--task-id",
+                        help="Which task in that head do you want?",
+                        dest="taskID", type=int)
+    parser.add_argument("--mode",
+                        help="What do you want written? The options are the same as "
+                        "for predictToBigwig: 'profile', 'logits', 'mnlogits', "
+                        "'logcounts', or 'counts'.", default="profile")
+    parser.add_argument("--spacing",
+                        help="The space between tiles. A negative number makes the tiles "
+                        "overlap, and overlapping predictions are averaged.",
+                        type=int, default=0)
+    parser.add_argument("--allow-chrom",
+                        help="A chromosome to predict on. May be given multiple times. "
+                        "If not given, all chromosomes are used.",
+                        action="append", dest="allowChrom")
+    parser.add_argument("--batch-size", help="The batch size to use.",
+                        type=int, default=64, dest="batchSize")
+    parser.add_argument("--num-threads",
+                        help="If given, run this many predictors in parallel.",
+                        type=int, dest="numThreads")
+    parser.add_argument("--negate",
+                        help="Negate all of the values written to the bigwig. "
+                        "Used for negative-strand predictions.", action="store_true")
+    parser.add_argument("--verbose",
+                        help="Display progress as the file is being written.",
+                        action="store_true")
+    return parser
+
+
+def main() -> None:
+    """Run the program."""
+    args = getParser().parse_args()
+    logUtils.setBooleanVerbosity(args.verbose)
+    predictGenome(args.modelFname, args.genome, args.bw, args.inputLength,
+                  args.outputLength, args.headID, args.taskID, args.mode,
+                  spacing=args.spacing, allowChroms=args.allowChrom,
+                  batchSize=args.batchSize, numThreads=args.numThreads,
+                  negate=args.negate)
+
+
+if __name__ == "__main__":
+    main()
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
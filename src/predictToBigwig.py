@@ -1,261 +1,387 @@
 #!/usr/bin/env python3
-"""A script to take the predictions hdf5 file and turn it into a bigwig."""
+"""A script to take the predictions hdf5 file and turn it into a bigwig.
+
+You can make several bigwigs in one run. ``--head-id``, ``--task-id``, and ``--mode``
+each take one or more values, and a bigwig is written for every combination. If you
+leave out ``--head-id`` you get every head, and if you leave out ``--task-id`` you
+get every task of each head. When more than one bigwig is being made, ``--bw`` is a
+template, and ``{head}``, ``{task}``, and ``{mode}`` in it are filled in for each
+output. For example::
+
+    predictToBigwig --h5 preds.h5 --bw "preds_{head}_{task}_{mode}.bw" \\
+        --mode profile counts
+
+writes a profile and a counts bigwig for each task of each head. The prediction
+file is only read once, no matter how many bigwigs are made.
+"""
 import argparse
+import itertools
 import multiprocessing
-from bpreveal.internal.constants import PRED_T
+from bpreveal.internal.constants import PRED_T, H5_CHUNK_SIZE
 import tqdm
 import h5py
 import pyBigWig
 import numpy as np
-import numpy.typing as npt
+import scipy.special
 from bpreveal import logUtils
-from bpreveal import utils
 
+MODES = ["profile", "logits", "mnlogits", "logcounts", "counts"]
+"""The kinds of data that can be written to a bigwig."""
 
-class Region:
-    """Represents a single region.
+_LOGIT_MODES = {"profile", "logits", "mnlogits"}
 
-    It knows where it is in the genome and also what index it occupies in the hdf5.
+RUN_LENGTH_MODES = {"logcounts", "counts"}
+"""Modes that have one value per region, so their bigwigs are written as runs."""
 
-    :param chromIdx: The chromosome index, corresponding to ``chrom_names`` in the hdf5.
-    :param start: The genomic start coordinate, inclusive.
-    :param end: The genomic end coordinate, exclusive.
-    :param h5Idx: The index in the hdf5 file where this region is found.
-    """
 
-    def __init__(self, chromIdx: int, start: int, end: int, h5Idx: int):
-        self.chromIdx = chromIdx
-        self.start = start
-        self.end = end
-        self.h5Idx = h5Idx
-
-    def getValues(self, h5fp: h5py.File, mode: str, head: int, taskID: int) -> np.ndarray:
-        """Get the values in the hdf5 at this region.
-
-        :param h5fp: An opened hdf5 file containing predictions.
-        :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
-            or ``counts``.
-        :param head: Which head index do you want the data from?
-        :param taskID: Which task do you want the data for?
-        :return: A vector containing the requested data.
-        """
-        headLogits = h5fp[f"head_{head}"]["logits"]
-        headLogcounts = h5fp[f"head_{head}"]["logcounts"]
-
-        match mode:
-            case "profile":
-                logits = headLogits[self.h5Idx]
-                # Logits will have shape (output-length x numTasks)
-                logCounts = headLogcounts[self.h5Idx]
-                headProfile = utils.logitsToProfile(logits, logCounts)
-                taskProfile = headProfile[:, taskID]
-                profile = taskProfile
-            case "logits":
-                profile = headLogits[self.h5Idx, :, taskID]
-            case "mnlogits":
-                profile = headLogits[self.h5Idx, :, taskID]
-                profile -= np.mean(profile)
-            case "logcounts":
-                profile = np.zeros((self.end - self.start)) + headLogcounts[self.h5Idx]
-            case "counts":
-                profile = np.zeros((self.end - self.start)) \
-                    + np.exp(headLogcounts[self.h5Idx])
-            case _:
-                raise ValueError(f"{mode} is not a valid mode.")
-        return profile
-
-
-def getChromInserts(arg: tuple[list[Region], str, int, int, str]) -> \
-        list[tuple[np.ndarray, int]]:
+def getBlockValues(logits: np.ndarray | None, logcounts: np.ndarray, outputLength: int,
+                   mode: str, taskID: int) -> np.ndarray:
+    """Get the requested data for a block of regions.
+
+    :param logits: The logits for the block, shape ``(numRows x output-length x numTasks)``.
+        May be None if mode is ``logcounts`` or ``counts``.
+    :param logcounts: The logcounts for the block, shape ``(numRows,)``.
+    :param outputLength: The output length of the model.
+    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
+        or ``counts``.
+    :param taskID: Which task do you want the data for?
+    :return: An array of shape ``(numRows x output-length)``.
+    """
+    match mode:
+        case "profile":
+            assert logits is not None
+            # The softmax is taken over all the tasks together.
+            profile = scipy.special.softmax(logits, axis=(1, 2)) \
+                * np.exp(logcounts)[:, np.newaxis, np.newaxis]
+            values = profile[:, :, taskID]
+        case "logits":
+            assert logits is not None
+            values = logits[:, :, taskID]
+        case "mnlogits":
+            assert logits is not None
+            values = logits[:, :, taskID]
+            values = values - np.mean(values, axis=1, keepdims=True)
+        case "logcounts":
+            values = np.repeat(logcounts[:, np.newaxis], outputLength, axis=1)
+        case "counts":
+            values = np.repeat(np.exp(logcounts)[:, np.newaxis], outputLength, axis=1)
+        case _:
+            raise ValueError(f"{mode} is not a valid mode.")
+    return values
+
+
+def getChromInserts(arg: tuple[int, np.ndarray, np.ndarray, str,
+                               list[tuple[int, int, str]]]) -> \
+        list[list[tuple[np.ndarray, int]]]:
     """Packs all the arguments into one so it's easier to use with pool.map().
 
-    :param arg: In order, regionList, h5Fname, headID, taskID, mode.
-    :return: The inserts from vectorToListOfInserts.
+    :param arg: In order, chromIdx, h5Idxs, starts, h5Fname, tracks.
+    :return: For each track, the inserts from getChromInsertLists.
     """
-    regionList, h5Fname, headID, taskID, mode = arg
+    chromIdx, h5Idxs, starts, h5Fname, tracks = arg
     with h5py.File(h5Fname, "r") as h5fp:
-        vec = getChromVector(regionList, h5fp, headID, taskID, mode)
-        inserts = vectorToListOfInserts(vec)
-    logUtils.info(f"Finished region {str(regionList[0].chromIdx)}")
+        inserts = getChromInsertLists(h5Idxs, starts, h5fp, tracks)
+    logUtils.info(f"Finished region {chromIdx}")
     return inserts
 
 
-def getChromVector(regionList: list[Region], h5fp: h5py.File, headID: int,
-                   taskID: int, mode: str) -> npt.NDArray:
-    """Map the values at each Region onto a vector representing the chromosome.
+def mergeRegions(starts: np.ndarray, width: int) -> \
+        tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge overlapping regions into blocks, and pack the blocks end to end.
+
+    :param starts: The start of each region. They all have the same width.
+    :param width: The width of the regions.
+    :return: A tuple of ``(blockStarts, blockLengths, packedStarts)``.
+        ``blockStarts`` and ``blockLengths`` give the genomic position and size of
+        each block of covered bases, in sorted order. ``packedStarts`` gives, for
+        each region (in the same order as ``starts``), where it starts in an
+        array that holds all of the blocks back to back.
 
-    regionList should only contain regions from one chromosome, as regionList[0].chromIdx
-    is used to determine the size of the returned vector.
+    For example, regions of width 3 starting at ``[10, 0, 2, 20]`` cover the blocks
+    ``[0, 5)``, ``[10, 13)``, and ``[20, 23)``, so you'd get::
 
-    :param regionList: The regions you want data for.
+        (array([0, 10, 20]), array([5, 3, 3]), array([5, 0, 2, 8]))
+    """
+    order = np.argsort(starts, kind="stable")
+    sortedStarts = starts[order]
+    # A new block begins wherever a region starts past the end of the one before it.
+    # Since all regions are the same width, the one before it ends furthest right.
+    newBlock = np.concatenate([[True], sortedStarts[1:] > sortedStarts[:-1] + width])
+    blockIds = np.cumsum(newBlock) - 1
+    firstInBlock = np.flatnonzero(newBlock)
+    lastInBlock = np.concatenate([firstInBlock[1:] - 1, [sortedStarts.shape[0] - 1]])
+    blockStarts = sortedStarts[firstInBlock]
+    blockLengths = sortedStarts[lastInBlock] + width - blockStarts
+    blockOffsets = np.concatenate([[0], np.cumsum(blockLengths)[:-1]])
+    packedStarts = np.empty_like(starts)
+    packedStarts[order] = blockOffsets[blockIds] + sortedStarts - blockStarts[blockIds]
+    return blockStarts, blockLengths, packedStarts
+
+
+def getChromInsertLists(h5Idxs: np.ndarray, starts: np.ndarray, h5fp: h5py.File,
+                        tracks: list[tuple[int, int, str]]) -> \
+        list[list[tuple[np.ndarray, int]]]:
+    """Get the data for each track over the regions on one chromosome.
+
+    :param h5Idxs: The rows of the hdf5 that are on this chromosome, in increasing order.
+    :param starts: The start coordinate of each of those rows.
     :param h5fp: The (open) hdf5 file of predictions.
-    :param headID: The head you want data for.
-    :param taskID: The task within that head that you want data for.
-    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
-        or ``counts``.
-    :return: An array as long as the chromosome, with zeros everywhere that
-        regionList did not cover, and the values of the data wherever the regions
-        do exist. For overlapping regions, the predictions are averaged.
+    :param tracks: A list of ``(headID, taskID, mode)`` tuples, one for each track
+        you want.
+    :return: For each track, a list of ``(values, start)`` inserts, one for each
+        block of bases that some region covers. For overlapping regions, the
+        predictions are averaged.
+
+    Only the bases that are covered by a region get any memory, so the memory use
+    depends on how much of the chromosome was predicted, not on how long it is.
+    The hdf5 is read in file order, one chunk at a time, and each chunk's values
+    are added in with a single vectorized call. Each chunk is read once, no matter
+    how many tracks use it.
     """
-    chromSize = h5fp["chrom_sizes"][regionList[0].chromIdx]
-    regionCounts = np.zeros((chromSize,), dtype=np.uint16)
-    regionValues = np.zeros((chromSize,), dtype=PRED_T)
-    for r in regionList:
-        regionCounts[r.start:r.end] += 1
-        regionValues[r.start:r.end] += r.getValues(h5fp, mode, headID, taskID)
-    regionCounts[regionCounts == 0] = 1
-    return regionValues / regionCounts
-
-
-def vectorToListOfInserts(dataVector: npt.NDArray) -> list[tuple[np.ndarray, int]]:
-    """Convert a chromosome vector to a list of regions that actually have data.
-
-    Given a vector of data from getChromVector, remove all the zeros and give you
-    a list of regions with actual data. For example::
-
-        vectorToListOfInserts([0,0,0,1,2,3,0,0,0,5,6,7])
-        [([1, 2, 3], 3), ([5, 6, 7], 9)]
-
-    :param dataVector: An array representing the data along an entire chromosome.
-    :return: A list of tuples. The first element of each tuple is an array of data,
-        and the second is the genomic coordinate where that dataset starts.
+    heads = sorted({headID for headID, _, _ in tracks})
+    needLogits = {headID: any(h == headID and mode in _LOGIT_MODES for h, _, mode in tracks)
+                  for headID in heads}
+    logitsDset = h5fp[f"head_{heads[0]}"]["logits"]
+    outputLength = logitsDset.shape[1]
+    blockStarts, blockLengths, packedStarts = mergeRegions(starts, outputLength)
+    numCovered = int(np.sum(blockLengths))
+    # Every track covers the same regions, so they can share the counts.
+    regionCounts = np.zeros((numCovered,), dtype=np.uint16)
+    regionValues = [np.zeros((numCovered,), dtype=PRED_T) for _ in tracks]
+    chunkRows = logitsDset.chunks[0] if logitsDset.chunks is not None else H5_CHUNK_SIZE
+    # Split the rows at chunk boundaries. Each piece is read with one call.
+    chunkIds = h5Idxs // chunkRows
+    splitPoints = np.flatnonzero(np.diff(chunkIds)) + 1
+    offsets = np.arange(outputLength)
+    for pieceIdxs, pieceStarts in zip(np.split(h5Idxs, splitPoints),
+                                      np.split(packedStarts, splitPoints)):
+        rowStart = pieceIdxs[0]
+        rowEnd = pieceIdxs[-1] + 1
+        rows = pieceIdxs - rowStart
+        headData = {}
+        for headID in heads:
+            headGroup = h5fp[f"head_{headID}"]
+            logits = None
+            if needLogits[headID]:
+                logits = headGroup["logits"][rowStart:rowEnd][rows]
+            headData[headID] = (logits, headGroup["logcounts"][rowStart:rowEnd][rows])
+        # positions[i, j] is where base j of region i goes in the packed blocks.
+        positions = (pieceStarts[:, np.newaxis] + offsets).ravel()
+        np.add.at(regionCounts, positions, 1)
+        for (headID, taskID, mode), trackValues in zip(tracks, regionValues):
+            logits, logcounts = headData[headID]
+            values = getBlockValues(logits, logcounts, outputLength, mode, taskID)
+            np.add.at(trackValues, positions, values.ravel())
+    blockEnds = np.cumsum(blockLengths)
+    ret = []
+    for trackValues in regionValues:
+        trackValues /= regionCounts
+        ret.append([(trackValues[end - length:end], int(start))
+                    for start, length, end in zip(blockStarts, blockLengths, blockEnds)])
+    return ret
+
+
+def writeInserts(outBw: pyBigWig.pyBigWig, chromName: str,
+                 inserts: list[tuple[np.ndarray, int]], runLength: bool) -> None:
+    """Write the inserts for one chromosome to a bigwig.
+
+    :param outBw: The (open) bigwig file, with its header already written.
+    :param chromName: The name of the chromosome.
+    :param inserts: The inserts from getChromInsertLists.
+    :param runLength: If True, runs of identical values are merged into single
+        bedGraph-style entries. Use this when the data are piecewise constant,
+        like in the ``logcounts`` and ``counts`` modes, where each region has a
+        single value. Otherwise, every base gets its own entry.
+
+    The values are handed to pyBigWig as numpy arrays, so no Python lists of
+    floats are ever built.
     """
-    rets = []
-    regionStart = 0
-    poses = np.nonzero(dataVector)[0]
-    lastPoint = -1
-    for pos in poses:
-        if pos == lastPoint + 1:
-            # We're in a block.
-            pass
-        else:
-            # We just ended a block.
-            if lastPoint > 0:
-                rets.append((dataVector[regionStart:lastPoint + 1], regionStart))
-            regionStart = pos
-
-        lastPoint = pos
-    rets.append((dataVector[regionStart:poses[-1] + 1], regionStart))
-    return rets
-
-
-def buildRegionList(inH5: h5py.File) -> dict[int, list[Region]]:
-    """Builds a list of Region objects for each chromosome in the hdf5.
+    if not inserts:
+        return
+    if not runLength:
+        for values, start in inserts:
+            outBw.addEntries(chromName, int(start),
+                             values=values.astype(np.float64), span=1, step=1)
+        return
+    runStarts = []
+    runEnds = []
+    runValues = []
+    for values, start in inserts:
+        # A run starts wherever the value differs from the one before it.
+        changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+        starts = np.concatenate([[0], changes])
+        runStarts.append(starts + start)
+        runEnds.append(np.concatenate([changes, [values.shape[0]]]) + start)
+        runValues.append(values[starts])
+    allStarts = np.concatenate(runStarts).astype(np.int64)
+    outBw.addEntries([chromName] * allStarts.shape[0], allStarts,
+                     ends=np.concatenate(runEnds).astype(np.int64),
+                     values=np.concatenate(runValues).astype(np.float64))
+
+
+def buildRegionList(inH5: h5py.File) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """Find the regions on each chromosome in the hdf5.
 
     :param inH5: The (open) h5py file containing predictions.
-    :return: A dict mapping chromosome ID to a list of Regions on that chromosome.
+    :return: A dict mapping chromosome ID to ``(h5Idxs, starts)``, two arrays giving
+        the rows of the hdf5 that are on that chromosome (in file order) and their
+        start coordinates.
     """
-    numRegions = inH5["coords_chrom"].shape[0]
-
-    # Sort the regions.
     logUtils.debug("Loading coordinate data")
-    coordsChrom = list(inH5["coords_chrom"])
+    coordsChrom = np.array(inH5["coords_chrom"])
     coordsStart = np.array(inH5["coords_start"])
     coordsStop = np.array(inH5["coords_stop"])
-    logUtils.debug("Region data loaded. Sorting.")
-    regionList = []
-    regionRange = range(numRegions)
-    for regionNumber in regionRange:
-        regionList.append(Region(coordsChrom[regionNumber],
-                                 coordsStart[regionNumber],
-                                 coordsStop[regionNumber],
-                                 regionNumber))
-    logUtils.debug("Generated list of regions to sort.")
-    regionOrder = sorted(range(numRegions),
-                         key=lambda x: (regionList[x].chromIdx, regionList[x].start))
-    logUtils.info("Region order calculated.")
-
+    outputLength = inH5["head_0"]["logits"].shape[1]
+    assert np.all(coordsStop - coordsStart == outputLength), \
+        "Every region in the hdf5 must be output-length wide."
+    logUtils.debug("Region data loaded. Grouping by chromosome.")
+    # A stable sort keeps the rows of each chromosome in file order.
+    order = np.argsort(coordsChrom, kind="stable")
+    chromIds, firstRows = np.unique(coordsChrom[order], return_index=True)
     regionsByChrom = {}
-    for idx in regionOrder:
-        r = regionList[idx]
-        if r.chromIdx not in regionsByChrom:
-            regionsByChrom[r.chromIdx] = []
-        regionsByChrom[r.chromIdx].append(r)
+    for chromIdx, chromOrder in zip(chromIds, np.split(order, firstRows[1:])):
+        regionsByChrom[int(chromIdx)] = (chromOrder, coordsStart[chromOrder])
+    logUtils.info("Region lists built.")
     return regionsByChrom
 
 
-def writeBigWig(inH5Fname: str, outFname: str, headID: int, taskID: int, mode: str,
-                verbose: bool, negate: bool, numThreads: int) -> None:
-    """Load in the h5 files and write the predictions to a bigwig file.
+def writeBigWigs(inH5Fname: str, outputs: list[tuple[str, int, int, str]],
+                 verbose: bool, negate: bool, numThreads: int) -> None:
+    """Load in the h5 file and write several bigwig files from it in one pass.
 
     :param inH5Fname: The name of an hdf5 file on disk containing predictions.
-    :param outFname: The name of the bigwig file to write.
-    :param headID: The head you want predictions from.
-    :param taskID: The task within that head that you want predictions for.
-    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
-        or ``counts``.
+    :param outputs: A list of ``(outFname, headID, taskID, mode)`` tuples, one for
+        each bigwig to write. ``mode`` is one of ``profile``, ``logits``,
+        ``mnlogits``, ``logcounts``, or ``counts``.
     :param verbose: Should the program emit logging information?
-    :param negate: Should the predictions be negated in the output bigwig?
+    :param negate: Should the predictions be negated in the output bigwigs?
         Useful for chip-nexus.
     :param numThreads: How many threads should be used?
     """
     inH5 = h5py.File(inH5Fname, "r")
-    logUtils.info(f"Starting to write {outFname}, head {headID} task {taskID}")
+    for outFname, headID, taskID, mode in outputs:
+        logUtils.info(f"Will write {outFname}, head {headID} task {taskID} mode {mode}")
     bwHeader = []
     for i, name in enumerate(inH5["chrom_names"].asstr()):
         bwHeader.append((str(name), int(inH5["chrom_sizes"][i])))
-    outBw = pyBigWig.open(outFname, "w")
-
-    outBw.addHeader(bwHeader)
+    outBws = []
+    for outFname, _, _, _ in outputs:
+        outBw = pyBigWig.open(outFname, "w")
+        outBw.addHeader(bwHeader)
+        outBws.append(outBw)
     logUtils.debug(str(bwHeader))
-    logUtils.info("Added header.")
+    logUtils.info("Added headers.")
     regionsByChrom = buildRegionList(inH5)
     chromList = sorted(regionsByChrom.keys())
+    tracks = [(headID, taskID, mode) for _, headID, taskID, mode in outputs]
     # In order to use multiprocessing, I need to unstaple the dict into a list.
     # The order of the list is sorted(regionsByChrom.keys())
     chromRegionLists = []
     for chromIdx in chromList:
-        chromRegionLists.append(
-            (regionsByChrom[chromIdx], inH5Fname, headID, taskID, mode))
+        h5Idxs, starts = regionsByChrom[chromIdx]
+        chromRegionLists.append((chromIdx, h5Idxs, starts, inH5Fname, tracks))
     logUtils.info("Extracted list of regions to process.")
     logUtils.info("Beginning to extract profile data.")
 
-    with multiprocessing.Pool(numThreads) as p:
-        # Get the insert list for each chromosome in a subprocess.
-        chromInsertLists = p.map(getChromInserts, chromRegionLists)
-    logUtils.info("Insert lists calculated. Writing bigwig.")
     pbar = None
     if verbose:
-        totalInserts = 0
-        for il in chromInsertLists:
-            totalInserts += len(il)
-        pbar = tqdm.tqdm(total=totalInserts)
-    for i, chromIdx in enumerate(chromList):
-        inserts = chromInsertLists[i]
-        chromName = inH5["chrom_names"][chromIdx].decode("utf-8")
-        for ins in inserts:
+        pbar = tqdm.tqdm(total=sum(len(regionsByChrom[c][0]) for c in chromList))
+    with multiprocessing.Pool(numThreads) as p:
+        # Get the insert lists for each chromosome in a subprocess. imap hands them
+        # back in chromosome order, so each chromosome is written (and its inserts
+        # dropped) as soon as it arrives, instead of holding every track of every
+        # chromosome at once.
+        for chromIdx, chromInserts in zip(chromList,
+                                          p.imap(getChromInserts, chromRegionLists)):
+            chromName = inH5["chrom_names"][chromIdx].decode("utf-8")
+            for outBw, (_, _, _, mode), inserts in zip(outBws, outputs, chromInserts):
+                if negate:
+                    for values, _ in inserts:
+                        values *= -1
+                writeInserts(outBw, chromName, inserts, mode in RUN_LENGTH_MODES)
+            del chromInserts
             if pbar is not None:
-                pbar.update()
-            values, start = ins
-            if negate:
-                values *= -1
-            insertValues = [float(x) for x in values]
-            outBw.addEntries(chromName,
-                             start,
-                             values=insertValues,
-                             span=1, step=1)
+                pbar.update(len(regionsByChrom[chromIdx][0]))
     if pbar is not None:
         pbar.close()
-    logUtils.info("Bigwig written. Closing.")
-    outBw.close()
+    logUtils.info("Bigwigs written. Closing.")
+    for outBw in outBws:
+        outBw.close()
     logUtils.info("Done.")
 
 
+def writeBigWig(inH5Fname: str, outFname: str, headID: int, taskID: int, mode: str,
+                verbose: bool, negate: bool, numThreads: int) -> None:
+    """Load in the h5 files and write the predictions to a bigwig file.
+
+    :param inH5Fname: The name of an hdf5 file on disk containing predictions.
+    :param outFname: The name of the bigwig file to write.
+    :param headID: The head you want predictions from.
+    :param taskID: The task within that head that you want predictions for.
+    :param mode: One of ``profile``, ``logits``, ``mnlogits``, ``logcounts``,
+        or ``counts``.
+    :param verbose: Should the program emit logging information?
+    :param negate: Should the predictions be negated in the output bigwig?
+        Useful for chip-nexus.
+    :param numThreads: How many threads should be used?
+
+    To write more than one bigwig, use :py:func:`~writeBigWigs`, which reads the
+    prediction file only once.
+    """
+    writeBigWigs(inH5Fname, [(outFname, headID, taskID, mode)], verbose, negate, numThreads)
+
+
+def buildOutputList(inH5Fname: str, bwTemplate: str, headIDs: list[int] | None,
+                    taskIDs: list[int] | None, modes: list[str]) -> \
+        list[tuple[str, int, int, str]]:
+    """Work out every bigwig that should be written.
+
+    :param inH5Fname: The hdf5 file of predictions, used to find the heads and tasks.
+    :param bwTemplate: The bigwig file name. If there is more than one output, it
+        must contain ``{head}``, ``{task}``, and ``{mode}`` as needed to make the
+        names unique.
+    :param headIDs: The heads to write, or None for all of them.
+    :param taskIDs: The tasks to write, or None for all tasks of each head.
+    :param modes: The modes to write.
+    :return: A list of ``(outFname, headID, taskID, mode)`` tuples for
+        :py:func:`~writeBigWigs`.
+    """
+    with h5py.File(inH5Fname, "r") as inH5:
+        numHeads = len([k for k in inH5.keys() if k.startswith("head_")])
+        if headIDs is None:
+            headIDs = list(range(numHeads))
+        tasksPerHead = {h: inH5[f"head_{h}"]["logits"].shape[2] for h in headIDs}
+    outputs = []
+    for headID, mode in itertools.product(headIDs, modes):
+        headTasks = range(tasksPerHead[headID]) if taskIDs is None else taskIDs
+        for taskID in headTasks:
+            outFname = bwTemplate.format(head=headID, task=taskID, mode=mode)
+            outputs.append((outFname, headID, taskID, mode))
+    assert len({o[0] for o in outputs}) == len(outputs), \
+        f"The bigwig name {bwTemplate} would give several outputs the same file name. " \
+        "Use {head}, {task}, and {mode} in it."
+    return outputs
+
+
 def getParser() -> argparse.ArgumentParser:
     """Generate the argument parser."""
     parser = argparse.ArgumentParser(
         description="Take an hdf5-format file generated by "
-                    "the predict script and render it to a bigwig.")
+                    "the predict script and render it to one or more bigwigs.")
     parser.add_argument("--h5",
                         help="The name of the hdf5-format file to be read in.")
     parser.add_argument("--bw",
-                        help="The name of the bigwig file that should be written.")
+                        help="The name of the bigwig file that should be written. "
+                        "If more than one bigwig is made, {head}, {task}, and {mode} "
+                        "in the name are replaced for each one.")
     parser.add_argument("--head-id",
-                        help="Which head number do you want data for?",
-                        dest="headID", type=int)
+                        help="Which head number(s) do you want data for? "
+                        "If not given, all heads are used.",
+                        dest="headID", type=int, nargs="+")
     parser.add_argument("--task-id",
-                        help="Which task in that head do you want?",
-                        dest="taskID", type=int)
+                        help="Which task(s) in that head do you want? "
+                        "If not given, all tasks are used.",
+                        dest="taskID", type=int, nargs="+")
     parser.add_argument("--mode",
                         help="What do you want written? Options are 'profile', meaning "
                         "you want (softmax(logits) * exp(logcounts)), or 'logits', "
@@ -263,7 +389,8 @@ def getParser() -> argparse.ArgumentParser:
                         "the logits, but mean-normalized (for easier display), or "
                         "'logcounts', meaning you want the log counts for every region, "
                         "or 'counts', meaning you want exp(logcounts). "
-                        "You will usually want 'profile'")
+                        "You will usually want 'profile'. You can give more than one.",
+                        nargs="+", choices=MODES, required=True)
     parser.add_argument("--verbose",
                         help="Display progress as the file is being written.",
                         action="store_true")
@@ -281,8 +408,8 @@ def main() -> None:
     """Run the program."""
     args = getParser().parse_args()
     logUtils.setBooleanVerbosity(args.verbose)
-    writeBigWig(args.h5, args.bw, args.headID, args.taskID, args.mode, args.verbose,
-                args.negate, args.numThreads)
+    outputs = buildOutputList(args.h5, args.bw, args.headID, args.taskID, args.mode)
+    writeBigWigs(args.h5, outputs, args.verbose, args.negate, args.numThreads)
 
 
 if __name__ == "__main__":
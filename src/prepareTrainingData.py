@@ -35,6 +35,10 @@ revcomp-task-order
     Alternatively, this may be the string ``"auto"``.
     If ``reverse-complement`` is false, it is an error to specify
     ``revcomp-task-order``.
+num-threads
+    (Optional) How many chromosomes should be read at the same time?
+    Each worker reads all of the regions on one chromosome of one bigwig (or of
+    the genome) at once. Default: 1.
 
 Output specification
 --------------------
@@ -90,10 +94,13 @@ History
 API
 ---
 """
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, nullcontext
 from typing import Literal
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import h5py
-import pyBigWig
 import pysam
 import pybedtools
 from bpreveal import logUtils
@@ -102,6 +109,7 @@ from bpreveal.internal.constants import ONEHOT_T, ONEHOT_AR_T, PRED_AR_T, \
     H5_CHUNK_SIZE, PRED_T, NUM_BASES
 import bpreveal.internal.files
 from bpreveal.internal import interpreter
+from bpreveal.internal.bigwigCache import BigwigCache
 
 
 def revcompSeq(oneHotSeq: ONEHOT_AR_T) -> ONEHOT_AR_T:
@@ -112,8 +120,139 @@ def revcompSeq(oneHotSeq: ONEHOT_AR_T) -> ONEHOT_AR_T:
     return np.flip(oneHotSeq)
 
 
+STREAM_BLOCK_SIZE: int = 64 * H5_CHUNK_SIZE
+"""How many rows of the output are read into memory before they are written out?
+
+:py:func:`~writeH5` fills the output file one block of this many rows (a whole
+number of hdf5 chunks) at a time, so it never holds more than one block of
+sequences or of one head's data in memory.
+"""
+
+
+def getRegionCoords(bed: pybedtools.BedTool) -> tuple[np.ndarray, np.ndarray]:
+    """Get the chromosome and start of every region in a bed file.
+
+    :param bed: The regions.
+    :return: An array of chromosome names and an array of start coordinates.
+    """
+    chroms = np.array([region.chrom for region in bed])
+    starts = np.array([region.start for region in bed], dtype=np.int64)
+    return chroms, starts
+
+
+def getChromGroups(chroms: np.ndarray, starts: np.ndarray) -> \
+        list[tuple[str, np.ndarray, np.ndarray]]:
+    """Split a list of regions up by chromosome.
+
+    :param chroms: The chromosome of each region.
+    :param starts: The start of each region.
+    :return: A list of ``(chrom, rowIdxs, starts)`` tuples, one for each chromosome,
+        where ``rowIdxs`` gives the position of each region in the input arrays and
+        ``starts`` gives their start coordinates.
+    """
+    order = np.argsort(chroms, kind="stable")
+    chromNames, firstRows = np.unique(chroms[order], return_index=True)
+    return [(str(chrom), rowIdxs, starts[rowIdxs])
+            for chrom, rowIdxs in zip(chromNames, np.split(order, firstRows[1:]))]
+
+
+def _checkWidths(bed: pybedtools.BedTool, outputLength: int) -> None:
+    for region in bed:
+        assert region.stop - region.start == outputLength, \
+            f"Region {region.chrom}:{region.start}-{region.stop} is not {outputLength} long."
+
+
+def _getSeqChrom(arg: tuple[str, str, np.ndarray, np.ndarray, int]) -> \
+        tuple[np.ndarray, ONEHOT_AR_T]:
+    """Read the sequences for all of the regions on one chromosome.
+
+    :param arg: In order, genomeFname, chrom, rowIdxs, starts, width.
+    :return: The rowIdxs, and the one-hot encoded sequences, shape
+        ``(len(starts), width, NUM_BASES)``.
+
+    Regions that are close together are fetched from the genome as one piece,
+    and then cut out of it.
+    """
+    genomeFname, chrom, rowIdxs, starts, width = arg
+    seqs = np.zeros((starts.shape[0], width, NUM_BASES), dtype=ONEHOT_T)
+    order = np.argsort(starts)
+    # Start a new piece wherever there's a gap of more than one region.
+    breaks = np.flatnonzero(np.diff(starts[order]) > 2 * width) + 1
+    with pysam.FastaFile(genomeFname) as genome:
+        for piece in np.split(order, breaks):
+            pieceStart = int(starts[piece[0]])
+            pieceSeq = genome.fetch(chrom, pieceStart, int(starts[piece[-1]]) + width)
+            for i in piece:
+                offset = starts[i] - pieceStart
+                seqs[i] = utils.oneHotEncode(pieceSeq[offset:offset + width])
+    return rowIdxs, seqs
+
+
+def _getHeadChrom(arg: tuple[str, int, str, np.ndarray, np.ndarray, int]) -> \
+        tuple[np.ndarray, int, PRED_AR_T]:
+    """Read the data for all of the regions on one chromosome from one bigwig.
+
+    :param arg: In order, bwFname, taskIdx, chrom, rowIdxs, starts, width.
+    :return: The rowIdxs, the taskIdx, and the data, shape ``(len(starts), width)``.
+    """
+    bwFname, taskIdx, chrom, rowIdxs, starts, width = arg
+    bwCache = BigwigCache(bwFname)
+    vals = np.nan_to_num(bwCache.regions(chrom, starts, width))
+    bwCache.close()
+    return rowIdxs, taskIdx, vals
+
+
+def _mapChroms(func: Callable, args: list, pool: multiprocessing.pool.Pool | None) -> Iterator:
+    """Run func on each of args, in the pool if there is one. Results come back in any order."""
+    if pool is None:
+        yield from map(func, args)
+    else:
+        yield from pool.imap_unordered(func, args)
+
+
+def _makePool(numThreads: int) -> AbstractContextManager:
+    """Make a pool to use in a with block, or (with one thread) a context that gives None."""
+    return multiprocessing.Pool(numThreads) if numThreads > 1 else nullcontext()
+
+
+def _readSequences(genomeFname: str, chroms: np.ndarray, starts: np.ndarray, width: int,
+                   revcomp: bool, pool: multiprocessing.pool.Pool | None) -> ONEHOT_AR_T:
+    """Read the sequences for the regions starting at starts, for getSequences and writeH5."""
+    numRows = starts.shape[0] * (2 if revcomp else 1)
+    seqs = np.zeros((numRows, width, NUM_BASES), dtype=ONEHOT_T)
+    args = [(genomeFname, chrom, rowIdxs, chromStarts, width)
+            for chrom, rowIdxs, chromStarts in getChromGroups(chroms, starts)]
+    for rowIdxs, chromSeqs in _mapChroms(_getSeqChrom, args, pool):
+        if not revcomp:
+            seqs[rowIdxs] = chromSeqs
+        else:
+            seqs[rowIdxs * 2] = chromSeqs
+            seqs[rowIdxs * 2 + 1] = np.flip(chromSeqs, axis=(1, 2))
+    return seqs
+
+
+def _readHead(bigwigFnames: list[str], chroms: np.ndarray, starts: np.ndarray, width: int,
+              revcomp: Literal[False] | list[int],
+              pool: multiprocessing.pool.Pool | None) -> PRED_AR_T:
+    """Read one head's data for the regions starting at starts, for getHead and writeH5."""
+    numRows = starts.shape[0] * (2 if revcomp else 1)
+    headVals = np.zeros((numRows, width, len(bigwigFnames)), dtype=PRED_T)
+    chromGroups = getChromGroups(chroms, starts)
+    args = [(bwFname, i, chrom, rowIdxs, chromStarts, width)
+            for i, bwFname in enumerate(bigwigFnames)
+            for chrom, rowIdxs, chromStarts in chromGroups]
+    for rowIdxs, i, bwVals in _mapChroms(_getHeadChrom, args, pool):
+        if not revcomp:
+            headVals[rowIdxs        , :, i         ] = bwVals  # noqa
+        else:
+            headVals[rowIdxs * 2    , :, i         ] = bwVals  # noqa
+            headVals[rowIdxs * 2 + 1, :, revcomp[i]] = np.flip(bwVals, axis=1)
+    return headVals
+
+
 def getSequences(bed: pybedtools.BedTool, genome: pysam.FastaFile, outputLength: int,
-                 inputLength: int, jitter: int, revcomp: bool) -> ONEHOT_AR_T:
+                 inputLength: int, jitter: int, revcomp: bool,
+                 numThreads: int = 1) -> ONEHOT_AR_T:
     """Extract sequences from the fasta.
 
     :param bed: A BedTool containing the regions to get sequence data for.
@@ -125,31 +264,22 @@ def getSequences(bed: pybedtools.BedTool, genome: pysam.FastaFile, outputLength:
     :param revcomp: Should the returned sequence include reverse-complement data?
         If so, then each region will produce two sequences: one forward and
         one reverse-complemented.
+    :param numThreads: How many chromosomes should be read at once?
     :return: An array of one-hot-encoded sequences of shape
         ```(numSequences x inputLength + 2*jitter, NUM_BASES)```.
     """
-    numSequences = bed.count()
-    if not revcomp:
-        seqs = np.zeros((numSequences, inputLength + 2 * jitter, NUM_BASES), dtype=ONEHOT_T)
-    else:
-        seqs = np.zeros((numSequences * 2, inputLength + 2 * jitter, NUM_BASES), dtype=ONEHOT_T)
-    padding = ((inputLength + 2 * jitter) - outputLength) // 2
-    for i, region in enumerate(bed):
-        chrom = region.chrom
-        start = region.start - padding
-        stop = region.stop + padding
-        seq = genome.fetch(chrom, start, stop)
-        if not revcomp:
-            seqs[i] = utils.oneHotEncode(seq)
-        else:
-            sret = utils.oneHotEncode(seq)
-            seqs[i * 2] = sret
-            seqs[i * 2 + 1] = revcompSeq(sret)
-    return seqs
+    _checkWidths(bed, outputLength)
+    width = inputLength + 2 * jitter
+    padding = (width - outputLength) // 2
+    chroms, starts = getRegionCoords(bed)
+    with _makePool(numThreads) as pool:
+        return _readSequences(genome.filename.decode(), chroms, starts - padding, width,
+                              revcomp, pool)
 
 
 def getHead(bed: pybedtools.BedTool, bigwigFnames: list[str], outputLength: int,
-            jitter: int, revcomp: Literal[False] | list[int]) -> PRED_AR_T:
+            jitter: int, revcomp: Literal[False] | list[int],
+            numThreads: int = 1) -> PRED_AR_T:
     """Get all the data for a particular head.
 
     :param bed: A BedTool containing the regions that will be used to train.
@@ -159,76 +289,99 @@ def getHead(bed: pybedtools.BedTool, bigwigFnames: list[str], outputLength: int,
     :param jitter: The jitter that will be applied during training.
     :param revcomp: If no reverse-complement is desired, this is just ``False``.
         Otherwise, see the section on ``revcomp-task-order`` for what this list means.
+    :param numThreads: How many chromosomes (of any of the bigwigs) should be
+        read at once?
     :return: An array of data that can be put in the training hdf5. It has shape
         (numSequences * outputLength + 2 * jitter, numTasks). numSequences will be
         the length of your bed file if ``revcomp == False``, or twice the length of your
         bed file if you include revcomp augmentation.
     :rtype: PRED_AR_T
+
+    The bigwigs are read through a
+    :py:class:`BigwigCache<bpreveal.internal.bigwigCache.BigwigCache>`. If the
+    cache is turned on, a bigwig that prepareBed already read doesn't need to be
+    decoded again, and all of the regions on a chromosome are sliced out at once.
     """
     # Note that revcomp should be either False or the task-order array (which is truthy).
-    numSequences = bed.count()
-    if not revcomp:
-        headVals = np.zeros((numSequences, outputLength + 2 * jitter, len(bigwigFnames)),
-                            dtype=PRED_T)
-    else:
-        headVals = np.zeros((numSequences * 2, outputLength + 2 * jitter, len(bigwigFnames)),
-                            dtype=PRED_T)
-
-    for i, bwFname in enumerate(bigwigFnames):
-        with pyBigWig.open(bwFname, "r") as fp:
-            for j, region in enumerate(bed):
-                chrom = region.chrom
-                start = region.start - jitter
-                stop = region.stop + jitter
-                bwVals = np.nan_to_num(fp.values(chrom, start, stop))
-                if not revcomp:
-                    headVals[j        , :, i         ] = bwVals  # noqa
-                else:
-                    headVals[j * 2    , :, i         ] = bwVals  # noqa
-                    headVals[j * 2 + 1, :, revcomp[i]] = np.flip(bwVals)
-    return headVals
+    _checkWidths(bed, outputLength)
+    chroms, starts = getRegionCoords(bed)
+    with _makePool(numThreads) as pool:
+        return _readHead(bigwigFnames, chroms, starts - jitter, outputLength + 2 * jitter,
+                         revcomp, pool)
+
+
+def _getRevcompOrder(head: dict, reverseComplement: bool) -> Literal[False] | list[int]:
+    """Figure out the revcomp-task-order for a head in the configuration."""
+    if not reverseComplement:
+        return False
+    revcomp = head["revcomp-task-order"]
+    if revcomp == "auto":
+        # The user has left reverse-complementing up to us.
+        match len(head["bigwig-files"]):
+            case 1:
+                revcomp = [0]
+            case 2:
+                revcomp = [1, 0]
+            case _:
+                raise ValueError("Cannot automatically determine revcomp "
+                                 "order with more than two tasks.")
+    return revcomp
 
 
 def writeH5(config: dict) -> None:
     """Main method, load the config and then generate training data hdf5 files.
 
     :param config: The configuration json.
+
+    The datasets are created up front and filled in blocks of
+    :py:data:`~STREAM_BLOCK_SIZE` rows, so the memory needed doesn't depend on
+    how many regions there are.
     """
     regions = pybedtools.BedTool(config["regions"])
     outputLength = config["output-length"]
     inputLength = config["input-length"]
     jitter = config["max-jitter"]
-    genome = pysam.FastaFile(config["genome"])
+    reverseComplement = config["reverse-complement"]
+    numThreads = config.get("num-threads", 1)
+    _checkWidths(regions, outputLength)
+    chroms, starts = getRegionCoords(regions)
+    revcomps = [_getRevcompOrder(head, reverseComplement) for head in config["heads"]]
     logUtils.debug("Opening output file.")
     outFile = h5py.File(config["output-h5"], "w")
     bpreveal.internal.files.addH5Metadata(outFile, config=str(config))
-    logUtils.debug("Loading sequence information.")
-    seqs = getSequences(regions, genome, outputLength,
-                        inputLength, jitter, config["reverse-complement"])
-
-    outFile.create_dataset("sequence", data=seqs, dtype=ONEHOT_T,
-                           chunks=(H5_CHUNK_SIZE, seqs.shape[1], NUM_BASES), compression="gzip")
-    logUtils.debug("Sequence dataset created.")
+    rowsPerRegion = 2 if reverseComplement else 1
+    numRows = starts.shape[0] * rowsPerRegion
+    chunkRows = min(H5_CHUNK_SIZE, numRows)
+    seqWidth = inputLength + 2 * jitter
+    seqPadding = (seqWidth - outputLength) // 2
+    headWidth = outputLength + 2 * jitter
+    seqDset = outFile.create_dataset("sequence", (numRows, seqWidth, NUM_BASES),
+                                     dtype=ONEHOT_T, chunks=(chunkRows, seqWidth, NUM_BASES),
+                                     compression="gzip")
+    headDsets = []
     for i, head in enumerate(config["heads"]):
-        if config["reverse-complement"]:
-            revcomp = head["revcomp-task-order"]
-            if revcomp == "auto":
-                # The user has left reverse-complementing up to us.
-                match len(head["bigwig-files"]):
-                    case 1:
-                        revcomp = [0]
-                    case 2:
-                        revcomp = [1, 0]
-                    case _:
-                        raise ValueError("Cannot automatically determine revcomp "
-                                         "order with more than two tasks.")
-        else:
-            revcomp = False  # pylint: disable=redefined-variable-type
-        headVals = getHead(regions, head["bigwig-files"], outputLength, jitter, revcomp)
-        outFile.create_dataset(f"head_{i}", data=headVals, dtype=PRED_T,
-                               chunks=(H5_CHUNK_SIZE, headVals.shape[1], headVals.shape[2]),
-                               compression="gzip")
-        logUtils.debug(f"Added data for head {i}")
+        numTasks = len(head["bigwig-files"])
+        headDsets.append(outFile.create_dataset(
+            f"head_{i}", (numRows, headWidth, numTasks), dtype=PRED_T,
+            chunks=(chunkRows, headWidth, numTasks), compression="gzip"))
+    logUtils.debug("Datasets created.")
+    # Each block is a whole number of chunks, even with revcomp rows.
+    regionsPerBlock = STREAM_BLOCK_SIZE // rowsPerRegion
+    genomeFname = config["genome"]
+    with _makePool(numThreads) as pool:
+        for blockStart in logUtils.wrapTqdm(range(0, starts.shape[0], regionsPerBlock)):
+            blockEnd = min(blockStart + regionsPerBlock, starts.shape[0])
+            blockChroms = chroms[blockStart:blockEnd]
+            blockStarts = starts[blockStart:blockEnd]
+            rowStart = blockStart * rowsPerRegion
+            rowEnd = blockEnd * rowsPerRegion
+            seqDset[rowStart:rowEnd] = _readSequences(
+                genomeFname, blockChroms, blockStarts - seqPadding, seqWidth,
+                reverseComplement, pool)
+            for head, revcomp, headDset in zip(config["heads"], revcomps, headDsets):
+                headDset[rowStart:rowEnd] = _readHead(
+                    head["bigwig-files"], blockChroms, blockStarts - jitter, headWidth,
+                    revcomp, pool)
     outFile.close()
     logUtils.info("File created; closing.")
 
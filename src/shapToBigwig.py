@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
-"""A little script that takes an hdf5 generated by interpretFlat and renders a bigwig file."""
+"""A little script that takes an hdf5 generated by interpretFlat and renders a bigwig file.
+
+Each chromosome is handled by a separate worker process, which reads its regions in
+the order they're stored in the hdf5 so that each compressed chunk is only
+decompressed once. The main process writes the results to the bigwig as they come in.
+"""
 import argparse
+import multiprocessing
+from collections import OrderedDict
 import h5py
 import pyBigWig
 import numpy as np
@@ -8,34 +15,48 @@ from bpreveal import logUtils
 from bpreveal.internal.constants import H5_CHUNK_SIZE, IMPORTANCE_AR_T, ONEHOT_AR_T
 
 
-class BatchedH5Reader:
-    """Read in an hdf5 in chunks.
+class ChunkedH5Reader:
+    """Read an hdf5 of importance scores one chunk at a time, with a cache of chunks.
 
-    :param batchSize: The number of elements that should be read in at once
     :param h5fp: The (open) hdf5 file object to read from.
+    :param maxCachedChunks: How many decoded chunks should be kept in memory?
+
+    The reader looks at how ``hyp_scores`` is chunked in the file and always reads
+    whole chunks, so no chunk is ever decompressed just to get part of it.
+    The most recently used chunks are kept, so reading rows in any order close to
+    file order only decompresses each chunk once.
+    If the file isn't chunked, blocks of :py:data:`H5_CHUNK_SIZE
+    <bpreveal.internal.constants.H5_CHUNK_SIZE>` rows are read instead.
     """
 
-    curChunkStart: int
-    curChunkEnd: int
-
-    def __init__(self, h5fp: h5py.File, batchSize: int):
-        self.batchSize = batchSize
+    def __init__(self, h5fp: h5py.File, maxCachedChunks: int = 16):
         self.h5fp = h5fp
-        self._maxIndex = self.h5fp["hyp_scores"].shape[0]
-        self._curChunkStart = -100000
-        self._curChunkEnd = -100000
-        self._loadChunk(0)
-
-    def _loadChunk(self, index: int) -> None:
-        """Makes sure that the given chunk has been read."""
-        if self._curChunkStart <= index < self._curChunkEnd:
-            return
-        self._curChunkStart = index
-        self._curChunkEnd = min(index + self.batchSize, self._maxIndex)
-        self.curScore = np.array(self.h5fp["hyp_scores"]
-                                 [self._curChunkStart:self._curChunkEnd, :, :])
-        self.curSeqs = np.array(self.h5fp["input_seqs"]
-                                [self._curChunkStart:self._curChunkEnd, :, :])
+        scoreDset = self.h5fp["hyp_scores"]
+        self.chunkRows = scoreDset.chunks[0] if scoreDset.chunks is not None \
+            else H5_CHUNK_SIZE
+        self._maxIndex = scoreDset.shape[0]
+        self._maxCachedChunks = maxCachedChunks
+        self._chunks: OrderedDict[int, tuple[IMPORTANCE_AR_T, ONEHOT_AR_T]] = OrderedDict()
+        self.numChunkReads = 0
+
+    def _getChunk(self, index: int) -> tuple[int, tuple[IMPORTANCE_AR_T, ONEHOT_AR_T]]:
+        """Get the chunk containing the given row, reading it if needed.
+
+        :return: The first row of the chunk, and the scores and sequences in it.
+        """
+        chunkIdx = index // self.chunkRows
+        chunkStart = chunkIdx * self.chunkRows
+        if chunkIdx in self._chunks:
+            self._chunks.move_to_end(chunkIdx)
+            return chunkStart, self._chunks[chunkIdx]
+        chunkEnd = min(chunkStart + self.chunkRows, self._maxIndex)
+        chunk = (np.array(self.h5fp["hyp_scores"][chunkStart:chunkEnd]),
+                 np.array(self.h5fp["input_seqs"][chunkStart:chunkEnd]))
+        self.numChunkReads += 1
+        self._chunks[chunkIdx] = chunk
+        if len(self._chunks) > self._maxCachedChunks:
+            self._chunks.popitem(last=False)
+        return chunkStart, chunk
 
     def readScore(self, idx: int) -> IMPORTANCE_AR_T:
         """Read in score information from the hdf5.
@@ -43,8 +64,8 @@ class BatchedH5Reader:
         :param idx: The index of the score that we want to read.
         :return: An array of shape (input-length, NUM_BASES) containing hypothetical scores.
         """
-        self._loadChunk(idx)
-        return self.curScore[idx - self._curChunkStart, :, :]
+        chunkStart, (scores, _) = self._getChunk(idx)
+        return scores[idx - chunkStart]
 
     def readSeq(self, idx: int) -> ONEHOT_AR_T:
         """Read in sequence information from the hdf5.
@@ -52,18 +73,80 @@ class BatchedH5Reader:
         :param idx: The index of the sequence to read.
         :return: One-hot encoded sequences, shape (input-length, NUM_BASES)
         """
-        self._loadChunk(idx)
-        return self.curSeqs[idx - self._curChunkStart, :, :]
+        chunkStart, (_, seqs) = self._getChunk(idx)
+        return seqs[idx - chunkStart]
+
 
+def getWriteWindows(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Decide which bases of each region get written.
 
-def writeBigWig(inH5: h5py.File, outFname: str) -> None:  # pylint: disable=too-many-statements
+    :param starts: The start of each region on one chromosome, sorted.
+    :param ends: The end of each region.
+    :return: ``(writeStarts, writeEnds)``, the part of each region whose scores go
+        in the bigwig. A region with ``writeEnd <= writeStart`` isn't written at all.
+
+    Where two regions overlap, the first one is written up to the middle of the
+    overlap and the second one takes over from there.
+    """
+    nextStarts = np.concatenate([starts[1:], [np.iinfo(np.int64).max]])
+    overlaps = nextStarts < ends
+    writeEnds = np.where(overlaps, ends - (ends - nextStarts) // 2, ends)
+    # A region can't start writing until every region before it has finished.
+    prevEnds = np.concatenate([[0], np.maximum.accumulate(writeEnds)[:-1]])
+    writeStarts = np.maximum(starts, prevEnds)
+    return writeStarts, writeEnds
+
+
+def getChromInserts(arg: tuple[str, str, np.ndarray, np.ndarray, np.ndarray]) -> \
+        tuple[str, list[tuple[int, np.ndarray]]]:
+    """Project the importance scores for one chromosome.
+
+    :param arg: In order, h5Fname, chromName, h5Idxs, starts, ends.
+        ``h5Idxs`` are the rows of the hdf5 on this chromosome, sorted by start.
+    :return: The chromosome name, and a list of ``(start, values)`` inserts for
+        the bigwig, in order.
+
+    The projected score at each base is ``hyp_scores * input_seqs``, summed over
+    the bases.
+    """
+    h5Fname, chromName, h5Idxs, starts, ends = arg
+    writeStarts, writeEnds = getWriteWindows(starts, ends)
+    lengths = np.maximum(writeEnds - writeStarts, 0)
+    # All of the written bases, packed end to end, in genomic order.
+    outOffsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = np.zeros((outOffsets[-1],), dtype=np.float64)
+    with h5py.File(h5Fname, "r") as h5fp:
+        reader = ChunkedH5Reader(h5fp)
+        # Visit the regions in file order, so each chunk is read once.
+        for i in np.argsort(h5Idxs):
+            if lengths[i] == 0:
+                continue
+            projected = np.sum(reader.readScore(h5Idxs[i]) * reader.readSeq(h5Idxs[i]),
+                               axis=1)
+            sliceStart = writeStarts[i] - starts[i]
+            values[outOffsets[i]:outOffsets[i + 1]] = \
+                projected[sliceStart:sliceStart + lengths[i]]
+    # Regions that abut each other are merged into one insert.
+    written = np.flatnonzero(lengths)
+    if written.shape[0] == 0:
+        return chromName, []
+    breaks = np.flatnonzero(writeStarts[written[1:]] != writeEnds[written[:-1]]) + 1
+    inserts = []
+    for group in np.split(written, breaks):
+        inserts.append((int(writeStarts[group[0]]),
+                        values[outOffsets[group[0]]:outOffsets[group[-1] + 1]]))
+    logUtils.debug(f"Finished {chromName}, read {reader.numChunkReads} chunks.")
+    return chromName, inserts
+
+
+def writeBigWig(inH5: h5py.File, outFname: str, numThreads: int = 1) -> None:
     """Write the data in the h5 file to a bigwig on disk.
 
     :param inH5: The (open) hdf5 file to use
     :param outFname: The name of the bigwig to save
+    :param numThreads: How many chromosomes should be processed in parallel?
     """
     bwHeader = []
-    h5Reader = BatchedH5Reader(inH5, H5_CHUNK_SIZE)
     chromIdxToName = {}
     for i, name in enumerate(inH5["chrom_names"].asstr()):
         bwHeader.append((str(name), int(inH5["chrom_sizes"][i])))
@@ -71,7 +154,6 @@ def writeBigWig(inH5: h5py.File, outFname: str) -> None:  # pylint: disable=too-
     outBw = pyBigWig.open(outFname, "w")
     outBw.addHeader(sorted(bwHeader))
     logUtils.debug("Bigwig header" + str((sorted(bwHeader))))
-    numRegions = inH5["coords_chrom"].shape[0]
     if isinstance(inH5["coords_chrom"][0], bytes):
         logUtils.error("You are using an old-style hdf5 file for importance scores. "
                        "Support for these files will be removed in BPReveal 7.0. "
@@ -80,69 +162,23 @@ def writeBigWig(inH5: h5py.File, outFname: str) -> None:  # pylint: disable=too-
     else:
         coordsChromIdxes = np.array(inH5["coords_chrom"])
         coordsChrom = np.array([chromIdxToName[x] for x in coordsChromIdxes])
-    # Sort the regions.
     coordsStart = np.array(inH5["coords_start"])
     coordsEnd   = np.array(inH5["coords_end"])  # noqa
-    regionOrder = sorted(range(numRegions), key=lambda x: (coordsChrom[x], coordsStart[x]))
-    startWritingAt = 0
-    regionID = regionOrder[0]
-    regionChrom = coordsChrom[regionID]
-    curChrom = regionChrom
-    regionStart = coordsStart[regionID]
-    regionStop = coordsEnd[regionID]
+    # Sort the regions by chromosome name (the order of the bigwig header) and start.
+    regionOrder = np.lexsort((coordsStart, coordsChrom))
+    chromNames, firstRegions = np.unique(coordsChrom[regionOrder], return_index=True)
+    chromArgs = []
+    for chromName, chromOrder in zip(chromNames, np.split(regionOrder, firstRegions[1:])):
+        chromArgs.append((inH5.filename, str(chromName), chromOrder,
+                          coordsStart[chromOrder].astype(np.int64),
+                          coordsEnd[chromOrder].astype(np.int64)))
     logUtils.info("Files opened; writing regions")
-    regionRange = logUtils.wrapTqdm(range(numRegions))
-    nextRegion = None
-    nextStop = 0
-    for regionNumber in regionRange:
-        # Extract the appropriate region from the sorted list.
-
-        if regionChrom != curChrom:
-            curChrom = regionChrom
-            startWritingAt = 0
-
-        if startWritingAt < regionStart:
-            # The next region starts beyond the end
-            # of the previous one. Some bases will not be filled in.
-            startWritingAt = regionStart
-        # By default, write the whole region.
-        stopWritingAt = regionStop
-        # As long as we aren't on the last region, check for overlaps.
-
-        if regionNumber < numRegions - 1:
-            nextRegion = regionOrder[regionNumber + 1]
-            nextChrom = coordsChrom[nextRegion]
-            nextStart = coordsStart[nextRegion]
-            nextStop = coordsEnd[nextRegion]
-            if nextChrom == regionChrom and nextStart < stopWritingAt:
-                # The next region overlaps. So stop writing before then.
-                overlapSize = regionStop - nextStart
-                stopWritingAt = stopWritingAt - overlapSize // 2
-        dataSliceStart = startWritingAt - regionStart
-        dataSliceStop = stopWritingAt - regionStart
-
-        # Okay, now it's time to actually do the thing to the data!
-
-        importances = h5Reader.readScore(regionID)
-        seq = h5Reader.readSeq(regionID)
-        projected = np.array(importances) * np.array(seq)
-        # Add up all the bases to get a vector of projected importances.
-        profile = np.sum(projected, axis=1)
-        vals = [float(x) for x in profile[dataSliceStart:dataSliceStop]]
-        outBw.addEntries(regionChrom,
-                         int(startWritingAt),
-                         values=vals,
-                         span=1, step=1)
-
-        # Update the region. By pulling the first setting of the region variables out of the loop,
-        # I avoid double-dipping to get those data from the H5.
-        startWritingAt = stopWritingAt
-        if nextRegion is not None:
-            regionID = nextRegion
-            regionChrom = nextChrom  # type: ignore
-            regionStart = nextStart  # type: ignore
-            regionStop = nextStop  # type: ignore
-
+    with multiprocessing.Pool(numThreads) as pool:
+        # imap hands back the chromosomes in order, so they can be written as they finish.
+        for chromName, inserts in logUtils.wrapTqdm(pool.imap(getChromInserts, chromArgs),
+                                                    total=len(chromArgs)):
+            for start, values in inserts:
+                outBw.addEntries(chromName, start, values=values, span=1, step=1)
     logUtils.info("Regions written; closing bigwig.")
     outBw.close()
     logUtils.info("Done saving shap scores.")
@@ -158,6 +194,8 @@ def getParser() -> argparse.ArgumentParser:
                     "script and render it to a bigwig.")
     parser.add_argument("--h5", help="The name of the hdf5-format file to be read in.")
     parser.add_argument("--bw", help="The name of the bigwig file that should be written.")
+    parser.add_argument("--threads", help="How many chromosomes should be processed "
+                        "at once?", type=int, default=1, dest="numThreads")
     parser.add_argument("--verbose", help="Print progress messages.", action="store_true")
     return parser
 
@@ -167,7 +205,7 @@ def main() -> None:
     args = getParser().parse_args()
     logUtils.setBooleanVerbosity(args.verbose)
     inH5 = h5py.File(args.h5, "r")
-    writeBigWig(inH5, args.bw)
+    writeBigWig(inH5, args.bw, args.numThreads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Check and time the two multinomial profile losses.
+
+:py:func:`fastMultinomialNll<bpreveal.losses.fastMultinomialNll>` is supposed to
+give exactly the same loss as :py:func:`multinomialNll<bpreveal.losses.multinomialNll>`,
+just faster. This tool makes random counts and logits shaped like a batch of
+profiles, checks that the two losses (and their gradients with respect to the
+logits) agree, and then times each of them, compiled with ``tf.function``.
+
+For example, to check a wide, two-task output on the CPU::
+
+    benchmarkLoss --output-length 3000 --num-tasks 2 --batch-size 128
+
+If the losses don't agree, this exits with an ``AssertionError``.
+"""
+# flake8: noqa: T201
+import argparse
+import time
+import numpy as np
+from bpreveal.internal import disableTensorflowLogging  # pylint: disable=unused-import # noqa
+import tensorflow as tf
+from bpreveal.losses import multinomialNll, fastMultinomialNll
+
+
+def makeData(batchSize: int, outputLength: int, numTasks: int,
+             meanCounts: float) -> tuple[tf.Tensor, tf.Tensor]:
+    """Make random counts and logits.
+
+    :param batchSize: The number of regions.
+    :param outputLength: The width of each profile.
+    :param numTasks: The number of tasks in the head.
+    :param meanCounts: The average number of reads at each base.
+    :return: A tuple of (counts, logits), each of shape
+        ``(batchSize x outputLength x numTasks)``.
+    """
+    rng = np.random.default_rng(seed=1234)
+    shape = (batchSize, outputLength, numTasks)
+    counts = rng.poisson(meanCounts, size=shape).astype(np.float32)
+    logits = rng.normal(size=shape).astype(np.float32)
+    return tf.constant(counts), tf.constant(logits)
+
+
+def lossAndGradient(lossFun, counts: tf.Tensor,  # noqa: ANN001
+                    logits: tf.Tensor) -> tuple[float, np.ndarray]:
+    """Evaluate a loss and its gradient with respect to the logits."""
+    with tf.GradientTape() as tape:
+        tape.watch(logits)
+        loss = lossFun(counts, logits)
+    return float(loss), tape.gradient(loss, logits).numpy()
+
+
+def checkLosses(counts: tf.Tensor, logits: tf.Tensor) -> None:
+    """Make sure that the two losses and their gradients agree.
+
+    :param counts: The true counts.
+    :param logits: The predicted logits.
+    """
+    refLoss, refGrad = lossAndGradient(multinomialNll, counts, logits)
+    fastLoss, fastGrad = lossAndGradient(fastMultinomialNll, counts, logits)
+    print(f"multinomialNll:     {refLoss:.6f}")
+    print(f"fastMultinomialNll: {fastLoss:.6f}")
+    assert np.isclose(refLoss, fastLoss, rtol=1e-5), "The losses disagree."
+    maxGradDiff = float(np.max(np.abs(refGrad - fastGrad)))
+    print(f"Largest difference in the gradients: {maxGradDiff:.3g}")
+    assert np.allclose(refGrad, fastGrad, rtol=1e-4, atol=1e-5), "The gradients disagree."
+    # With no counts at all, there is only one possible outcome, so both losses are zero.
+    zeros = tf.zeros_like(counts)
+    for lossFun in (multinomialNll, fastMultinomialNll):
+        assert np.isclose(float(lossFun(zeros, logits)), 0, atol=1e-6), \
+            f"{lossFun.__name__} of no counts is not zero."
+
+
+def timeLoss(lossFun, counts: tf.Tensor, logits: tf.Tensor,  # noqa: ANN001
+             repeats: int) -> float:
+    """Time a compiled loss and its gradient.
+
+    :return: The fastest time of one evaluation, in seconds.
+    """
+    @tf.function
+    def step(c: tf.Tensor, l: tf.Tensor) -> tf.Tensor:  # noqa: E741
+        with tf.GradientTape() as tape:
+            tape.watch(l)
+            loss = lossFun(c, l)
+        return tape.gradient(loss, l)
+    step(counts, logits).numpy()  # Trace the function before timing it.
+    best = float("inf")
+    for _ in range(repeats):
+        startTime = time.perf_counter()
+        step(counts, logits).numpy()
+        best = min(best, time.perf_counter() - startTime)
+    return best
+
+
+def getParser() -> argparse.ArgumentParser:
+    """Generate the parser."""
+    parser = argparse.ArgumentParser(
+        description="Check that the fast multinomial loss matches the original, and time both.")
+    parser.add_argument("--batch-size", help="The number of regions in each batch.",
+                        type=int, default=64, dest="batchSize")
+    parser.add_argument("--output-length", help="The width of the profiles.",
+                        type=int, default=1000, dest="outputLength")
+    parser.add_argument("--num-tasks", help="The number of tasks in the head.",
+                        type=int, default=2, dest="numTasks")
+    parser.add_argument("--mean-counts", help="The average number of reads at each base.",
+                        type=float, default=0.5, dest="meanCounts")
+    parser.add_argument("--repeats", help="How many times to run each loss.",
+                        type=int, default=20)
+    return parser
+
+
+def main() -> None:
+    """Run the checks and the benchmark."""
+    args = getParser().parse_args()
+    counts, logits = makeData(args.batchSize, args.outputLength, args.numTasks,
+                              args.meanCounts)
+    checkLosses(counts, logits)
+    refTime = timeLoss(multinomialNll, counts, logits, args.repeats)
+    fastTime = timeLoss(fastMultinomialNll, counts, logits, args.repeats)
+    print(f"{'loss':20s}{'seconds':>12s}")
+    print(f"{'multinomialNll':20s}{refTime:12.6f}")
+    print(f"{'fastMultinomialNll':20s}{fastTime:12.6f}")
+    print(f"Speedup: {refTime / fastTime:.2f}")
+
+
+if __name__ == "__main__":
+    main()
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Time the libslide kernels that jitter the training data.
+
+Every epoch, :py:class:`H5BatchGenerator<bpreveal.generators.H5BatchGenerator>`
+uses libslide to copy a randomly-offset window out of every region. This tool
+runs each kernel on random data shaped like a training set, checks that it
+gives the same answer as plain numpy indexing, and prints how long each one
+took with different numbers of threads.
+
+The kernels are:
+
+slideReference
+    The original float kernel, which copies one element at a time. Nothing uses
+    it any more; it's here so you can see what ``slide`` gained.
+
+slide
+    The float kernel, which copies each row as one block. The generator uses it
+    for the profiles.
+
+slideBytes
+    The same, for the one-hot sequences, which stay as bytes.
+
+Speedups are relative to the numpy version, so compare ``slide`` with
+``slideReference`` to see the difference between the old and new kernels.
+
+For example, to see how well the kernels scale on your machine::
+
+    benchmarkSlide --rows 50000 --threads 1 --threads 4 --threads 16
+
+"""
+# flake8: noqa: T201
+import argparse
+import os
+import time
+import numpy as np
+from bpreveal.internal.libslide import slide, slideBytes, slideReference
+
+
+def numpySlide(source: np.ndarray, dest: np.ndarray, rowIndexes: np.ndarray,
+               colIndexes: np.ndarray) -> None:
+    """Do what the libslide kernels do, using numpy indexing.
+
+    :param source: The (numRows x numSourceCols x depth) data to copy from.
+    :param dest: The (numRows x numDestCols x depth) array to fill.
+    :param rowIndexes: The row of dest that each row of source goes to.
+    :param colIndexes: The first column of each row of source to copy.
+    """
+    cols = colIndexes[:, np.newaxis] + np.arange(dest.shape[1])
+    dest[rowIndexes] = source[np.arange(source.shape[0])[:, np.newaxis], cols]
+
+
+def timeKernel(kernel, args: tuple, repeats: int) -> float:  # noqa: ANN001
+    """Run a kernel several times and return the fastest time, in seconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        startTime = time.perf_counter()
+        kernel(*args)
+        best = min(best, time.perf_counter() - startTime)
+    return best
+
+
+def runBenchmark(numRows: int, sourceCols: int, destCols: int, depth: int,
+                 threadCounts: list[int], repeats: int) -> None:
+    """Time all of the kernels and print a table of the results.
+
+    :param numRows: How many regions are in the fake data set?
+    :param sourceCols: The width of each region, including the jitter.
+    :param destCols: The width of each jittered window.
+    :param depth: The size of the last dimension (tasks or bases).
+    :param threadCounts: The numbers of threads to try.
+    :param repeats: How many times should each kernel be run? The fastest run is reported.
+    """
+    rng = np.random.default_rng(seed=1234)
+    rowIndexes = rng.permutation(numRows).astype(np.int32)
+    colIndexes = rng.integers(0, sourceCols - destCols + 1, size=(numRows,), dtype=np.int32)
+    floatSource = rng.random((numRows, sourceCols, depth), dtype=np.float32)
+    byteSource = rng.integers(0, 2, size=(numRows, sourceCols, depth), dtype=np.uint8)
+    kernels = [("slideReference", slideReference, floatSource, np.float32),
+               ("slide", slide, floatSource, np.float32),
+               ("slideBytes", slideBytes, byteSource, np.uint8)]
+    print(f"{'kernel':16s}{'threads':>8s}{'seconds':>12s}{'speedup':>10s}")
+    for name, kernel, source, destType in kernels:
+        expected = np.empty((numRows, destCols, depth), dtype=destType)
+        baseTime = timeKernel(numpySlide, (source, expected, rowIndexes, colIndexes), repeats)
+        print(f"{name:16s}{'numpy':>8s}{baseTime:12.5f}{1:10.2f}")
+        for numThreads in threadCounts:
+            dest = np.empty((numRows, destCols, depth), dtype=destType)
+            Δt = timeKernel(kernel, (source, dest, rowIndexes, colIndexes, numThreads), repeats)
+            assert np.array_equal(dest, expected), f"{name} gave the wrong answer!"
+            print(f"{name:16s}{numThreads:8d}{Δt:12.5f}{baseTime / Δt:10.2f}")
+
+
+def getParser() -> argparse.ArgumentParser:
+    """Generate the parser."""
+    parser = argparse.ArgumentParser(
+        description="Time the libslide kernels used to jitter training data.")
+    parser.add_argument("--rows", help="How many regions should the fake data have?",
+                        type=int, default=20000)
+    parser.add_argument("--source-cols", help="The width of each region, including jitter.",
+                        type=int, default=1100, dest="sourceCols")
+    parser.add_argument("--dest-cols", help="The width of each jittered window.",
+                        type=int, default=1000, dest="destCols")
+    parser.add_argument("--depth", help="The number of tasks (or bases) in each column.",
+                        type=int, default=4)
+    parser.add_argument("--threads", help="A number of threads to try. May be given "
+                        "multiple times. The default is 1, 8, and the number of CPUs "
+                        "this process may run on.", type=int, action="append",
+                        dest="threadCounts")
+    parser.add_argument("--repeats", help="How many times to run each kernel.",
+                        type=int, default=5)
+    return parser
+
+
+def main() -> None:
+    """Run the benchmark."""
+    args = getParser().parse_args()
+    threadCounts = args.threadCounts
+    if threadCounts is None:
+        threadCounts = sorted({1, 8, len(os.sched_getaffinity(0))})
+    runBenchmark(args.rows, args.sourceCols, args.destCols, args.depth,
+                 threadCounts, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""See how much accuracy a model loses when it predicts in mixed precision.
+
+This makes predictions on the same sequences twice, once with the model in
+float32 (even if it was trained with ``mixed-precision``) and once in mixed
+precision (bfloat16 calculations with float32 outputs, see
+:py:func:`loadModel<bpreveal.utils.loadModel>`), and compares them.
+The sequences come from the ``sequence`` dataset of an hdf5 file made by
+:py:mod:`prepareTrainingData<bpreveal.prepareTrainingData>`, usually your test
+set. If the sequences are longer than the model's input (because of jitter), the
+middle of each one is used.
+
+For each head, it prints:
+
+logcounts-mean, logcounts-max
+    The mean and largest absolute difference in the predicted logcounts.
+
+profile-mean, profile-max
+    The mean and largest total variation distance between the two predicted
+    profiles (as probability distributions over all of the positions and tasks
+    of a region). This is half the sum of the absolute differences, so 0 means
+    the profiles are the same and 1 means they don't overlap at all.
+
+logcounts-r
+    The Pearson correlation between the two sets of logcounts, over all regions.
+
+If ``--tolerance`` is given and, in any head, either mean difference is bigger
+than it, the program exits with an error.
+"""
+# flake8: noqa: T201
+import argparse
+import sys
+import h5py
+import numpy as np
+import scipy.special
+from bpreveal import logUtils
+from bpreveal import utils
+
+
+def loadSequences(h5Fname: str, inputLength: int, maxRegions: int | None) -> np.ndarray:
+    """Read the sequences from the hdf5 and trim them to the model's input length.
+
+    :param h5Fname: The hdf5 file, from prepareTrainingData.
+    :param inputLength: The input length of the model.
+    :param maxRegions: If given, only read this many regions.
+    :return: A one-hot encoded array of shape (numRegions x inputLength x NUM_BASES).
+    """
+    with h5py.File(h5Fname, "r") as fp:
+        seqDset = fp["sequence"]
+        numRegions = seqDset.shape[0] if maxRegions is None \
+            else min(maxRegions, seqDset.shape[0])
+        extra = seqDset.shape[1] - inputLength
+        assert extra >= 0 and extra % 2 == 0, \
+            f"Sequences of length {seqDset.shape[1]} can't be centered on an input " \
+            f"of length {inputLength}."
+        return np.array(seqDset[:numRegions, extra // 2:extra // 2 + inputLength])
+
+
+def compareHead(logits: np.ndarray, logcounts: np.ndarray, mixedLogits: np.ndarray,
+                mixedLogcounts: np.ndarray) -> dict[str, float]:
+    """Compare the float32 and mixed-precision predictions for one head.
+
+    :param logits: The float32 logits, shape (numRegions x outputLength x numTasks).
+    :param logcounts: The float32 logcounts, shape (numRegions,).
+    :param mixedLogits: The mixed-precision logits.
+    :param mixedLogcounts: The mixed-precision logcounts.
+    :return: A dict with the statistics described at the top of this file.
+    """
+    numRegions = logits.shape[0]
+    probs = scipy.special.softmax(logits.reshape(numRegions, -1).astype(np.float64), axis=1)
+    mixedProbs = scipy.special.softmax(mixedLogits.reshape(numRegions, -1).astype(np.float64),
+                                       axis=1)
+    profileDists = np.sum(np.abs(probs - mixedProbs), axis=1) / 2
+    countsDiffs = np.abs(logcounts.astype(np.float64) - mixedLogcounts)
+    return {"logcounts-mean": float(np.mean(countsDiffs)),
+            "logcounts-max": float(np.max(countsDiffs)),
+            "profile-mean": float(np.mean(profileDists)),
+            "profile-max": float(np.max(profileDists)),
+            "logcounts-r": float(np.corrcoef(logcounts, mixedLogcounts)[0, 1])}
+
+
+def getParser() -> argparse.ArgumentParser:
+    """Generate the parser."""
+    parser = argparse.ArgumentParser(
+        description="Compare a model's predictions in float32 and in mixed precision.")
+    parser.add_argument("--model", help="The model to check.", dest="modelFname",
+                        required=True)
+    parser.add_argument("--h5", help="An hdf5 file from prepareTrainingData, usually "
+                        "your test set.", dest="h5Fname", required=True)
+    parser.add_argument("--input-length", help="The input length of the model.",
+                        type=int, dest="inputLength", required=True)
+    parser.add_argument("--batch-size", help="The batch size to use.",
+                        type=int, default=64, dest="batchSize")
+    parser.add_argument("--max-regions", help="Only use this many regions from the file.",
+                        type=int, dest="maxRegions")
+    parser.add_argument("--tolerance", help="Fail if the mean logcounts difference or the "
+                        "mean profile distance of any head is bigger than this.",
+                        type=float)
+    parser.add_argument("--verbose", help="Print progress messages.", action="store_true")
+    return parser
+
+
+def main() -> None:
+    """Run the comparison."""
+    args = getParser().parse_args()
+    logUtils.setBooleanVerbosity(args.verbose)
+    fullBatcher = utils.BatchPredictor(args.modelFname, args.batchSize)
+    mixedBatcher = utils.BatchPredictor(args.modelFname, args.batchSize, mixedPrecision=True)
+    sequences = loadSequences(args.h5Fname, args.inputLength, args.maxRegions)
+    logUtils.info(f"Predicting {sequences.shape[0]} regions.")
+    logits, logcounts = fullBatcher.predictArray(sequences)
+    mixedLogits, mixedLogcounts = mixedBatcher.predictArray(sequences)
+    statNames = ["logcounts-mean", "logcounts-max", "profile-mean", "profile-max",
+                 "logcounts-r"]
+    print("head\t" + "\t".join(statNames))
+    passed = True
+    for headIdx in range(len(logits)):
+        stats = compareHead(logits[headIdx], logcounts[headIdx],
+                            mixedLogits[headIdx], mixedLogcounts[headIdx])
+        print(f"{headIdx}\t" + "\t".join(f"{stats[s]:.6f}" for s in statNames))
+        if args.tolerance is not None and max(stats["logcounts-mean"],
+                                              stats["profile-mean"]) > args.tolerance:
+            passed = False
+    if not passed:
+        logUtils.error(f"At least one head differs by more than {args.tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+# Copyright 2022, 2023, 2024 Charles McAnany. This file is part of BPReveal. BPReveal is free software: You can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 2 of the License, or (at your option) any later version. BPReveal is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details. You should have received a copy of the GNU General Public License along with BPReveal. If not, see <https://www.gnu.org/licenses/>.  # noqa
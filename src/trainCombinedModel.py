@@ -67,6 +67,8 @@ def main(config: dict) -> None:
     logUtils.debug("Initializing")
     inputLength = config["settings"]["architecture"]["input-length"]
     outputLength = config["settings"]["architecture"]["output-length"]
+    if config["settings"].get("mixed-precision", False):
+        bpreveal.training.useMixedPrecision()
     regressionModel = utils.loadModel(
         config["settings"]["transformation-model"]["transformation-model-file"])
     regressionModel.trainable = False
@@ -80,7 +82,8 @@ def main(config: dict) -> None:
         config["settings"]["architecture"]["input-filter-width"],
         config["settings"]["architecture"]["output-filter-width"],
         config["heads"], regressionModel)
-    losses, lossWeights = bpreveal.training.buildLosses(config["heads"])
+    losses, lossWeights = bpreveal.training.buildLosses(
+        config["heads"], config["settings"].get("fast-profile-loss", False))
 
     residualModel.compile(
         optimizer=keras.optimizers.Adam(learning_rate=config["settings"]["learning-rate"]),
@@ -128,6 +128,45 @@ max-jitter
     used when you created your training data file - if you want to try a
     different jitter, you need to re-generate your data hdf5 files.
 
+lazy-loading
+    (Optional) If ``true``, the training and validation data are not loaded into
+    memory. Instead, the chunks of the hdf5 files are read in a random order as
+    training goes, and each batch is jittered as it's needed. Use this when your
+    data are bigger than your memory. It's a bit slower, and the regions are not
+    shuffled quite as thoroughly, since regions from far-apart parts of the file
+    never end up in the same batch. See
+    :py:class:`H5BatchGenerator<bpreveal.generators.H5BatchGenerator>`.
+    Default: ``false``.
+
+background-refresh-mb
+    (Optional) Between epochs, the training data are shuffled and re-jittered, and
+    this can take a while for big data sets. If the jittered data fit in this many
+    megabytes, a second copy is made and the next epoch's data are prepared in the
+    background while the current epoch trains. Note that the training and
+    validation data each get their own second copy.
+    Not used with ``lazy-loading``. Default: 0, meaning don't prepare data in
+    the background.
+
+fast-profile-loss
+    (Optional) If ``true``, the profile loss is calculated with
+    :py:func:`fastMultinomialNll<bpreveal.losses.fastMultinomialNll>`, which
+    writes out the multinomial log probability directly, instead of
+    :py:func:`multinomialNll<bpreveal.losses.multinomialNll>`, which goes through
+    tensorflow-probability. The two give the same loss, but the fast one takes
+    less time for each batch, which matters most when training on a CPU.
+    Default: ``false``.
+
+mixed-precision
+    (Optional) If ``true``, the model does its calculations in bfloat16 instead of
+    float32, except for the output layers and the losses, which stay in float32.
+    The weights are still saved in float32. On hardware with bfloat16 support, this
+    is about twice as fast. Predictions from the saved model are still made in
+    float32, unless you pass ``mixedPrecision=True`` to
+    :py:func:`loadModel<bpreveal.utils.loadModel>` or to the batchers.
+    ``checkMixedPrecision`` compares a model's predictions in bfloat16 and in
+    float32, so you can see how much accuracy is lost.
+    Default: ``false``.
+
 Additional information
 ----------------------
 
@@ -170,6 +209,8 @@ def main(config: dict) -> None:
     logUtils.debug("Initializing")
     inputLength = config["settings"]["architecture"]["input-length"]
     outputLength = config["settings"]["architecture"]["output-length"]
+    if config["settings"].get("mixed-precision", False):
+        bpreveal.training.useMixedPrecision()
 
     model = models.soloModel(
         inputLength, outputLength,
@@ -179,7 +220,8 @@ def main(config: dict) -> None:
         config["settings"]["architecture"]["output-filter-width"],
         config["heads"], "solo")
     logUtils.debug("Model built.")
-    losses, lossWeights = bpreveal.training.buildLosses(config["heads"])
+    losses, lossWeights = bpreveal.training.buildLosses(
+        config["heads"], config["settings"].get("fast-profile-loss", False))
     model.compile(
         optimizer=keras.optimizers.Adam(learning_rate=config["settings"]["learning-rate"]),
         loss=losses, loss_weights=lossWeights, metrics=losses)
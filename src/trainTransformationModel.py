@@ -92,7 +92,8 @@ def main(config: dict) -> None:
         config["settings"]["counts-architecture"],
         config["heads"])
 
-    losses, lossWeights = bpreveal.training.buildLosses(config["heads"])
+    losses, lossWeights = bpreveal.training.buildLosses(
+        config["heads"], config["settings"].get("fast-profile-loss", False))
     model.compile(
         optimizer=keras.optimizers.Adam(
             learning_rate=config["settings"]["learning-rate"]),
@@ -13,10 +13,13 @@ from bpreveal import generators
 from bpreveal import losses
 
 
-def buildLosses(heads: dict) -> tuple[list, list]:
+def buildLosses(heads: dict, fastProfileLoss: bool = False) -> tuple[list, list]:
     r"""Given the output head specification (from the configuration JSON), build losses.
 
     :param heads: The heads section from a configuration file.
+    :param fastProfileLoss: If True, use
+        :py:func:`fastMultinomialNll<bpreveal.losses.fastMultinomialNll>` for the profiles
+        instead of :py:func:`multinomialNll<bpreveal.losses.multinomialNll>`.
     :return: A tuple. The first element contains the losses, and the second contains the
         loss weights.
 
@@ -43,7 +46,8 @@ def buildLosses(heads: dict) -> tuple[list, list]:
     """
     logUtils.info("Building loss functions.")
     numHeads = len(heads)
-    profileLosses = [losses.multinomialNll] * numHeads
+    profileLoss = losses.fastMultinomialNll if fastProfileLoss else losses.multinomialNll
+    profileLosses = [profileLoss] * numHeads
     countsLosses = []
     profileWeights = []
     countsWeights = []
@@ -66,6 +70,18 @@ def buildLosses(heads: dict) -> tuple[list, list]:
     return (allLosses, allWeights)
 
 
+def useMixedPrecision() -> None:
+    """Build all models from now on with bfloat16 compute and float32 weights.
+
+    This sets the global Keras ``mixed_bfloat16`` policy, so it must be called before
+    the model is built. The output layers of the BPReveal models always compute in
+    float32, so the losses are still calculated with full precision.
+    bfloat16 has the same range as float32, so no loss scaling is needed.
+    """
+    logUtils.info("Using mixed precision (bfloat16) for training.")
+    keras.mixed_precision.set_global_policy("mixed_bfloat16")
+
+
 def _makeJsonSerializable(cfg: Any) -> Any:  # pylint: disable=too-many-return-statements
     """Takes history dictionary that may contain ndarrays and tf.Variables and makes it json-safe.
 
@@ -118,12 +134,16 @@ def trainWithGenerators(model: keras.Model, config: dict, inputLength: int,
     trainH5 = h5py.File(config["train-data"], "r")
     valH5 = h5py.File(config["val-data"], "r")
 
+    lazy = config["settings"].get("lazy-loading", False)
+    refreshBytes = int(config["settings"].get("background-refresh-mb", 0) * 2 ** 20)
     trainGenerator = generators.H5BatchGenerator(
         config["heads"], trainH5, inputLength, outputLength,
-        config["settings"]["max-jitter"], config["settings"]["batch-size"])
+        config["settings"]["max-jitter"], config["settings"]["batch-size"], lazy=lazy,
+        backgroundRefreshBytes=refreshBytes)
     valGenerator = generators.H5BatchGenerator(
         config["heads"], valH5, inputLength, outputLength,
-        config["settings"]["max-jitter"], config["settings"]["batch-size"])
+        config["settings"]["max-jitter"], config["settings"]["batch-size"], lazy=lazy,
+        backgroundRefreshBytes=refreshBytes)
     logUtils.info("Generators initialized. Training.")
     history = trainModel(
         model, trainGenerator,
@@ -2,6 +2,7 @@
 from collections import deque
 import multiprocessing
 import multiprocessing.synchronize
+from multiprocessing import resource_tracker
 import subprocess as sp
 import typing
 import queue
@@ -16,12 +17,14 @@ from bpreveal import logUtils
 # find them.
 from bpreveal.logUtils import setVerbosity, wrapTqdm  # pylint: disable=unused-import  # noqa
 from bpreveal.internal.constants import NUM_BASES, ONEHOT_AR_T, PRED_AR_T, ONEHOT_T, \
-    LOGCOUNT_T, LOGIT_AR_T, IMPORTANCE_AR_T, IMPORTANCE_T, PRED_T
+    LOGCOUNT_T, LOGIT_AR_T, IMPORTANCE_AR_T, IMPORTANCE_T, PRED_T, LOGIT_T, LOGCOUNT_AR_T
 from bpreveal.internal import constants
 from bpreveal.internal.crashQueue import CrashQueue
+from bpreveal.internal.sharedRing import SharedRing
+from bpreveal.internal.predictionCache import PredictionCache
 
 
-def loadModel(modelFname: str):  # noqa: ANN201
+def loadModel(modelFname: str, mixedPrecision: bool = False):  # noqa: ANN201
     """Load up a BPReveal model.
 
     .. note::
@@ -30,6 +33,13 @@ def loadModel(modelFname: str):  # noqa: ANN201
     :param modelFname: The name of the model that Keras saved earlier, either a directory
         ending in ``.model`` for models trained before BPReveal 5.0.0, or a file ending in
         ``.keras`` for models trained with BPReveal 5.0.0 or later.
+    :param mixedPrecision: If True, the model's layers compute in bfloat16, except for
+        the output layers, which stay in float32. The weights are still stored in
+        float32. This is only for making predictions: the returned model is not
+        compiled, and it is not supported for pre-5.0.0 models.
+        If False, a model that was trained with ``mixed-precision`` (and so saved
+        with bfloat16 layers) is rebuilt to compute entirely in float32. That
+        rebuilt model is not compiled either.
     :return: A Keras ``Model`` object.
 
     For pre-5.0.0 models, the returned model does NOT support additional training,
@@ -48,7 +58,7 @@ def loadModel(modelFname: str):  # noqa: ANN201
     ret = None
     # pylint: disable=import-outside-toplevel
     import bpreveal.internal.disableTensorflowLogging  # pylint: disable=unused-import # noqa
-    from bpreveal.losses import multinomialNll, dummyMse
+    from bpreveal.losses import multinomialNll, fastMultinomialNll, dummyMse
     # pylint: enable=import-outside-toplevel
     constants.setTensorflowLoaded()
     if modelFname.endswith("model"):
@@ -62,6 +72,7 @@ def loadModel(modelFname: str):  # noqa: ANN201
             ret = tf_keras.models.load_model(
                 filepath=modelFname,
                 custom_objects={"multinomialNll": multinomialNll,
+                                "fastMultinomialNll": fastMultinomialNll,
                                 "reweightableMse": dummyMse})
             ret.useOldKeras = True
             logUtils.debug(f"Loaded old-style model {modelFname}.")
@@ -79,12 +90,78 @@ def loadModel(modelFname: str):  # noqa: ANN201
         ret = load_model(
             filepath=modelFname,
             custom_objects={"multinomialNll": multinomialNll,
+                            "fastMultinomialNll": fastMultinomialNll,
                             "reweightableMse": dummyMse})
         ret.useOldKeras = False
         logUtils.debug(f"Loaded new-style model {modelFname}.")
+    if mixedPrecision:
+        if ret.useOldKeras:
+            logUtils.warning("Mixed precision is not supported for old-style models. "
+                             "The model will compute in float32.")
+        else:
+            ret = _mixedPrecisionModel(ret)
+    elif not ret.useOldKeras and _hasMixedLayers(ret.get_config()["layers"]):
+        ret = _float32Model(ret)
+    return ret
+
+
+def _mixedPrecisionModel(model):  # noqa: ANN001, ANN202
+    """Rebuild a (keras 3) model so that it computes in bfloat16 and copy its weights in."""
+    config = model.get_config()
+    outputNames = {outputLayer[0] for outputLayer in config["output_layers"]}
+    _setComputeDtype(config["layers"], "mixed_bfloat16", outputNames)
+    ret = model.__class__.from_config(config)
+    ret.set_weights(model.get_weights())
+    ret.useOldKeras = False
+    logUtils.debug("Switched model to mixed precision.")
+    return ret
+
+
+def _float32Model(model):  # noqa: ANN001, ANN202
+    """Rebuild a (keras 3) model that was saved in mixed precision so it computes in float32."""
+    config = model.get_config()
+    _setComputeDtype(config["layers"], "float32", set())
+    ret = model.__class__.from_config(config)
+    ret.set_weights(model.get_weights())
+    ret.useOldKeras = False
+    logUtils.debug("Switched model from mixed precision to float32.")
     return ret
 
 
+def _dtypePolicyName(dtype: str | dict | None) -> str:
+    """Get the name of a layer's dtype policy from its config.
+
+    Keras saves the policy either as a plain name or as a serialized ``DTypePolicy``.
+    """
+    if isinstance(dtype, dict):
+        return dtype.get("config", {}).get("name", "float32")
+    return dtype or "float32"
+
+
+def _hasMixedLayers(layerConfigs: list[dict]) -> bool:
+    """Does any layer (including layers of inner models) compute in something but float32?"""
+    for layerConfig in layerConfigs:
+        innerConfig = layerConfig["config"]
+        if "layers" in innerConfig:
+            if _hasMixedLayers(innerConfig["layers"]):
+                return True
+        elif _dtypePolicyName(innerConfig.get("dtype")) != "float32":
+            return True
+    return False
+
+
+def _setComputeDtype(layerConfigs: list[dict], dtype: str, keepNames: set[str]) -> None:
+    """Set the dtype policy of every layer, except inputs and the layers in keepNames."""
+    for layerConfig in layerConfigs:
+        innerConfig = layerConfig["config"]
+        if "layers" in innerConfig:
+            # A model that's used as a layer, like the bias model in a combined model.
+            _setComputeDtype(innerConfig["layers"], dtype, set())
+        elif layerConfig["class_name"] != "InputLayer" and \
+                innerConfig["name"] not in keepNames:
+            innerConfig["dtype"] = dtype
+
+
 def setMemoryGrowth() -> None:
     """Turn on the tensorflow option to grow memory usage as needed.
 
@@ -364,7 +441,8 @@ def blankChromosomeArrays(*, genomeFname: str | None = None,
 def writeBigwig(bwFname: str, chromDict: dict[str, np.ndarray] | None = None,
                 regionList: list[tuple[str, int, int]] | None = None,
                 regionData: typing.Any = None,
-                chromSizes: dict[str, int] | None = None) -> None:
+                chromSizes: dict[str, int] | None = None,
+                skipZeros: bool = True, mergeRuns: bool = False) -> None:
     """Write a bigwig file given some region data.
 
     You must specify either:
@@ -377,13 +455,25 @@ def writeBigwig(bwFname: str, chromDict: dict[str, np.ndarray] | None = None,
 
     :param bwFname: The name of the bigwig file to write.
     :param chromDict: A dict mapping chromosome names to the data for that
-        chromosome. The data should have shape ``(chromosome-length,)``.
+        chromosome. The data should have shape ``(chromosome-length,)``
+        (or ``(chromosome-length, 1)``, as made by
+        :py:func:`blankChromosomeArrays<bpreveal.utils.blankChromosomeArrays>`).
     :param regionList: A list of ``(chrom, start, end)`` tuples giving the
         locations where the data should be saved.
     :param regionData: An iterable with the same length as ``regionList``.
         The ith element of ``regionData`` will be
         written to the ith location in ``regionList``.
     :param chromSizes: A dict mapping chromosome name → chromosome size.
+    :param skipZeros: If True (the default), bases where the data are zero are
+        left out of the bigwig, so they read back as having no data. If False, zeros
+        are written like any other value.
+    :param mergeRuns: If True, runs of bases with the same value are written as
+        single entries. This makes much smaller files for data that are constant
+        over long stretches, like counts that are the same across a whole region.
+
+    ``NaN`` values are never written. The data are handed to pyBigWig as numpy
+    arrays, a block at a time, so this doesn't need much more memory than
+    ``chromDict`` itself, even for a whole genome.
 
     See :py:func:`loadChromSizes<bpreveal.utils.loadChromSizes>` for an example.
     """
@@ -397,7 +487,7 @@ def writeBigwig(bwFname: str, chromDict: dict[str, np.ndarray] | None = None,
         chromDict = blankChromosomeArrays(bwHeader=chromSizes)
         for i, r in enumerate(regionList):
             chrom, start, end = r
-            chromDict[chrom][start:end] = regionData[i]
+            chromDict[chrom][start:end] = np.reshape(regionData[i], (end - start, 1))
     else:
         chromSizes = {}
         for c in chromDict.keys():
@@ -409,14 +499,49 @@ def writeBigwig(bwFname: str, chromDict: dict[str, np.ndarray] | None = None,
     outBw.addHeader(header)
 
     for chromName in sorted(list(chromDict.keys())):
-        vals = [float(x) for x in chromDict[chromName]]
-        outBw.addEntries(chromName, 0, values=vals,
-                         span=1, step=1)
+        chromData = chromDict[chromName]
+        assert chromData.ndim == 1 or chromData.shape[1:] == (1,), \
+            f"Can only write one track to a bigwig, but got data of shape {chromData.shape}"
+        chromData = chromData.reshape((chromData.shape[0],))
+        # Convert a block at a time so that a whole chromosome is never copied.
+        for blockStart in range(0, chromData.shape[0], _BIGWIG_BLOCK_SIZE):
+            _writeBigwigBlock(outBw, chromName, blockStart,
+                              chromData[blockStart:blockStart + _BIGWIG_BLOCK_SIZE],
+                              skipZeros, mergeRuns)
     logUtils.debug("Data written. Closing bigwig.")
     outBw.close()
     logUtils.debug("Bigwig closed.")
 
 
+_BIGWIG_BLOCK_SIZE = 2 ** 22
+
+
+def _writeBigwigBlock(outBw: pyBigWig.pyBigWig, chromName: str, blockStart: int,
+                      data: np.ndarray, skipZeros: bool, mergeRuns: bool) -> None:
+    """Write the covered runs in one block of a chromosome to a bigwig."""
+    values = data.astype(np.float64)
+    keep = ~np.isnan(values)
+    if skipZeros:
+        keep &= values != 0
+    # Find the starts and ends of the runs of bases that will be written.
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], keep, [False]])))
+    runStarts, runEnds = edges[::2], edges[1::2]
+    if runStarts.shape[0] == 0:
+        return
+    if mergeRuns:
+        # Split the runs wherever the value changes, and write them all as intervals.
+        changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+        starts = np.union1d(runStarts, changes[keep[changes]])
+        runIdx = np.searchsorted(runStarts, starts, side="right") - 1
+        ends = np.minimum(np.append(starts[1:], values.shape[0]), runEnds[runIdx])
+        outBw.addEntries([chromName] * starts.shape[0], starts + blockStart,
+                         ends=ends + blockStart, values=values[starts])
+        return
+    for runStart, runEnd in zip(runStarts, runEnds):
+        outBw.addEntries(chromName, int(runStart + blockStart),
+                         values=values[runStart:runEnd], span=1, step=1)
+
+
 def oneHotEncode(sequence: str, allowN: bool = False, alphabet: str = "ACGT") -> ONEHOT_AR_T:
     """Convert the string sequence into a one-hot encoded numpy array.
 
@@ -575,7 +700,8 @@ def logitsToProfile(logitsAcrossSingleRegion: LOGIT_AR_T,
 # Easy functions
 
 
-def easyPredict(sequences: Iterable[str] | str, modelFname: str, quiet: bool = False) -> \
+def easyPredict(sequences: Iterable[str] | str, modelFname: str, quiet: bool = False,
+                cache: PredictionCache | None = None) -> \
         list[list[PRED_AR_T]] | list[PRED_AR_T]:
     """Make predictions with your model.
 
@@ -584,6 +710,10 @@ def easyPredict(sequences: Iterable[str] | str, modelFname: str, quiet: bool = F
     :param quiet: If True, all stderr spew from tensorflow is deleted. Set to True
         for interactive use, but set to False if you're getting errors, since they'll
         be deleted otherwise and make debugging a nightmare.
+    :param cache: (Optional) A
+        :py:class:`PredictionCache<bpreveal.internal.predictionCache.PredictionCache>`
+        for this model. If you call easyPredict over and over on the same sequences
+        (in a notebook, say), hold on to a cache and pass it in each time.
     :return: An array of profiles or a single profile, depending on ``sequences``
     :rtype: ``list[list[PRED_AR_T]]`` or ``list[PRED_AR_T]``
 
@@ -648,7 +778,7 @@ def easyPredict(sequences: Iterable[str] | str, modelFname: str, quiet: bool = F
         sequences = list(sequences)
     logUtils.debug(f"Running {len(sequences)} predictions using model {modelFname}")
     predictor = ThreadedBatchPredictor(modelFname, 64, start=False, produceProfiles=True,
-                                       quiet=quiet)
+                                       quiet=quiet, cache=cache)
     ret = []
     remainingToRead = 0
     with predictor:
@@ -834,6 +964,19 @@ class BatchPredictor:
     In this example, I'm not using the labels, so I just pass in None
     as the label for each sequence and ignore the labels from ``getOutput()``
 
+    If you already have your sequences in a big one-hot encoded array, you can
+    skip the per-sequence bookkeeping entirely with :py:meth:`~predictArray`,
+    which takes an array of shape ``(numSequences x input-length x NUM_BASES)``
+    and gives you back arrays of logits and logcounts. For streaming use, the
+    same thing is available as :py:meth:`~submitOHEBatch` and
+    :py:meth:`~getOutputBatch`::
+
+        for oheBlock, blockLabels in blockGenerator:
+            batcher.submitOHEBatch(oheBlock, blockLabels)
+            while batcher.outputReady():
+                (logits, logcounts), labels = batcher.getOutputBatch()
+                processPredictions(logits, logcounts, labels)
+
     You should not, however, demand an output after every submission, since this
     will use a batch size of one and be painfully slow::
 
@@ -858,11 +1001,21 @@ class BatchPredictor:
         getOutputProfile() after the prediction has been made.
     :param quiet: If True, then all output to stderr will be suppressed in tensorflow-related
         code. Useful for interactive use.
+    :param cache: (Optional) A
+        :py:class:`PredictionCache<bpreveal.internal.predictionCache.PredictionCache>`
+        made for the same model. Sequences that are found in the cache never go to the
+        model, and new predictions are added to it. Only sequences that are exactly
+        ``input-length`` long are cached.
+    :param mixedPrecision: If True, the model computes in bfloat16, with float32
+        outputs. See :py:func:`~loadModel`. On hardware with bfloat16 support,
+        this is about twice as fast, at the cost of a little accuracy. The
+        ``checkMixedPrecision`` tool tells you how much.
     """
 
     def __init__(self, modelFname: str, batchSize: int, start: bool = True,
                  numThreads: int = 0, produceProfiles: bool = False,
-                 quiet: bool = False) -> None:
+                 quiet: bool = False, cache: PredictionCache | None = None,
+                 mixedPrecision: bool = False) -> None:
         """Start up the BatchPredictor.
 
         This will load your model, and get ready to make predictions.
@@ -877,7 +1030,7 @@ class BatchPredictor:
             self.suppress = disableTfLogging.LeaveStderrAlone
         with self.suppress():
             setMemoryGrowth()
-            self._model = loadModel(modelFname)  # type: ignore
+            self._model = loadModel(modelFname, mixedPrecision)  # type: ignore
         self._inputLength = self._model.input.shape[1]
         self._outputLength = self._model.output[0].shape[1]
         self._tasksPerHead = []
@@ -894,6 +1047,9 @@ class BatchPredictor:
         self._outQueue = deque()
         self._inWaiting = 0
         self._outWaiting = 0
+        self._cache = cache
+        # Mixed-precision predictions are a little different, so they get their own keys.
+        self._cacheKind = "logits-bf16" if mixedPrecision else "logits"
         del start  # We don't refer to start.
         del numThreads
         del produceProfiles
@@ -933,10 +1089,6 @@ class BatchPredictor:
             one-hot encoded sequence to predict.
         :param label: Any object; it will be returned with the prediction.
         """
-        # pylint: disable=import-outside-toplevel
-        import pybedtools
-        from bpreveal import bedUtils
-        # pylint: enable=import-outside-toplevel
         if sequence.shape[0] > self._inputLength:
             # We need to tile.
             logUtils.logFirstN(
@@ -945,34 +1097,72 @@ class BatchPredictor:
                 f"the model has input length {self._inputLength}. Automatic "
                 "tiling of input window enabled. This may incur a performance cost.",
                 1)
-            outputTiles = list(
-                bedUtils.tileSegments(self._inputLength, self._outputLength,
-                                      [pybedtools.Interval("chrN", 0, sequence.shape[0])],
-                                      0))
-            for ot in outputTiles:
-                center = (ot.end + ot.start) // 2
-                start = center - self._inputLength // 2
-                end = start + self._inputLength
-                query = {"sequence": sequence[start:end],
-                         "label": label,
-                         "numTiles": len(outputTiles),
-                         "tileStart": ot.start - (self._inputLength - self._outputLength) // 2}
-                #  Note that tileStart is relative to the OUTPUT, not the input.
-                self._inQueue.appendleft(query)
+            inputStarts, tileStarts = self._tileSequence(sequence.shape[0])
+            # The whole sequence is one entry in the queue. The tiles are cut out
+            # of it when the batch runs.
+            self._inQueue.appendleft(
+                {"sequence": sequence,
+                 "label": label,
+                 "numTiles": len(tileStarts),
+                 "inputStarts": inputStarts,
+                 "tileStarts": tileStarts})
+            #  Note that tileStarts is relative to the OUTPUT, not the input.
+            self._inWaiting += len(tileStarts)
+        elif self._cache is not None:
+            cacheKey = self._cache.key(sequence, self._cacheKind)
+            preds = self._cache.get(cacheKey)
+            if preds is None:
+                self._inQueue.appendleft(
+                    {"sequence": sequence,
+                     "label": label,
+                     "numTiles": 1,
+                     "inputStarts": None,
+                     "tileStarts": None,
+                     "cacheKey": cacheKey})
                 self._inWaiting += 1
+            else:
+                # A cache hit still waits its turn in the queue, so that outputs come
+                # out in order, but it doesn't use any rows in the batch.
+                self._inQueue.appendleft(
+                    {"preds": preds,
+                     "label": label,
+                     "numTiles": 0})
         else:
             self._inQueue.appendleft(
                 {"sequence": sequence,
                  "label": label,
                  "numTiles": 1,
-                 "tileStart": 0})
+                 "inputStarts": None,
+                 "tileStarts": None})
             self._inWaiting += 1
 
-        if self._inWaiting >= self._batchSize * 16:
+        if self._inWaiting >= self._batchSize * 16 or len(self._inQueue) >= self._batchSize * 64:
             # We have a ton of sequences to run, so go ahead
             # and run a batch real quick.
             self.runBatch()
 
+    def _tileSequence(self, sequenceLength: int) -> tuple[np.ndarray, np.ndarray]:
+        """Work out where the tiles go in a sequence that is longer than the model's input.
+
+        :param sequenceLength: The length of the sequence to tile.
+        :return: Two arrays, ``(inputStarts, tileStarts)``. ``inputStarts`` gives the
+            position of each tile's input window in the sequence, and ``tileStarts``
+            gives the position of each tile's output window relative to the start of
+            the stitched output.
+
+        The tiles are laid out the same way as
+        :py:func:`bedUtils.tileSegments<bpreveal.bedUtils.tileSegments>` with
+        ``spacing=0``: the output windows abut each other, and the last one is
+        shifted back so that it ends at the end of the sequence.
+        """
+        padding = (self._inputLength - self._outputLength) // 2
+        segmentEnd = sequenceLength - padding
+        outputStarts = np.arange(padding, segmentEnd - self._outputLength,
+                                 self._outputLength)
+        outputStarts = np.append(outputStarts, segmentEnd - self._outputLength)
+        inputStarts = outputStarts + self._outputLength // 2 - self._inputLength // 2
+        return inputStarts, outputStarts - padding
+
     def submitString(self, sequence: str, label: typing.Any) -> None:
         """Submit a given sequence for prediction.
 
@@ -983,6 +1173,81 @@ class BatchPredictor:
         seqOhe = oneHotEncode(sequence)
         self.submitOHE(seqOhe, label)
 
+    def submitOHEBatch(self, sequences: ONEHOT_AR_T, labels: typing.Any) -> None:
+        """Submit a whole block of one-hot-encoded sequences at once.
+
+        :param sequences: An ``(numSequences x input-length x NUM_BASES)`` ndarray
+            containing the one-hot encoded sequences to predict.
+            Unlike :py:meth:`~submitOHE`, every sequence must be exactly
+            ``input-length`` long.
+        :param labels: Any object; it will be returned with the predictions.
+            This is one label for the whole block, so a list or array with one
+            entry per sequence is a natural choice.
+
+        The block is predicted right away with :py:meth:`~predictArray` and the
+        result is queued, so you must retrieve it with :py:meth:`~getOutputBatch`.
+        Any single sequences that were submitted before this block are run first,
+        so outputs still come out in the order they were submitted.
+        """
+        if self._inQueue:
+            # Flush out the single sequences so that their outputs land in
+            # the out queue before this block.
+            self.runBatch()
+        self._outQueue.appendleft({"batchPreds": self.predictArray(sequences),
+                                   "label": labels})
+        self._outWaiting += 1
+
+    def predictArray(self, sequences: ONEHOT_AR_T) -> \
+            tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]]:
+        """Run predictions on a big array of sequences, and get arrays back.
+
+        :param sequences: An ``(numSequences x input-length x NUM_BASES)`` ndarray
+            containing the one-hot encoded sequences to predict.
+        :return: A tuple of ``(logits, logcounts)``.
+        :rtype: ``tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]]``
+
+        * ``logits`` is a list with one entry per head, and each entry is an array of
+          shape ``(numSequences x output-length x num-tasks)``.
+        * ``logcounts`` is a list with one entry per head, and each entry is an array
+          of shape ``(numSequences,)``.
+
+        This does not touch the queues at all, and it doesn't make any per-sequence
+        Python objects. The output arrays are allocated once and each batch from
+        the model is copied straight into them, so this is the fastest way to get
+        predictions if you have your sequences in memory already.
+        This does not tile sequences that are longer than the model's input length.
+
+        **Example:**
+
+        .. code-block:: python
+
+            from bpreveal.utils import BatchPredictor
+            batcher = BatchPredictor("/scratch/mnase.keras", 64)
+            logits, logcounts = batcher.predictArray(myOneHotSequences)
+            print(logits[0].shape)
+            # > (10000, 1000, 2)
+            print(logcounts[0].shape)
+            # > (10000,)
+        """
+        assert sequences.shape[1:] == (self._inputLength, NUM_BASES), \
+            f"predictArray needs sequences of shape (N x {self._inputLength} x {NUM_BASES}) " \
+            f"but got {sequences.shape}."
+        numSamples = sequences.shape[0]
+        numHeads = len(self._tasksPerHead)
+        logits = [np.empty((numSamples, self._outputLength, numTasks), dtype=LOGIT_T)
+                  for numTasks in self._tasksPerHead]
+        logcounts = [np.empty((numSamples,), dtype=LOGCOUNT_T) for _ in range(numHeads)]
+        with self.suppress():
+            for batchStart in range(0, numSamples, self._batchSize):
+                batchEnd = min(batchStart + self._batchSize, numSamples)
+                # Slicing gives a view, so no copy of the input is made here.
+                preds = self._model.predict_on_batch(sequences[batchStart:batchEnd])
+                for h in range(numHeads):
+                    logits[h][batchStart:batchEnd] = preds[h]
+                    logcounts[h][batchStart:batchEnd] = \
+                        np.reshape(preds[h + numHeads], (batchEnd - batchStart,))
+        return logits, logcounts
+
     def runBatch(self, maxSamples: int | None = None) -> None:
         """Actually run the batch.
 
@@ -995,7 +1260,7 @@ class BatchPredictor:
             run in this batch. It should probably be a multiple of the
             batch size.
         """
-        if self._inWaiting == 0:
+        if not self._inQueue:
             # There are no samples to process right now, so return
             # (successfully) immediately.
             logUtils.info("runBatch was called even though there was nothing to do.")
@@ -1004,23 +1269,38 @@ class BatchPredictor:
             numSamples = self._inWaiting
         else:
             numSamples = min(self._inWaiting, maxSamples)
-        labels = []
-        counts = []
-        tileStarts = []
-        modelInputs = np.zeros((numSamples, self._inputLength, NUM_BASES), dtype=ONEHOT_T)
-        writeHead = 0
-        for _ in range(numSamples):
+        # A tiled sequence is never split across batches, so this may run
+        # a few more than numSamples inputs.
+        entries = []
+        numRows = 0
+        # Cache hits don't take any rows, so take any that are waiting at the
+        # front of the queue even once the batch is full.
+        while self._inQueue and (numRows < numSamples or self._inQueue[-1]["numTiles"] == 0):
             nextElem = self._inQueue.pop()
-            modelInputs[writeHead] = nextElem["sequence"]
-            labels.append(nextElem["label"])
-            counts.append(nextElem["numTiles"])
-            tileStarts.append(nextElem["tileStart"])
-            writeHead += 1
-            self._inWaiting -= 1
-        with self.suppress():
-            preds = self._model.predict(modelInputs[:numSamples, :, :],
-                                        verbose=0,  # type: ignore
-                                        batch_size=self._batchSize)
+            entries.append(nextElem)
+            numRows += nextElem["numTiles"]
+        self._inWaiting -= numRows
+        modelInputs = np.empty((numRows, self._inputLength, NUM_BASES), dtype=ONEHOT_T)
+        writeHead = 0
+        for entry in entries:
+            if entry["numTiles"] == 0:
+                continue
+            if entry["numTiles"] == 1:
+                modelInputs[writeHead] = entry["sequence"]
+            else:
+                # A strided view of every window in the sequence, so the only copy
+                # made is into modelInputs.
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    entry["sequence"], (self._inputLength, NUM_BASES))[:, 0]
+                modelInputs[writeHead:writeHead + entry["numTiles"]] = \
+                    windows[entry["inputStarts"]]
+            writeHead += entry["numTiles"]
+        preds = []
+        if numRows:
+            with self.suppress():
+                preds = self._model.predict(modelInputs,
+                                            verbose=0,  # type: ignore
+                                            batch_size=self._batchSize)
         # I now need to parse out the shape of the prediction to
         # generate the correct outputs.
         numHeads = len(preds) // 2  # Two predictions (logits & logcounts) for each head.
@@ -1034,20 +1314,41 @@ class BatchPredictor:
         # Note that I'm collapsing the batch dimension out,
         # so you don't have to always have a [0] index to
         # indicate the first element of the batch.
-
-        for i in range(numSamples):
+        # Tiled sequences keep their tile dimension, so that they
+        # can be stitched together in one go.
+        readHead = 0
+        for entry in entries:
             curHeads = []
-            # The logits come first.
-            for j in range(numHeads):
-                curHeads.append(preds[j][i])
-            # and then the logcounts. For ease of processing,
-            # I'm converting the logcounts to a float, rather than
-            # a scalar value inside a numpy array.
-            for j in range(numHeads):
-                curHeads.append(float(preds[j + numHeads][i]))
+            numTiles = entry["numTiles"]
+            if numTiles == 0:
+                # This came from the cache.
+                self._outQueue.appendleft(
+                    {"preds": entry["preds"], "label": entry["label"], "numTiles": 1,
+                     "tileStarts": None})
+                self._outWaiting += 1
+                continue
+            if numTiles == 1:
+                # The logits come first.
+                for j in range(numHeads):
+                    curHeads.append(preds[j][readHead])
+                # and then the logcounts. For ease of processing,
+                # I'm converting the logcounts to a float, rather than
+                # a scalar value inside a numpy array.
+                for j in range(numHeads):
+                    curHeads.append(float(preds[j + numHeads][readHead]))
+                if "cacheKey" in entry:
+                    assert self._cache is not None
+                    self._cache.put(entry["cacheKey"], curHeads)
+            else:
+                for j in range(numHeads):
+                    curHeads.append(preds[j][readHead:readHead + numTiles])
+                for j in range(numHeads):
+                    curHeads.append(np.reshape(preds[j + numHeads][readHead:readHead + numTiles],
+                                               (numTiles,)))
+            readHead += numTiles
             self._outQueue.appendleft(
-                {"preds": curHeads, "label": labels[i], "numTiles":
-                 counts[i], "tileStart": tileStarts[i]})
+                {"preds": curHeads, "label": entry["label"], "numTiles":
+                 numTiles, "tileStarts": entry["tileStarts"]})
             self._outWaiting += 1
 
     def outputReady(self) -> bool:
@@ -1067,7 +1368,7 @@ class BatchPredictor:
 
         :return: True if there are no predictions at all in the queue.
         """
-        return self._outWaiting == 0 and self._inWaiting == 0
+        return self._outWaiting == 0 and not self._inQueue
 
     def getOutput(self) -> tuple[list, typing.Any]:
         """Return one of the predictions made by the model.
@@ -1109,21 +1410,46 @@ class BatchPredictor:
 
         This function will error out if an input sequence was longer than the model's input
         length, since there's no logical way to combine the logits and logcounts in that case.
-        If you want to use longer sequences, you should get outputs with getOutputProfile().
+        If you want to use longer sequences, you should get outputs with getOutputProfile()
+        or :py:meth:`~getOutputStitched`.
 
         """
         if not self._outWaiting:
-            if self._inWaiting:
+            if self._inQueue:
                 # There are inputs that have not been processed. Run the batch.
                 self.runBatch()
             else:
                 raise queue.Empty("There are no outputs ready, and the input queue is empty.")
         ret = self._outQueue.pop()
+        assert "batchPreds" not in ret, "Attempted to getOutput but the next output came " \
+            "from submitOHEBatch(). Use getOutputBatch() instead."
         assert ret["numTiles"] == 1, "Attempted to getOutput but the query input size was not " \
             "equal to the model's input size. Use getOutputProfile() instead."
         self._outWaiting -= 1
         return (ret["preds"], ret["label"])
 
+    def getOutputBatch(self) -> tuple[tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]],
+                                      typing.Any]:
+        """Return the predictions for a block submitted with :py:meth:`~submitOHEBatch`.
+
+        :return: A two-tuple.
+        :rtype: ``tuple[tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]], typing.Any]``
+
+        * The first element is ``(logits, logcounts)``, exactly as returned by
+          :py:meth:`~predictArray`.
+        * The second element is the label you passed in with the block.
+
+        Outputs are returned in the order they were submitted, so it is an error
+        to call this when the next output came from a single-sequence submission.
+        """
+        if not self._outWaiting:
+            raise queue.Empty("There are no outputs ready.")
+        ret = self._outQueue.pop()
+        assert "batchPreds" in ret, "Attempted to getOutputBatch but the next output came " \
+            "from a single-sequence submission. Use getOutput() instead."
+        self._outWaiting -= 1
+        return (ret["batchPreds"], ret["label"])
+
     def getOutputProfile(self) -> tuple[list, typing.Any]:
         """Return one of the predictions made by the model, in profile space.
 
@@ -1160,36 +1486,63 @@ class BatchPredictor:
         If there is output ready, then this function will not block.
         """
         if not self._outWaiting:
-            if self._inWaiting:
+            if self._inQueue:
                 # There are inputs that have not been processed. Run the batch.
                 self.runBatch()
             else:
                 raise queue.Empty("There are no outputs ready, and the input queue is empty.")
-        rets = []
         ret = self._outQueue.pop()
+        assert "batchPreds" not in ret, "Attempted to getOutputProfile but the next output " \
+            "came from submitOHEBatch(). Use getOutputBatch() instead."
         self._outWaiting -= 1
-        rets.append(ret)
-        for _ in range(ret["numTiles"] - 1):
-            rets.append(self._outQueue.pop())
-            self._outWaiting -= 1
-        outputWidth = rets[-1]["tileStart"] + self._outputLength
-        headProfiles = [np.zeros((outputWidth, tasks)) for tasks in self._tasksPerHead]
-        headNumPreds = [np.zeros((outputWidth, tasks)) for tasks in self._tasksPerHead]
-        for ret in rets:
-            preds = ret["preds"]
-            outputStart = ret["tileStart"]
-            outputStop = outputStart + self._outputLength
-            for h in range(len(self._tasksPerHead)):
-                logits = preds[h]
-                logcounts = preds[h + len(self._tasksPerHead)]
-                headProfiles[h][outputStart:outputStop] += logitsToProfile(logits, logcounts)
-                headNumPreds[h][outputStart:outputStop] += 1
-        for h in range(len(self._tasksPerHead)):
-            assert np.min(headNumPreds[h]) == 1, \
-                "Missed placing an output somewhere! Please report this bug."
-            headProfiles[h] /= headNumPreds[h]
-
-        return (headProfiles, rets[0]["label"])
+        return (self._stitch(ret), ret["label"])
+
+    def getOutputStitched(self) -> tuple[tuple[list[PRED_AR_T], int], typing.Any]:
+        """Return one prediction in profile space, along with where it starts.
+
+        :return: A two-tuple.
+        :rtype: ``tuple[tuple[list[PRED_AR_T], int], typing.Any]``
+
+        * The first element is ``(profiles, outputStart)``. ``profiles`` is the same
+          list of per-head profiles that :py:meth:`~getOutputProfile` gives you.
+          ``outputStart`` is the position in the submitted sequence where the
+          profiles begin, so ``profiles[h][i]`` is the prediction for base
+          ``outputStart + i`` of the input.
+        * The second element is the label you passed in with the sequence.
+
+        This is the easy way to predict over a long locus: submit the whole one-hot
+        encoded locus with :py:meth:`~submitOHE` and you get back one contiguous
+        profile for it, already stitched together from the tiles, with no need to
+        work out where the tiles went.
+        """
+        ret = self.getOutputProfile()
+        return ((ret[0], (self._inputLength - self._outputLength) // 2), ret[1])
+
+    def _stitch(self, ret: dict) -> list[PRED_AR_T]:
+        """Turn an entry from the output queue into one profile for each head."""
+        numHeads = len(self._tasksPerHead)
+        preds = ret["preds"]
+        if ret["numTiles"] == 1:
+            return [logitsToProfile(preds[h], preds[h + numHeads]) for h in range(numHeads)]
+        tileStarts = ret["tileStarts"]
+        outputWidth = tileStarts[-1] + self._outputLength
+        # positions[i, j] is where base j of tile i goes in the stitched output.
+        positions = tileStarts[:, np.newaxis] + np.arange(self._outputLength)
+        numPreds = np.bincount(positions.ravel(), minlength=outputWidth)
+        assert np.min(numPreds) >= 1, \
+            "Missed placing an output somewhere! Please report this bug."
+        headProfiles = []
+        for h in range(numHeads):
+            # Same as logitsToProfile, but for all of the tiles at once.
+            tileProfiles = scipy.special.softmax(preds[h], axis=(1, 2)) \
+                * np.exp(preds[h + numHeads])[:, np.newaxis, np.newaxis]
+            profile = np.zeros((outputWidth, self._tasksPerHead[h]), dtype=PRED_T)
+            # The last tile usually overlaps the one before it, so the overlapping
+            # bases are averaged.
+            np.add.at(profile, positions, tileProfiles)
+            profile /= numPreds[:, np.newaxis]
+            headProfiles.append(profile)
+        return headProfiles
 
 
 class ThreadedBatchPredictor:
@@ -1222,6 +1575,17 @@ class ThreadedBatchPredictor:
     the order you submitted them in, even though the internal calculations may
     happen out-of-order.
 
+    Queries are gathered into chunks of ``batchSize`` and put on a single work
+    queue that all of the worker processes pull from, so a worker that is running
+    slowly (because it's sharing a CPU, say) just ends up doing less of the work
+    instead of holding everyone else up. The results are put back in order in
+    a reorder buffer in this process.
+
+    Only about 10,000 queries per worker can wait in the work queue, and about as
+    many results can wait to be read. So read outputs as they become ready (check
+    :py:meth:`~outputReady` after each submission, as in the example for
+    :py:class:`~BatchPredictor`) rather than submitting everything first.
+
     :param modelFname: The name of the model to use to make predictions.
     :param batchSize: The number of samples to calculate at once.
     :param start: Should the predictor start right away? This should be False
@@ -1235,12 +1599,32 @@ class ThreadedBatchPredictor:
         production is done in parallel and so this class needs to know what sort
         of output you will want so it can have it ready for you when you need it.
     :param quiet: If True, redirect all stdout from tensorflow to the trash.
+    :param sharedMemory: If True, pass sequences and predictions to the worker
+        processes through ring buffers in shared memory instead of pickling them
+        onto a queue. Only slot numbers and labels go through the queues. This is
+        much faster for models with wide outputs or lots of tasks.
+
+    With ``sharedMemory=True``, the ring buffers are created once the first
+    prediction comes back, since that's when the batcher learns the size of the
+    model's outputs. The rings have ``32 * batchSize`` slots per worker. Queries that can't
+    use the rings (because they're a different length than the first query, or
+    because all the slots are full) just go through the queue as usual, so you
+    don't need to do anything differently.
+
+    :param cache: (Optional) A
+        :py:class:`PredictionCache<bpreveal.internal.predictionCache.PredictionCache>`
+        made for the same model. The cache lives in this process: queries that are
+        found in it are never sent to the workers, and the predictions that come
+        back from the workers are added to it.
+    :param mixedPrecision: If True, the workers' models compute in bfloat16.
+        See :py:class:`~BatchPredictor`.
 
     """
 
     def __init__(self, modelFname: str, batchSize: int, start: bool = False,
                  numThreads: int = 1, produceProfiles: bool = False,
-                 quiet: bool = False) -> None:
+                 quiet: bool = False, sharedMemory: bool = False,
+                 cache: PredictionCache | None = None, mixedPrecision: bool = False) -> None:
         """Build the batch predictor."""
         logUtils.debug(f"Creating threaded batch predictor for model {modelFname}.")
         self._batchSize = batchSize
@@ -1255,6 +1639,15 @@ class ThreadedBatchPredictor:
         self.running = False
         self._quiet = quiet
         self._contextDepth = 0
+        self._sharedMemory = sharedMemory
+        self._inRing = None
+        self._outRing = None
+        self._firstInputShape = None
+        self._cache = cache
+        self._cacheKind = "profile" if produceProfiles else "logits"
+        if mixedPrecision:
+            self._cacheKind += "-bf16"
+        self._mixedPrecision = mixedPrecision
         if start:
             self.start()
 
@@ -1300,26 +1693,46 @@ class ThreadedBatchPredictor:
             logUtils.debug("Starting threaded batcher.")
             assert self._batchers is None, "Attempting to start a new batcher when an "\
                 "old one is still alive." + str(self._batchers)
-            self._inQueues = []
-            self._outQueues = []
+            if self._sharedMemory:
+                # Start the resource tracker before forking so that the workers
+                # share it. Otherwise each worker starts its own tracker when it
+                # attaches to the rings, and that tracker frees the rings when
+                # the worker exits.
+                resource_tracker.ensure_running()
+            # All of the workers pull chunks from the same queue, so a fast worker
+            # just takes more of the work. Each chunk is one batch, so this holds
+            # about as many sequences as the old per-worker queues did.
+            self._inQueue = CrashQueue(maxsize=max(10000 // self._batchSize, 1)
+                                       * self._numThreads)
+            # The output queue holds as many chunks of results as the input queue
+            # holds chunks of work. If you submit a lot more than that without
+            # reading any results, the workers stop and then submitting blocks, so
+            # results are never piled up in memory without limit.
+            self._outQueue = CrashQueue(maxsize=max(10000 // self._batchSize, 1)
+                                        * self._numThreads)
             self._batchers = []
-
             for _ in range(self._numThreads):
-                nextInQueue = CrashQueue(maxsize=10000)
-                nextOutQueue = CrashQueue(maxsize=10000)
-                self._inQueues.append(nextInQueue)
-                self._outQueues.append(nextOutQueue)
                 nextBatcher = multiprocessing.Process(
                     target=_batcherThread,
-                    args=(self._modelFname, self._batchSize, nextInQueue,
-                          nextOutQueue, self._produceProfiles, self._quiet),
+                    args=(self._modelFname, self._batchSize, self._inQueue,
+                          self._outQueue, self._produceProfiles, self._quiet,
+                          self._mixedPrecision),
                     daemon=True)
                 nextBatcher.start()
                 self._batchers.append(nextBatcher)
             self._inFlight = 0
-            self._inQueueIdx = 0
             self.running = True
-            self._outQueueOrder = deque()
+            # Each query gets a number when it's submitted, and the results are
+            # handed back in that order. Results that come back early wait in
+            # the reorder buffer.
+            self._numSubmitted = 0
+            self._numReturned = 0
+            self._reorderBuffer = {}
+            self._cacheKeys = {}
+            self._chunk = []
+            self._chunkIdxs = []
+            self._chunkUsesRing = False
+            self._freeSlots = deque()
         else:
             logUtils.warning("Attempted to start a batcher that was already running.")
 
@@ -1336,19 +1749,28 @@ class ThreadedBatchPredictor:
             if self._batchers is None:
                 raise ValueError("Attempting to shut down a running ThreadedBatchPredictor"
                                  "When its _batchers is None.")
-            for i in range(self._numThreads):
-                self._inQueues[i].put("shutdown")
-                self._inQueues[i].close()
-                self._batchers[i].join(5)  # Wait 5 seconds.
-                if self._batchers[i].exitcode is None:
+            # Each worker exits as soon as it reads one shutdown message, so every
+            # worker gets exactly one.
+            for _ in range(self._numThreads):
+                self._inQueue.put("shutdown")
+            self._inQueue.close()
+            for batcher in self._batchers:
+                batcher.join(5)  # Wait 5 seconds.
+                if batcher.exitcode is None:
                     # The process failed to die. Kill it more forcefully.
-                    self._batchers[i].terminate()
-                self._batchers[i].join(5)  # Wait 5 seconds.
-                self._batchers[i].close()
-                self._outQueues[i].close()
-            del self._inQueues
+                    batcher.terminate()
+                batcher.join(5)  # Wait 5 seconds.
+                batcher.close()
+            self._outQueue.close()
+            del self._inQueue
             del self._batchers
-            del self._outQueues
+            del self._outQueue
+            if self._inRing is not None and self._outRing is not None:
+                # The workers are dead, so nobody else is using the rings.
+                self._inRing.close()
+                self._outRing.close()
+            self._inRing = None
+            self._outRing = None
             # Explicitly set None so that start won't panic.
             self._batchers = None
             self.running = False
@@ -1375,13 +1797,31 @@ class ThreadedBatchPredictor:
         if not self.running:
             logUtils.warning("Submitted a query when the batcher is stopped. Starting.")
             self.start()
-        q = self._inQueues[self._inQueueIdx]
-        query = (sequence, label)
-        q.put(query)
-        self._outQueueOrder.appendleft(self._inQueueIdx)
-        # Assign work in a round-robin fashion.
-        self._inQueueIdx = (self._inQueueIdx + 1) % self._numThreads
+        if self._firstInputShape is None:
+            self._firstInputShape = sequence.shape
+        idx = self._numSubmitted
+        self._numSubmitted += 1
         self._inFlight += 1
+        if self._cache is not None:
+            cacheKey = self._cache.key(sequence, self._cacheKind)
+            preds = self._cache.get(cacheKey)
+            if preds is not None:
+                # No need to bother the workers, just wait for its turn.
+                self._reorderBuffer[idx] = (preds, label)
+                return
+            self._cacheKeys[idx] = cacheKey
+        if self._inRing is not None and self._freeSlots \
+                and sequence.shape == self._inRing.arrays[0].shape[1:]:
+            # Put the sequence in shared memory and just send the slot number.
+            slotIdx = self._freeSlots.pop()
+            self._inRing.arrays[0][slotIdx] = sequence
+            self._chunk.append(("slot", slotIdx, label))
+            self._chunkUsesRing = True
+        else:
+            self._chunk.append((sequence, label))
+        self._chunkIdxs.append(idx)
+        if len(self._chunk) >= self._batchSize:
+            self._sendChunk()
 
     def submitString(self, sequence: str, label: typing.Any) -> None:
         """Submit a given sequence for prediction.
@@ -1393,6 +1833,73 @@ class ThreadedBatchPredictor:
         seqOhe = oneHotEncode(sequence)
         self.submitOHE(seqOhe, label)
 
+    def submitOHEBatch(self, sequences: ONEHOT_AR_T, labels: typing.Any) -> None:
+        """Submit a whole block of one-hot-encoded sequences at once.
+
+        :param sequences: An ``(numSequences x input-length x NUM_BASES)`` ndarray
+            containing the one-hot encoded sequences to predict.
+        :param labels: Any (picklable) object; it will be returned with the predictions.
+
+        Same semantics as
+        :py:meth:`BatchPredictor.submitOHEBatch<bpreveal.utils.BatchPredictor.submitOHEBatch>`.
+        The block always comes back as logits and logcounts, even if this batcher
+        was configured with ``produceProfiles=True``.
+        """
+        if not self.running:
+            logUtils.warning("Submitted a query when the batcher is stopped. Starting.")
+            self.start()
+        # Anything submitted before this block has to get a lower number.
+        self._sendChunk()
+        self._inQueue.put(("batch", self._numSubmitted, sequences, labels))
+        self._numSubmitted += 1
+        self._inFlight += 1
+
+    def predictArray(self, sequences: ONEHOT_AR_T) -> \
+            tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]]:
+        """Run predictions on a big array of sequences, and get arrays back.
+
+        :param sequences: An ``(numSequences x input-length x NUM_BASES)`` ndarray
+            containing the one-hot encoded sequences to predict.
+        :return: A tuple of ``(logits, logcounts)``.
+        :rtype: ``tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]]``
+
+        Same semantics as
+        :py:meth:`BatchPredictor.predictArray<bpreveal.utils.BatchPredictor.predictArray>`.
+        The array is cut into blocks that are spread over the worker processes, and
+        the results are copied into preallocated output arrays as they come back.
+        The batcher must be empty when you call this.
+        """
+        assert self.empty(), "Cannot predictArray() while there are predictions in flight."
+        numSamples = sequences.shape[0]
+        # Sixteen batches per block keeps each worker busy without making
+        # the pickled blocks enormous.
+        blockSize = self._batchSize * 16
+        logits = logcounts = None
+
+        def storeBlock() -> None:
+            nonlocal logits, logcounts
+            (blockLogits, blockLogcounts), blockStart = self.getOutputBatch()
+            if logits is None or logcounts is None:
+                logits = [np.empty((numSamples,) + x.shape[1:], dtype=LOGIT_T)
+                          for x in blockLogits]
+                logcounts = [np.empty((numSamples,), dtype=LOGCOUNT_T) for _ in blockLogcounts]
+            blockEnd = blockStart + blockLogcounts[0].shape[0]
+            for h, headLogits in enumerate(blockLogits):
+                logits[h][blockStart:blockEnd] = headLogits
+                logcounts[h][blockStart:blockEnd] = blockLogcounts[h]
+
+        # An empty array still goes to a worker as one (empty) block, since only
+        # the workers know the shapes of the model's outputs.
+        for blockStart in range(0, max(numSamples, 1), blockSize):
+            self.submitOHEBatch(sequences[blockStart:blockStart + blockSize], blockStart)
+            # Collect results as we go, since the queues only hold so many.
+            while self.outputReady():
+                storeBlock()
+        while not self.empty():
+            storeBlock()
+        assert logits is not None and logcounts is not None
+        return logits, logcounts
+
     def outputReady(self) -> bool:
         """Is there any output ready for you?
 
@@ -1401,8 +1908,9 @@ class ThreadedBatchPredictor:
         :return: ``True`` if the batcher is sitting on results, and ``False`` otherwise.
         """
         if self._inFlight:
-            outIdx = self._outQueueOrder[-1]
-            return not self._outQueues[outIdx].empty()
+            while not self._outQueue.empty():
+                self._storeResult(self._outQueue.get())
+            return self._numReturned in self._reorderBuffer
         return False
 
     def empty(self) -> bool:
@@ -1426,16 +1934,9 @@ class ThreadedBatchPredictor:
         """
         assert not self._produceProfiles, "Cannot getOutput() on a batcher that is set " \
             "to produce profiles. Use getOutputProfile() instead."
-        nextQueueIdx = self._outQueueOrder.pop()
-        if self._outQueues[nextQueueIdx].empty():
-            if self._inFlight:
-                # There are inputs that have not been processed. Run the batch.
-                self._inQueues[nextQueueIdx].put("finishBatch")
-            else:
-                raise queue.Empty("The batcher is empty; cannot getOutput().")
-        ret = self._outQueues[nextQueueIdx].get()
-        self._inFlight -= 1
-        return ret
+        if not self._inFlight:
+            raise queue.Empty("The batcher is empty; cannot getOutput().")
+        return self._nextSingle()
 
     def getOutputProfile(self) -> tuple[list, typing.Any]:
         """Get a single output, but in profile space instead of logits.
@@ -1448,20 +1949,101 @@ class ThreadedBatchPredictor:
         """
         assert self._produceProfiles, "Cannot getOutputProfile unless the batcher was " \
             "configured with produceProfile=True."
-        nextQueueIdx = self._outQueueOrder.pop()
-        if self._outQueues[nextQueueIdx].empty():
-            if self._inFlight:
-                # There are inputs that have not been processed. Run the batch.
-                self._inQueues[nextQueueIdx].put("finishBatch")
-            else:
-                raise queue.Empty("The batcher is empty; cannot getOutputProfile().")
-        ret = self._outQueues[nextQueueIdx].get()
+        if not self._inFlight:
+            raise queue.Empty("The batcher is empty; cannot getOutputProfile().")
+        return self._nextSingle()
+
+    def getOutputBatch(self) -> tuple[tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]],
+                                      typing.Any]:
+        """Get the predictions for a block submitted with :py:meth:`~submitOHEBatch`.
+
+        :return: The model's predictions and the label.
+        :rtype: ``tuple[tuple[list[LOGIT_AR_T], list[LOGCOUNT_AR_T]], typing.Any]``
+
+        Same semantics as
+        :py:meth:`BatchPredictor.getOutputBatch<bpreveal.utils.BatchPredictor.getOutputBatch>`.
+        """
+        if not self._inFlight:
+            raise queue.Empty("The batcher is empty; cannot getOutputBatch().")
+        return self._nextResult()
+
+    def _sendChunk(self) -> None:
+        """Put the sequences that have been submitted so far on the work queue."""
+        if not self._chunk:
+            return
+        # Only send the ring specs if the workers need them, so that chunks
+        # without any slots stay small.
+        ringSpecs = None
+        if self._chunkUsesRing:
+            assert self._inRing is not None and self._outRing is not None
+            ringSpecs = (self._inRing.spec, self._outRing.spec)
+        self._inQueue.put(("chunk", self._chunkIdxs, self._chunk, ringSpecs))
+        self._chunk = []
+        self._chunkIdxs = []
+        self._chunkUsesRing = False
+
+    def _storeResult(self, result: tuple) -> None:
+        """Put a message from a worker into the reorder buffer."""
+        match result:
+            case ("chunk", idxs, outputs):
+                for idx, output in zip(idxs, outputs):
+                    self._reorderBuffer[idx] = output
+            case ("batch", idx, output):
+                self._reorderBuffer[idx] = output
+
+    def _nextResult(self) -> typing.Any:
+        """Wait for the oldest outstanding query to finish and take it out of the buffer."""
+        if self._chunkIdxs and self._numReturned >= self._chunkIdxs[0]:
+            # The query we want hasn't even been sent to the workers yet.
+            self._sendChunk()
+        while self._numReturned not in self._reorderBuffer:
+            self._storeResult(self._outQueue.get())
+        ret = self._reorderBuffer.pop(self._numReturned)
+        self._numReturned += 1
         self._inFlight -= 1
         return ret
 
+    def _nextSingle(self) -> tuple[list, typing.Any]:
+        """Get the next single-sequence prediction, and add it to the cache if needed."""
+        idx = self._numReturned
+        ret = self._receive(self._nextResult())
+        if idx in self._cacheKeys:
+            assert self._cache is not None
+            self._cache.put(self._cacheKeys.pop(idx), ret[0])
+        return ret
+
+    def _receive(self, result: tuple) -> tuple[list, typing.Any]:
+        """Turn an output from a worker into a prediction, reading shared memory if needed."""
+        match result:
+            case ("slot", slotIdx, label):
+                assert self._outRing is not None
+                ret = (self._outRing.read(slotIdx), label)
+                self._freeSlots.appendleft(slotIdx)
+            case ("freed", slotIdx, ret):
+                # This query came in through shared memory, but its output
+                # didn't fit, so it was pickled.
+                self._freeSlots.appendleft(slotIdx)
+            case ret:
+                if self._sharedMemory and self._inRing is None:
+                    self._buildRings(ret[0])
+        return ret
+
+    def _buildRings(self, samplePreds: list) -> None:
+        """Now that we know what the outputs look like, set up the shared memory.
+
+        :param samplePreds: An output from the model, used to size the output ring.
+        """
+        numSlots = self._batchSize * 32 * self._numThreads
+        logUtils.debug(f"Creating shared memory rings with {numSlots} slots.")
+        self._inRing = SharedRing(numSlots, [self._firstInputShape], [ONEHOT_T])
+        self._outRing = SharedRing(numSlots, [np.shape(x) for x in samplePreds],
+                                   [np.asarray(x).dtype for x in samplePreds])
+        self._freeSlots = deque(range(numSlots))
+
 
 def _batcherThread(modelFname: str, batchSize: int, inQueue: CrashQueue,
-                   outQueue: CrashQueue, produceProfiles: bool, quiet: bool) -> None:
+                   outQueue: CrashQueue, produceProfiles: bool, quiet: bool,
+                   mixedPrecision: bool) -> None:
     """Run batches from the ``ThreadedBatchPredictor`` in this separate thread.
 
     If produceProfiles is True, then this will emit results from getOutputProfile().
@@ -1469,6 +2051,10 @@ def _batcherThread(modelFname: str, batchSize: int, inQueue: CrashQueue,
     Since this thread will put outputs into the queue before the user has asked,
     we need to know a priori whether we should produce profiles.
 
+    All of the workers share ``inQueue`` and ``outQueue``. Each message on the input
+    queue is a whole chunk of work, and the results go back tagged with the numbers
+    of the queries in the chunk, so the parent can put them in order.
+
     .. note::
         Sets :py:data:`bpreveal.internal.constants.GLOBAL_TENSORFLOW_LOADED`.
     """
@@ -1477,49 +2063,49 @@ def _batcherThread(modelFname: str, batchSize: int, inQueue: CrashQueue,
     logUtils.debug("Starting subthread")
     # Instead of reinventing the wheel, the thread that actually runs the batches
     # just creates a BatchPredictor.
-    batcher = BatchPredictor(modelFname, batchSize, quiet=quiet)
-    predsInFlight = 0
-    numWaits = 0
-    getOutput = batcher.getOutput
+    batcher = BatchPredictor(modelFname, batchSize, quiet=quiet,
+                             mixedPrecision=mixedPrecision)
+    batcherGetOutput = batcher.getOutput
     if produceProfiles:
-        getOutput = batcher.getOutputProfile
+        batcherGetOutput = batcher.getOutputProfile
+    inRing = outRing = None
+
+    def getOutput() -> tuple:
+        # The label that went into the batcher is (slot number, user's label),
+        # where the slot number is None if the query came in through the queue.
+        preds, (slotIdx, label) = batcherGetOutput()
+        if slotIdx is None:
+            return (preds, label)
+        assert outRing is not None
+        if outRing.fits(preds):
+            outRing.write(slotIdx, preds)
+            return ("slot", slotIdx, label)
+        return ("freed", slotIdx, (preds, label))
     while True:
-        # No timeout because this batcher could be waiting for a very long time to get
-        # inputs.
+        # The workers only ever get full chunks (or the last, partial chunk
+        # that the parent is waiting on), so there's never a reason to stop
+        # waiting and run a partial batch.
         try:
-            inVal = inQueue.get(timeout=0.1)
+            inVal = inQueue.get()
         except queue.Empty:
-            numWaits += 1
-            # There was no input. Are we sitting on predictions that we could go ahead
-            # and make?
-            # pylint: disable=protected-access
-            if batcher._inWaiting > batcher._batchSize / numWaits:
-                # pylint: enable=protected-access
-                # division by numWeights so that if you wait a long time, it will even
-                # run a partial batch.
-                # Nope, go ahead and give the batcher a spin while we wait.
-                batcher.runBatch(maxSamples=batchSize)
-                while not outQueue.full() and batcher.outputReady():
-                    outQueue.put(getOutput())
-                    predsInFlight -= 1
             continue
-        numWaits = 0
         match inVal:
-            case(sequence, label):
-                if isinstance(sequence, str):
-                    batcher.submitString(sequence, label)
-                else:
-                    batcher.submitOHE(sequence, label)
-                predsInFlight += 1
-                # If there's an answer and the out queue can handle it, go ahead
-                # and send it.
-                while not outQueue.full() and batcher.outputReady():
-                    outQueue.put(getOutput())
-                    predsInFlight -= 1
-            case "finishBatch":
-                while predsInFlight:
-                    outQueue.put(getOutput())
-                    predsInFlight -= 1
+            case ("chunk", idxs, entries, ringSpecs):
+                if ringSpecs is not None and inRing is None:
+                    inRing = SharedRing.attach(ringSpecs[0])
+                    outRing = SharedRing.attach(ringSpecs[1])
+                for entry in entries:
+                    match entry:
+                        case ("slot", slotIdx, label):
+                            assert inRing is not None
+                            # No need to copy; the parent won't touch this slot until
+                            # it has read back the prediction.
+                            batcher.submitOHE(inRing.arrays[0][slotIdx], (slotIdx, label))
+                        case (sequence, label):
+                            batcher.submitOHE(sequence, (None, label))
+                outQueue.put(("chunk", idxs, [getOutput() for _ in entries]))
+            case ("batch", idx, sequences, labels):
+                outQueue.put(("batch", idx, (batcher.predictArray(sequences), labels)))
             case "shutdown":
                 # End the thread.
                 logUtils.debug("Shutdown signal received.")